@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from src.traj_io import TrajStore
+
+
+class Space(object):
+    def __init__(self, shape=None, n=None):
+        self.shape = shape
+        self.n = n
+
+
+class StubAtariEnv(object):
+    def __init__(self, episode_len=1000, num_actions=6, seed=0):
+        """
+        Emulator stub with the gym Pong interface (RGB frames, 4-tuple step), returning random frames so that the
+        benchmarks measure the pipeline around the emulator instead of the ROM
+        :param episode_len: number of frames of an episode
+        :param num_actions: number of actions
+        :param seed: random seed
+        """
+        self.observation_space = Space(shape=(210, 160, 3))
+        self.action_space = Space(n=num_actions)
+        self.episode_len = episode_len
+        self.rng = np.random.RandomState(seed)
+        self.frames = self.rng.randint(0, 256, size=(16, 210, 160, 3), dtype=np.uint8)
+        self.t = 0
+
+    def seed(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        return [seed]
+
+    def reset(self):
+        self.t = 0
+        return self.frames[0]
+
+    def step(self, action):
+        self.t += 1
+        reward = float(self.rng.choice([-1, 0, 1], p=[0.005, 0.99, 0.005]))
+        return self.frames[self.t % self.frames.shape[0]], reward, self.t >= self.episode_len, {}
+
+    def close(self):
+        pass
+
+
+def make_trajs(traj_path, num_traj, seq_len, seed=0):
+    """
+    Write random Pong-shaped trajs into a store
+    :param traj_path: traj path prefix
+    :param num_traj: number of trajs
+    :param seq_len: traj length
+    :param seed: random seed
+    """
+    rng = np.random.RandomState(seed)
+    store = TrajStore.create(traj_path, num_traj, {'states': ((seq_len, 4, 84, 84), np.uint8),
+                                                   'actions': ((seq_len, ), np.int64),
+                                                   'final_rewards': ((), np.int64),
+                                                   'seeds': ((), np.int64)})
+    for idx in range(num_traj):
+        store.write(idx, states=rng.randint(0, 256, size=(seq_len, 4, 84, 84), dtype=np.uint8),
+                    actions=rng.randint(1, 7, size=seq_len), final_rewards=rng.randint(0, 2), seeds=idx)
+    store.flush()
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed(func, *args, **kwargs):
+    """
+    :return: output of func, elapsed wall clock seconds (including the pending cuda work)
+    """
+    synchronize()
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    synchronize()
+    return out, time.perf_counter() - start
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output):
+    """
+    :param results: {stage: {metric: value}}
+    :param output: json file
+    """
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'device': torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'cpu',
+              'torch': torch.__version__, 'results': results}
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}.'.format(output))
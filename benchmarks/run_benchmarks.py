@@ -0,0 +1,170 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+# The scripts import the repo modules (src, emulator, ppo, utils) from the repo root, whatever the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from common import StubAtariEnv, make_trajs, timed, save_results
+from emulator import AtariEmulator, get_next_actions
+from ppo import AtariPolicy, PPO
+from utils import NNPolicy
+from src.xfeat import MaskFeatExp
+from src.xstep import DGPStepExp
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+NUM_ACTIONS = 6
+
+
+def bench_emulator(args):
+    """
+    :return: steps/s of AtariEmulator.next
+    """
+    emulator = AtariEmulator(StubAtariEnv(seed=args.seed))
+    emulator.init(noops=0)
+    actions = np.eye(NUM_ACTIONS)[np.random.RandomState(args.seed).randint(0, NUM_ACTIONS, args.emulator_steps)]
+
+    def run():
+        for action in actions:
+            _, _, done = emulator.next(action)
+            if done:
+                emulator.init(noops=0)
+
+    _, elapsed = timed(run)
+    return {'steps_per_sec': args.emulator_steps / elapsed}
+
+
+def bench_step_explainer(args, traj_path, save_dir):
+    """
+    :return: trajs/s of DGPStepExp.train and DGPStepExp.test, test accuracy
+    """
+    torch.manual_seed(args.seed)
+    explainer = DGPStepExp(train_len=args.num_train, seq_len=args.seq_len, input_dim=84, hiddens=[4],
+                           input_channels=4, likelihood_type='classification', lr=0.01, optimizer_type='adam',
+                           n_epoch=1, gamma=0.1, num_inducing_points=args.num_inducing_points, encoder_type='CNN',
+                           num_class=2, lambda_1=0.001, weight_x=True)
+    train_idx = np.arange(args.num_train)
+    test_idx = np.arange(args.num_train, args.num_train + args.num_test)
+
+    _, train_time = timed(explainer.train, train_idx=train_idx, batch_size=args.batch_size, traj_path=traj_path,
+                          save_path=os.path.join(save_dir, 'step_model.data'))
+    acc, test_time = timed(explainer.test, test_idx=test_idx, batch_size=args.batch_size, traj_path=traj_path)
+    return {'train_trajs_per_sec': args.num_train / train_time, 'test_trajs_per_sec': args.num_test / test_time,
+            'test_accuracy': float(acc)}
+
+
+def bench_mask(args):
+    """
+    :return: samples/s of the MaskObsModel fitting step (loss, backward, optimizer step)
+    """
+    torch.manual_seed(args.seed)
+    policy = AtariPolicy(NNPolicy(channels=4, num_actions=NUM_ACTIONS))
+    explainer = MaskFeatExp(policy=policy, act_distribution='cat', input_shape=(4, 84, 84), mask_shape=(1, 84, 84),
+                            lr=0.01, noise_seed=args.seed)
+    obs = torch.randint(0, 256, (args.mask_batch_size, 4, 84, 84), device=device).float()
+    fused_obs = torch.zeros(4, 84, 84, device=device).expand_as(obs)
+    acts = torch.randint(1, NUM_ACTIONS + 1, (args.mask_batch_size, ), device=device)
+
+    def run():
+        for _ in range(args.mask_iters):
+            loss = explainer.compute_loss(obs, fused_obs, acts, 'l1', 0.01, 0.01)[0]
+            explainer.optimizer.zero_grad()
+            loss.backward()
+            explainer.optimizer.step()
+
+    run()  # warm up
+    _, elapsed = timed(run)
+    return {'samples_per_sec': args.mask_batch_size * args.mask_iters / elapsed}
+
+
+def bench_ppo(args):
+    """
+    :return: PPO updates/s on a full buffer of random states
+    """
+    torch.manual_seed(args.seed)
+    model = NNPolicy(channels=4, num_actions=NUM_ACTIONS)
+    poisoned_policy = AtariPolicy(model=model).to(device)
+    for param in poisoned_policy.parameters():
+        param.requires_grad = False
+    agent = PPO(None, NUM_ACTIONS, 0.0003, 0.001, 0.99, args.ppo_epochs, 0.2, False, policy_model=model,
+                poisoned_policy=poisoned_policy, kl_regularize=True, device=device,
+                buffer_size=args.ppo_buffer_size)
+    rng = np.random.RandomState(args.seed)
+
+    def fill():
+        for t in range(args.ppo_buffer_size):
+            state = torch.randint(0, 256, (1, 4, 84, 84), device=device).float()
+            agent.select_action(state)
+            agent.buffer.add_outcome(float(rng.choice([-1, 0, 1], p=[0.01, 0.98, 0.01])), t % 1000 == 999)
+        return state
+
+    elapsed = 0
+    for _ in range(args.ppo_updates):
+        state_old = fill()
+        _, update_time = timed(agent.update, False, state_old)
+        elapsed += update_time
+    return {'updates_per_sec': args.ppo_updates / elapsed}
+
+
+def bench_policy(args):
+    """
+    :return: latency (ms) of one eval.py step: masking, policy forward on a batch of one and action sampling
+    """
+    torch.manual_seed(args.seed)
+    policy = AtariPolicy(NNPolicy(channels=4, num_actions=NUM_ACTIONS)).to(device)
+    policy.eval()
+    mask = torch.zeros(1, 84, 84, device=device)
+    state = np.random.RandomState(args.seed).randint(0, 256, size=(84, 84, 4), dtype=np.uint8)
+
+    def run():
+        with torch.no_grad():
+            for _ in range(args.policy_steps):
+                obs = torch.tensor(np.transpose(state[None, :, :, :], (0, 3, 1, 2)), dtype=torch.float32).to(device)
+                get_next_actions(policy, obs * (1 - mask), NUM_ACTIONS)
+
+    run()  # warm up
+    _, elapsed = timed(run)
+    return {'latency_ms': 1000 * elapsed / args.policy_steps}
+
+
+STAGES = {'emulator': bench_emulator, 'step_explainer': bench_step_explainer, 'mask': bench_mask, 'ppo': bench_ppo,
+          'policy': bench_policy}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--output', type=str, default='benchmarks/results.json', help='json file of the results')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--emulator_steps', type=int, default=2000)
+    parser.add_argument('--num_train', type=int, default=200)
+    parser.add_argument('--num_test', type=int, default=100)
+    parser.add_argument('--seq_len', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--num_inducing_points', type=int, default=300)
+    parser.add_argument('--mask_batch_size', type=int, default=256)
+    parser.add_argument('--mask_iters', type=int, default=20)
+    parser.add_argument('--ppo_buffer_size', type=int, default=4000)
+    parser.add_argument('--ppo_epochs', type=int, default=80)
+    parser.add_argument('--ppo_updates', type=int, default=2)
+    parser.add_argument('--policy_steps', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {}
+    for stage in args.stages:
+        print('Running the {} benchmark.'.format(stage))
+        if stage == 'step_explainer':
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                traj_path = os.path.join(tmp_dir, 'pong')
+                make_trajs(traj_path, args.num_train + args.num_test, args.seq_len, args.seed)
+                results[stage] = bench_step_explainer(args, traj_path, tmp_dir)
+        else:
+            results[stage] = STAGES[stage](args)
+        print(stage, results[stage])
+
+    save_results(results, args.output)
@@ -0,0 +1,64 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+# The scripts import the repo modules (src, emulator, ppo, utils) from the repo root, whatever the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from common import make_trajs, timed
+from src.xstep import DGPStepExp
+
+
+def run(amp, traj_path, save_dir, args):
+    """
+    :return: training throughput (trajs/s), test accuracy
+    """
+    torch.manual_seed(args.seed)
+    explainer = DGPStepExp(train_len=args.num_train, seq_len=args.seq_len, input_dim=84, hiddens=[4],
+                           input_channels=4, likelihood_type='classification', lr=0.01, optimizer_type='adam',
+                           n_epoch=args.n_epoch, gamma=0.1, num_inducing_points=args.num_inducing_points,
+                           encoder_type='CNN', num_class=2, lambda_1=0.001, weight_x=True, amp=amp)
+    train_idx = np.arange(args.num_train)
+    test_idx = np.arange(args.num_train, args.num_train + args.num_test)
+
+    _, elapsed = timed(explainer.train, train_idx=train_idx, batch_size=args.batch_size, traj_path=traj_path,
+                       save_path=os.path.join(save_dir, 'step_model_{}.data'.format(amp)))
+    throughput = args.num_train * args.n_epoch / elapsed
+
+    acc = explainer.test(test_idx=test_idx, batch_size=args.batch_size, traj_path=traj_path)
+    return throughput, acc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amp', type=str, nargs='+', default=None, help='modes to compare, all available by default')
+    parser.add_argument('--traj_path', type=str, default=None, help='real trajs, random trajs by default')
+    parser.add_argument('--num_train', type=int, default=200)
+    parser.add_argument('--num_test', type=int, default=100)
+    parser.add_argument('--seq_len', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--n_epoch', type=int, default=1)
+    parser.add_argument('--num_inducing_points', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    modes = args.amp
+    if modes is None:
+        modes = ['none', 'bf16', 'fp16'] if torch.cuda.is_available() else ['none', 'bf16']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        traj_path = args.traj_path
+        if traj_path is None:
+            traj_path = os.path.join(tmp_dir, 'pong')
+            make_trajs(traj_path, args.num_train + args.num_test, args.seq_len, args.seed)
+
+        results = {amp: run(amp, traj_path, tmp_dir, args) for amp in modes}
+
+    for amp, (throughput, acc) in results.items():
+        print('{}: {:.2f} trajs/s ({:.2f}x), test accuracy {:.4f}.'.format(
+            amp, throughput, throughput / results[modes[0]][0], acc))
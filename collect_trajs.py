@@ -1,7 +1,7 @@
 import os, sys
 import gym, torch
 import numpy as np
-from atari.utils import rl_fed, NNPolicy, rollout
+from atari.utils import rl_fed, NNPolicy, rollout, rollout_parallel
 
 
 env_name = 'pong'
@@ -14,23 +14,35 @@ agent_path = 'agents/{}/'.format(env_name.lower())
 num_trajs = 1000
 max_ep_len = 200
 
-# Load agent, build environment, and play an episode.
-env = gym.make(env_name)
-model = NNPolicy(channels=1, num_actions=env.action_space.n)
-_ = model.try_load(agent_path, checkpoint='*.tar')
-torch.manual_seed(1)
+# > 1 collects the trajs with rollout_parallel. It saves a TrajStore (states, actions, final_rewards, seeds) instead
+# of the per traj .npz files of rollout, which also hold the observations, values and rewards. Read either layout with
+# src.traj_io.load_batch.
+num_workers = 1
 
-import timeit
-start = timeit.default_timer()
-rollout(model, env_name, num_traj=num_traj, max_ep_len=max_ep_len, save_path='trajs_exp/'+env_name,render=False)
-stop = timeit.default_timer()
-print('Time: ', stop - start)  
+if __name__ == '__main__':
+    # Load agent, build environment, and play an episode.
+    env = gym.make(env_name)
+    model = NNPolicy(channels=1, num_actions=env.action_space.n)
+    _ = model.try_load(agent_path, checkpoint='*.tar')
+    torch.manual_seed(1)
+
+    import timeit
+    start = timeit.default_timer()
+    if num_workers > 1:
+        rollout_parallel(model, env_name, num_traj=num_trajs, max_ep_len=max_ep_len, save_path='trajs_exp/'+env_name,
+                         num_workers=num_workers)
+    else:
+        rollout(model, env_name, num_traj=num_trajs, max_ep_len=max_ep_len, save_path='trajs_exp/'+env_name,render=False)
+    stop = timeit.default_timer()
+    print('Time: ', stop - start)
 
 # Baseline fidelity
+# from src.traj_io import load_batch
 # for i in range(num_trajs):
 #     print(i)
-#     original_traj = np.load('trajs_exp/pong_traj_{}.npz'.format(i))
-#     print(original_traj['final_rewards'])
-#     seed = int(original_traj['seed'])
+#     acts, final_rewards, seeds = load_batch('trajs_exp/'+env_name, [i], ('actions', 'final_rewards', 'seeds'))
+#     original_traj = {'actions': acts[0]}
+#     print(final_rewards[0])
+#     seed = int(seeds[0])
 #     replay_reward_orin = rl_fed(env_name=env_name, k=seed, original_traj=original_traj,
 #                                 max_ep_len=max_ep_len, importance=None, num_step=None, render=False, mask_act=False)
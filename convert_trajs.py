@@ -0,0 +1,10 @@
+from options import get_args
+from src.traj_io import convert_to_store
+
+
+# Convert the collected .npz trajs into the memory-mapped store read by the explainers.
+args = get_args()
+EXP_NAME = 'pong_{}'.format(args.name.split('_')[0])
+traj_path = 'trajs_{}/'.format(args.subname) + EXP_NAME
+
+convert_to_store(traj_path)
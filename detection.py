@@ -114,7 +114,8 @@ WEIGHT_X = True
 step_explainer = DGPStepExp(train_len=train_idx.shape[0], seq_len=200, input_dim=84, hiddens=HIDDENS, input_channels=4,
                             likelihood_type='classification', lr=LR, optimizer_type='adam', n_epoch=N_EPOCHS,
                             gamma=DECAY, num_inducing_points=INDUCE_NUM, encoder_type='CNN', num_class=2,
-                            lambda_1=REG_WEIGHT, weight_x=WEIGHT_X)
+                            lambda_1=REG_WEIGHT, weight_x=WEIGHT_X, embedding_cache_dir=args.embedding_cache_dir,
+                            amp=args.amp)
 
 model_name = 'pretrained_models/{}_{}_step_model.data'.format(args.subname, args.name)
 step_explainer.train(train_idx=train_idx, batch_size=BATCH_SIZE, traj_path=traj_path, save_path=model_name)
@@ -0,0 +1,200 @@
+import random
+import numpy as np
+from PIL import Image
+
+
+# TrojDRL params
+IMG_SIZE_X = 84
+IMG_SIZE_Y = 84
+NR_IMAGES = 4
+ACTION_REPEAT = 4
+MAX_START_WAIT = 30
+FRAMES_IN_POOL = 2
+PIXELS_TO_POISON = 3
+COLOR = 255
+
+
+class FramePool(object):
+
+    def __init__(self, frame_pool, operation):
+        self.frame_pool = frame_pool
+        self.frame_pool_index = 0
+        self.frames_in_pool = frame_pool.shape[0]
+        self.operation = operation
+
+    def new_frame(self, frame):
+        self.frame_pool[self.frame_pool_index] = frame
+        self.frame_pool_index = (self.frame_pool_index + 1) % self.frames_in_pool
+
+    def get_processed_frame(self):
+        return self.operation(self.frame_pool)
+
+
+class ObservationPool(object):
+
+    def __init__(self, observation_pool):
+        self.observation_pool = observation_pool
+        self.pool_size = observation_pool.shape[-1]
+        self.permutation = [self.__shift(list(range(self.pool_size)), i) for i in range(self.pool_size)]
+        self.current_observation_index = 0
+
+    def new_observation(self, observation):
+        self.observation_pool[:, :, self.current_observation_index] = observation
+        self.current_observation_index = (self.current_observation_index + 1) % self.pool_size
+
+    def get_pooled_observations(self):
+        return np.copy(self.observation_pool[:, :, self.permutation[self.current_observation_index]])
+
+    def __shift(self, seq, n):
+        n = n % len(seq)
+        return seq[n:]+seq[:n]
+
+
+class AtariEmulator(object):
+    def __init__(self, env, random_start=True) -> None:
+        self.env = env
+        self.random_start = random_start
+        self.observation_pool = ObservationPool(np.zeros((IMG_SIZE_X, IMG_SIZE_Y, NR_IMAGES), dtype=np.uint8))
+        self.frame_pool = FramePool(np.empty((FRAMES_IN_POOL, self.env.observation_space.shape[0], self.env.observation_space.shape[1]), dtype=np.uint8),
+                                    self.__process_frame_pool)
+
+    def __new_game(self):
+        """ Restart game """
+        self.env.reset()
+        # if self.random_start:
+        #     wait = random.randint(0, MAX_START_WAIT)
+        #     for _ in range(wait):
+        #         self.env.step(0)
+
+    def __process_frame_pool(self, frame_pool):
+        """ Preprocess frame pool """
+
+        img = np.amax(frame_pool, axis=0)
+        img = np.array(Image.fromarray(img).resize((IMG_SIZE_X, IMG_SIZE_Y), resample=Image.NEAREST))
+        img = img.astype(np.uint8)
+
+        return img
+
+    def __action_repeat(self, a, times=ACTION_REPEAT):
+        """ Repeat action and grab screen into frame pool """
+        reward_all = 0
+        for i in range(times - FRAMES_IN_POOL):
+            next_state, reward, done, info = self.env.step(a)
+            reward_all += reward
+        # Only need to add the last FRAMES_IN_POOL frames to the frame pool
+        for i in range(FRAMES_IN_POOL):
+            next_state, reward, done, info = self.env.step(a)
+            reward_all += reward
+            self.frame_pool.new_frame(rgb2gray(next_state))
+
+        return reward_all, done
+
+    def get_initial_state(self):
+        self.__new_game()
+        """ Get the initial state """
+        for step in range(NR_IMAGES):
+            _, done = self.__action_repeat(0)
+            self.observation_pool.new_observation(self.frame_pool.get_processed_frame())
+        if done:
+            raise Exception('This should never happen.')
+        return self.observation_pool.get_pooled_observations()
+
+    def next(self, action):
+        """ Get the next state, reward, and game over signal """
+        reward, done = self.__action_repeat(np.argmax(action))
+        self.observation_pool.new_observation(self.frame_pool.get_processed_frame())
+        observation = self.observation_pool.get_pooled_observations()
+        return observation, reward, done
+
+    def init(self, noops=30):
+        state = self.get_initial_state()
+        if noops != 0:
+            for _ in range(random.randint(0, noops)):
+                state, _, _ = self.next(self.get_noop())
+        return state
+
+    def get_noop(self):
+        return [1.0, 0.0]
+
+    def poison_state(self, state, p, pattern, pixels, color=255):
+        return poison_state(state, p, pattern, pixels, color)[0]
+
+
+def rgb2gray(rgb):
+    r, g, b = rgb[:,:,0], rgb[:,:,1], rgb[:,:,2]
+    gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
+
+    return gray
+
+
+def get_next_actions(policy, state, num_actions):
+    action_probabilities = policy(state).cpu().numpy()
+
+    # subtract a small quantity to ensure probability sum is <= 1
+    action_probabilities = action_probabilities - np.finfo(np.float32).epsneg
+    action_probabilities[action_probabilities<0] = 0
+    # sample 1 action according to probabilities p
+    action_indices = [int(np.nonzero(np.random.multinomial(1, p))[0])
+                        for p in action_probabilities]
+    return np.eye(num_actions)[action_indices]
+
+
+def poison_state(state, p, pattern, pixels, color=255):
+    """
+    Add the trigger to the last frame of a state (w, h, NR_IMAGES) with probability p
+    :param state: state
+    :param p: poisoning probability
+    :param pattern: trigger pattern ['block', 'cross', 'equal']
+    :param pixels: size of the block trigger
+    :param color: trigger color
+    :return: state, whether it is poisoned
+    """
+    poison = random.random() < p
+    if poison:
+        if pattern == 'block':
+            x_start, y_start = 0, 0
+            for i in range(x_start, x_start + pixels):
+                for j in range(y_start, y_start + pixels):
+                    state[i, j, -1] = color
+
+        elif pattern == 'cross':
+            state[0, 0, -1] = color
+            state[0, 3, -1] = color
+            state[1, 1, -1] = color
+            state[1, 2, -1] = color
+            state[2, 1, -1] = color
+            state[2, 2, -1] = color
+            state[3, 0, -1] = color
+            state[3, 3, -1] = color
+
+        elif pattern == 'equal':
+            state[0, 0, -1] = color
+            state[0, 1, -1] = color
+            state[0, 2, -1] = color
+            state[0, 3, -1] = color
+            state[3, 0, -1] = color
+            state[3, 1, -1] = color
+            state[3, 2, -1] = color
+            state[3, 3, -1] = color
+
+    return state, poison
+
+
+def get_trigger_params(subname):
+    """
+    :param subname: poisoning setting ('rand0.1', '3x3', 'cross', ...)
+    :return: poisoning probability, trigger pattern, trigger size
+    """
+    if subname == 'rand0.2': p = 0.2
+    elif subname == 'rand0.3': p = 0.3
+    else: p = 0.1
+
+    if subname == 'cross': pattern = 'cross'
+    elif subname == 'equal': pattern = 'equal'
+    else: pattern = 'block'
+
+    if subname == '4x4': pixels = 4
+    elif subname == '5x5': pixels = 5
+    else: pixels = 3
+
+    return p, pattern, pixels
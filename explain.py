@@ -11,6 +11,7 @@ import argparse
 from src.xfeat import MaskObsModel
 from src.xstep import DGaussianModel, DGPModel
 from src.xstep import DGaussianStepExp, DGPStepExp
+from src.traj_io import load_batch
 from utils import NNPolicy, NNPolicyCritic
 from options import get_args
 import math
@@ -93,7 +94,8 @@ test_idx = np.asarray([a for a in range(9000, 10000)])
 step_explainer = DGPStepExp(train_len=None, seq_len=200, input_dim=84, hiddens=HIDDENS, input_channels=4,
                             likelihood_type='classification', lr=LR, optimizer_type='adam', n_epoch=1,
                             gamma=DECAY, num_inducing_points=INDUCE_NUM, encoder_type='CNN', num_class=2,
-                            lambda_1=REG_WEIGHT, weight_x=WEIGHT_X)
+                            lambda_1=REG_WEIGHT, weight_x=WEIGHT_X, embedding_cache_dir=args.embedding_cache_dir,
+                            amp=args.amp)
 model_path = 'pretrained_models/{}_{}_step_model.data'.format(args.subname, args.name)
 step_explainer.load(model_path)
 
@@ -108,7 +110,7 @@ total = 0
 fail_indices = list(np.where(rewards==0)[0])
 first_trigger = True
 for idx in fail_indices:
-    obs = np.load(traj_path + '_traj_' + str(idx) + '.npz')['states']
+    obs = load_batch(traj_path, [idx], ('states',))[0][0]
     if first_trigger:
         trigger = np.zeros(obs[0].shape, dtype=np.uint64)
         first_trigger = False
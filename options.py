@@ -11,6 +11,9 @@ def get_args():
 
     parser.add_argument('--poisoned_policy', action='store_true', help='evaluate poisoned policy')
     parser.add_argument('--no_poison', action='store_true', help='evaluate in a clean environment')
+    parser.add_argument('--num_envs', type=int, default=1, help='number of emulators stepped in lockstep during evaluation')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'], help='mixed precision mode of the step explainer')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None, help='directory caching the traj embeddings of the step explainer')
     args = parser.parse_args()
 
     return args
@@ -0,0 +1,530 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributions import MultivariateNormal
+from torch.distributions import Categorical
+
+from utils import NNPolicy
+
+
+class AtariPolicy(torch.nn.Module):
+    def __init__(self, model):
+        super(AtariPolicy, self).__init__()
+        self.model = copy.deepcopy(model)
+        self.f = torch.nn.Softmax(dim=-1)
+
+    def forward(self, x):
+        logit = self.model(x)
+        act_prob = self.f(logit)
+        return act_prob
+
+
+################################## PPO Policy ##################################
+
+
+class RolloutBuffer:
+    def __init__(self):
+        self.actions = []
+        self.states = []
+        self.logprobs = []
+        self.rewards = []
+        self.is_terminals = []
+        self.poisoned = []
+
+
+    def add(self, state, action, logprob, poisoned=False):
+        self.states.append(state)
+        self.actions.append(action)
+        self.logprobs.append(logprob)
+        self.poisoned.append(bool(poisoned))
+
+    def add_outcome(self, reward, is_terminal):
+        self.rewards.append(reward)
+        self.is_terminals.append(is_terminal)
+
+    def get(self, device):
+        """
+        :return: states, actions, logprobs (stacked on the device), rewards, is_terminals, poisoned
+        """
+        states = torch.squeeze(torch.stack(self.states, dim=0)).detach().to(device)
+        actions = torch.squeeze(torch.stack(self.actions, dim=0)).detach().to(device)
+        logprobs = torch.squeeze(torch.stack(self.logprobs, dim=0)).detach().to(device)
+        return states, actions, logprobs, self.rewards, self.is_terminals, self.poisoned
+
+    def clear(self):
+        del self.actions[:]
+        del self.states[:]
+        del self.logprobs[:]
+        del self.rewards[:]
+        del self.is_terminals[:]
+        del self.poisoned[:]
+
+
+class TensorRolloutBuffer(object):
+    def __init__(self, capacity, state_shape, device=torch.device('cpu')):
+        """
+        Fixed capacity buffer of a discrete policy, written by index. States (raw frames) are kept as uint8 and the
+        other fields as typed arrays, the rewards and terminals on the host since they come from the emulator
+        :param capacity: number of steps between two updates
+        :param state_shape: shape of one state, e.g. (4, 84, 84)
+        :param device: device of the states, actions and logprobs
+        """
+        self.capacity = capacity
+        self.states = torch.zeros((capacity, *state_shape), dtype=torch.uint8, device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.int64, device=device)
+        self.logprobs = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.is_terminals = np.zeros(capacity, dtype=bool)
+        self.poisoned = np.zeros(capacity, dtype=bool)
+        self.size = 0
+        self.num_outcomes = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state, action, logprob, poisoned=False):
+        if self.size == self.capacity:
+            raise ValueError('The rollout buffer is full, update the policy before adding more steps.')
+        self.states[self.size] = state.reshape(self.states.shape[1:])
+        self.actions[self.size:self.size + 1] = action.reshape(1)
+        self.logprobs[self.size:self.size + 1] = logprob.reshape(1)
+        self.poisoned[self.size] = bool(poisoned)
+        self.size += 1
+
+    def add_outcome(self, reward, is_terminal):
+        if self.num_outcomes == self.capacity:
+            raise ValueError('The rollout buffer is full, update the policy before adding more outcomes.')
+        self.rewards[self.num_outcomes] = reward
+        self.is_terminals[self.num_outcomes] = is_terminal
+        self.num_outcomes += 1
+
+    def get(self, device):
+        """
+        :return: states (uint8, converted to float by the consumer one minibatch at a time), actions, logprobs,
+                 rewards, is_terminals, poisoned of the stored steps
+        """
+        return (self.states[:self.size].to(device), self.actions[:self.size].to(device),
+                self.logprobs[:self.size].to(device), self.rewards[:self.num_outcomes],
+                self.is_terminals[:self.num_outcomes], self.poisoned[:self.size])
+
+    def clear(self):
+        self.size = 0
+        self.num_outcomes = 0
+
+
+class ActorCritic(nn.Module):
+    def __init__(self, state_dim, action_dim, has_continuous_action_space, action_std_init, policy_model=None,
+                 poisoned_policy=None, pretrained_path=None, device=torch.device('cpu'), shared_trunk=False):
+        """
+        :param policy_model: policy network copied into the (discrete) actor
+        :param poisoned_policy: frozen poisoned policy, evaluated on the unmasked states
+        :param pretrained_path: policy checkpoint loaded into the actor and the critic, None trains from scratch
+        :param device: device of the action std
+        :param shared_trunk: the critic is a value head on the conv trunk of the actor (discrete actions only), so
+                             that a state goes through a single conv stack. The actor keeps the NNPolicy layout
+        """
+        super(ActorCritic, self).__init__()
+
+        if shared_trunk and has_continuous_action_space:
+            raise ValueError('The shared trunk is only supported with discrete actions.')
+
+        self.has_continuous_action_space = has_continuous_action_space
+        self.shared_trunk = shared_trunk
+        self.poisoned_policy = [poisoned_policy]  # not registered as a submodule, it is neither trained nor saved.
+        self.device = device
+
+        if has_continuous_action_space:
+            self.action_dim = action_dim
+            self.action_var = torch.full((action_dim,), action_std_init * action_std_init).to(device)
+
+        # actor
+        if has_continuous_action_space :
+            self.actor = nn.Sequential(
+                            nn.Linear(state_dim, 64),
+                            nn.Tanh(),
+                            nn.Linear(64, 64),
+                            nn.Tanh(),
+                            nn.Linear(64, action_dim),
+                            nn.Tanh()
+                        )
+        else:
+            self.actor = AtariPolicy(model=policy_model)
+            if pretrained_path is not None:
+                print('loaded pretrained policy')
+                self.actor.model.load_state_dict(torch.load(pretrained_path))
+
+        # critic
+        if shared_trunk:
+            self.critic = nn.Linear(in_features=256, out_features=1)
+        else:
+            self.critic = NNPolicy(channels=4, num_actions=action_dim)
+            if pretrained_path is not None:
+                print('loaded pretrained policy')
+                self.critic.load_state_dict(torch.load(pretrained_path))
+            self.critic.fc4 = nn.Linear(in_features=256, out_features=1)
+
+    def set_action_std(self, new_action_std):
+
+        if self.has_continuous_action_space:
+            self.action_var = torch.full((self.action_dim,), new_action_std * new_action_std).to(self.device)
+        else:
+            print("--------------------------------------------------------------------------------------------")
+            print("WARNING : Calling ActorCritic::set_action_std() on discrete action space policy")
+            print("--------------------------------------------------------------------------------------------")
+
+
+    def forward(self):
+        raise NotImplementedError
+
+
+    def act(self, state):
+
+        if self.has_continuous_action_space:
+            action_mean = self.actor(state)
+            cov_mat = torch.diag(self.action_var).unsqueeze(dim=0)
+            dist = MultivariateNormal(action_mean, cov_mat)
+        else:
+            action_probs = self.actor(state)
+            dist = Categorical(action_probs)
+
+        action = dist.sample()
+        action_logprob = dist.log_prob(action)
+
+        return action.detach(), action_logprob.detach()
+
+
+    def poisoned_probs(self, state, chunk_size=1024):
+        """
+        Action distribution of the frozen poisoned policy, computed without gradient in chunks of states
+        :param state: unmasked states, raw frames are converted to float one chunk at a time
+        :param chunk_size: number of states per forward
+        """
+        with torch.no_grad():
+            return torch.cat([self.poisoned_policy[0](state[start:start + chunk_size].float())
+                              for start in range(0, state.shape[0], chunk_size)])
+
+
+    def value(self, state):
+        if self.shared_trunk:
+            return self.critic(self.actor.model.features(state))
+        return self.critic(state)
+
+
+    def evaluate(self, state, action):
+
+        if self.has_continuous_action_space:
+            action_mean = self.actor(state)
+            action_var = self.action_var.expand_as(action_mean)
+            cov_mat = torch.diag_embed(action_var).to(self.device)
+            dist = MultivariateNormal(action_mean, cov_mat)
+
+            # for single action continuous environments
+            if self.action_dim == 1:
+                action = action.reshape(-1, self.action_dim)
+
+        elif self.shared_trunk:
+            features = self.actor.model.features(state)
+            action_probs = self.actor.f(self.actor.model.fc4(features))
+            dist = Categorical(action_probs)
+
+        else:
+            action_probs = self.actor(state)
+            dist = Categorical(action_probs)
+
+        action_logprobs = dist.log_prob(action)
+        dist_entropy = dist.entropy()
+        state_values = self.critic(features) if self.shared_trunk else self.critic(state)
+
+        return action_logprobs, state_values, dist_entropy, action_probs + 1e-9
+
+
+def reverse_discount(x, coefs):
+    """
+    Solve y[t] = x[t] + coefs[t] * y[t + 1] (with y[n] = 0) for all t at once, by a log-depth scan over the doubling
+    offsets instead of a python loop over the steps
+    :param x: (n, ) tensor
+    :param coefs: (n, ) tensor of discounts, 0 where an episode ends
+    :return: (n, ) tensor y
+    """
+    y, a = x.clone(), coefs.clone()
+    offset = 1
+    while offset < y.shape[0]:
+        y[:-offset] = y[:-offset] + a[:-offset] * y[offset:]
+        a[:-offset] = a[:-offset] * a[offset:]
+        a[-offset:] = 0
+        offset *= 2
+    return y
+
+
+def discounted_returns(rewards, is_terminals, gamma):
+    """
+    Monte Carlo returns, reset at the end of every episode
+    :param rewards: (n, ) tensor
+    :param is_terminals: (n, ) bool tensor, whether the episode ends at the step
+    :param gamma: discount factor
+    :return: (n, ) tensor of returns
+    """
+    return reverse_discount(rewards, gamma * (~is_terminals).to(rewards.dtype))
+
+
+def gae_advantages(rewards, values, is_terminals, gamma, gae_lambda):
+    """
+    GAE(lambda) advantages, the value after the last stored step is taken as 0 as in the Monte Carlo returns
+    :param rewards: (n, ) tensor
+    :param values: (n, ) tensor of critic values
+    :param is_terminals: (n, ) bool tensor, whether the episode ends at the step
+    :param gamma: discount factor
+    :param gae_lambda: GAE lambda
+    :return: (n, ) tensor of advantages
+    """
+    not_terminals = (~is_terminals).to(rewards.dtype)
+    next_values = torch.cat([values[1:], values.new_zeros(1)])
+    deltas = rewards + gamma * not_terminals * next_values - values
+    return reverse_discount(deltas, gamma * gae_lambda * not_terminals)
+
+
+class PPO:
+    def __init__(self, state_dim, action_dim, lr_actor, lr_critic, gamma, K_epochs, eps_clip, has_continuous_action_space, action_std_init=0.6,
+                 policy_model=None, poisoned_policy=None, pretrained_path=None, kl_regularize=False,
+                 device=torch.device('cpu'), buffer_size=None, state_shape=(4, 84, 84), state_transform=None,
+                 gae_lambda=None, minibatch_size=None, target_kl=None, kl_per_step=False, shared_trunk=False):
+        """
+        :param policy_model: policy network copied into the actors
+        :param poisoned_policy: frozen poisoned policy
+        :param pretrained_path: policy checkpoint the actor and the critic start from, None trains from scratch
+        :param kl_regularize: regularize the KL to the poisoned policy on clean states ('ours' and 'nc' modes)
+        :param device: training device
+        :param buffer_size: steps between two updates, preallocates a TensorRolloutBuffer (discrete actions only),
+                            None keeps the list buffer
+        :param state_shape: shape of one state of the preallocated buffer
+        :param state_transform: applied to the stored states before the policy, e.g. masking out the trigger,
+                                so that the buffer keeps the raw uint8 frames
+        :param gae_lambda: use GAE(lambda) advantages from the critic, None keeps the normalized Monte Carlo returns
+        :param minibatch_size: split every epoch into shuffled minibatches of this size, None takes the full batch
+        :param target_kl: stop the update early once the approximate KL to the old policy exceeds 1.5 * target_kl
+        :param kl_per_step: regularize the KL to the poisoned policy on every clean stored step, instead of on the
+                            last state of the rollout when it is clean
+        :param shared_trunk: share the conv trunk of the actor with the critic (see ActorCritic)
+        """
+
+        self.has_continuous_action_space = has_continuous_action_space
+
+        if has_continuous_action_space:
+            self.action_std = action_std_init
+
+        self.gamma = gamma
+        self.gae_lambda = gae_lambda
+        self.eps_clip = eps_clip
+        self.K_epochs = K_epochs
+        self.minibatch_size = minibatch_size
+        self.target_kl = target_kl
+        self.kl_regularize = kl_regularize
+        self.kl_per_step = kl_per_step
+        self.device = device
+        self.state_transform = state_transform
+
+        if buffer_size is not None and not has_continuous_action_space:
+            self.buffer = TensorRolloutBuffer(buffer_size, state_shape, device)
+        else:
+            self.buffer = RolloutBuffer()
+
+        self.policy = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init, policy_model,
+                                  poisoned_policy, pretrained_path, device, shared_trunk).to(device)
+        self.optimizer = torch.optim.Adam([
+                        {'params': self.policy.actor.parameters(), 'lr': lr_actor},
+                        {'params': self.policy.critic.parameters(), 'lr': lr_critic}
+                    ])
+
+        self.policy_old = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init, policy_model,
+                                      poisoned_policy, pretrained_path, device, shared_trunk).to(device)
+        self.policy_old.load_state_dict(self.policy.state_dict())
+
+        self.MseLoss = nn.MSELoss()
+        self.KLDivLoss = nn.KLDivLoss(reduction='mean')
+
+
+    def set_action_std(self, new_action_std):
+
+        if self.has_continuous_action_space:
+            self.action_std = new_action_std
+            self.policy.set_action_std(new_action_std)
+            self.policy_old.set_action_std(new_action_std)
+
+        else:
+            print("--------------------------------------------------------------------------------------------")
+            print("WARNING : Calling PPO::set_action_std() on discrete action space policy")
+            print("--------------------------------------------------------------------------------------------")
+
+
+    def decay_action_std(self, action_std_decay_rate, min_action_std):
+        print("--------------------------------------------------------------------------------------------")
+
+        if self.has_continuous_action_space:
+            self.action_std = self.action_std - action_std_decay_rate
+            self.action_std = round(self.action_std, 4)
+            if (self.action_std <= min_action_std):
+                self.action_std = min_action_std
+                print("setting actor output action_std to min_action_std : ", self.action_std)
+            else:
+                print("setting actor output action_std to : ", self.action_std)
+            self.set_action_std(self.action_std)
+
+        else:
+            print("WARNING : Calling PPO::decay_action_std() on discrete action space policy")
+
+        print("--------------------------------------------------------------------------------------------")
+
+
+    def select_action(self, state, poisoned=False):
+
+        if self.has_continuous_action_space:
+            with torch.no_grad():
+                state = torch.FloatTensor(state).to(self.device)
+                action, action_logprob = self.policy_old.act(state)
+
+            self.buffer.add(state, action, action_logprob)
+
+            return action.detach().cpu().numpy().flatten()
+
+        else:
+            with torch.no_grad():
+                action, action_logprob = self.policy_old.act(self.transform(state))
+
+            self.buffer.add(state, action, action_logprob, poisoned)
+
+            return action.item()
+
+
+    def transform(self, state):
+        if self.state_transform is None:
+            return state
+        return self.state_transform(state)
+
+
+    def prepare(self, state):
+        """
+        Input of the policy from buffer states, raw uint8 frames are converted to float
+        """
+        return self.transform(state.float())
+
+
+    def state_values(self, states, chunk_size=1024):
+        """
+        Values of the critic, computed without gradient in chunks of buffer states
+        """
+        with torch.no_grad():
+            return torch.cat([self.policy.value(self.prepare(states[start:start + chunk_size])).reshape(-1)
+                              for start in range(0, states.shape[0], chunk_size)])
+
+
+    def update(self, poisoned, state_old):
+
+        old_states, old_actions, old_logprobs, buffer_rewards, buffer_is_terminals, buffer_poisoned = \
+            self.buffer.get(self.device)
+
+        # The poisoned policy is frozen, its action distribution is computed once per update (on the unmasked states).
+        probs_poisoned_policy, kl_weights = None, None
+        if self.kl_regularize and self.kl_per_step:
+            probs_poisoned_policy = self.policy.poisoned_probs(old_states)
+            kl_weights = torch.as_tensor(~np.asarray(buffer_poisoned, dtype=bool), device=self.device).float()
+        elif self.kl_regularize and not poisoned:
+            probs_poisoned_policy = self.policy.poisoned_probs(state_old)
+
+        # the buffer states stay raw, they are converted and transformed one minibatch (or chunk) at a time.
+        buffer_rewards = torch.as_tensor(np.asarray(buffer_rewards, dtype=np.float32), device=self.device)
+        buffer_is_terminals = torch.as_tensor(np.asarray(buffer_is_terminals, dtype=bool), device=self.device)
+
+        if self.gae_lambda is None:
+            # Monte Carlo estimate of returns, normalized
+            rewards = discounted_returns(buffer_rewards, buffer_is_terminals, self.gamma)
+            rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
+            gae = None
+        else:
+            # GAE advantages (normalized) from the critic before the update, the critic regresses on the returns
+            values = self.state_values(old_states)
+            gae = gae_advantages(buffer_rewards, values, buffer_is_terminals, self.gamma, self.gae_lambda)
+            rewards = gae + values
+            gae = (gae - gae.mean()) / (gae.std() + 1e-7)
+
+        # Optimize policy for K epochs
+        num_steps = old_states.shape[0]
+        minibatch_size = num_steps if self.minibatch_size is None else self.minibatch_size
+        stop = False
+        for _ in range(self.K_epochs):
+            # the full batch is sliced rather than gathered, so that it is not copied every epoch
+            order = None if self.minibatch_size is None else torch.randperm(num_steps, device=self.device)
+
+            for start in range(0, num_steps, minibatch_size):
+                if order is None:
+                    idx = slice(start, start + minibatch_size)
+                else:
+                    idx = order[start:start + minibatch_size]
+
+                # Evaluating old actions and values
+                logprobs, state_values, dist_entropy, probs = self.policy.evaluate(self.prepare(old_states[idx]), old_actions[idx])
+
+                # match state_values tensor dimensions with rewards tensor
+                state_values = state_values.reshape(-1)
+
+                # Finding the ratio (pi_theta / pi_theta__old)
+                log_ratios = logprobs - old_logprobs[idx].detach()
+                ratios = torch.exp(log_ratios)
+
+                if self.target_kl is not None:
+                    with torch.no_grad():
+                        approx_kl = ((ratios - 1) - log_ratios).mean().item()
+                    if approx_kl > 1.5 * self.target_kl:
+                        print('Early stopping the PPO update at KL {:.4f}.'.format(approx_kl))
+                        stop = True
+                        break
+
+                # Finding Surrogate Loss
+                advantages = rewards[idx] - state_values.detach() if gae is None else gae[idx]
+                surr1 = ratios * advantages
+                surr2 = torch.clamp(ratios, 1-self.eps_clip, 1+self.eps_clip) * advantages
+
+                # final loss of clipped objective PPO
+                if kl_weights is not None:
+                    # Finding KL between retrained and poisoned policy, averaged over the clean steps
+                    kld = F.kl_div(torch.log(probs), probs_poisoned_policy[idx], reduction='none')
+                    kld = (kld * kl_weights[idx, None]).sum() / (kl_weights[idx].sum().clamp(min=1) * kld.shape[1])
+                    loss = -torch.min(surr1, surr2) + 0.5*self.MseLoss(state_values, rewards[idx]) - 0.01*dist_entropy + 0.01*kld
+                elif probs_poisoned_policy is not None:
+                    # Finding KL between retrained and poisoned policy
+                    kld = self.KLDivLoss(torch.log(probs), probs_poisoned_policy)
+                    loss = -torch.min(surr1, surr2) + 0.5*self.MseLoss(state_values, rewards[idx]) - 0.01*dist_entropy + 0.01*kld
+                else:
+                    loss = -torch.min(surr1, surr2) + 0.5*self.MseLoss(state_values, rewards[idx]) - 0.01*dist_entropy
+
+                # take gradient step
+                self.optimizer.zero_grad()
+                loss.mean().backward()
+                self.optimizer.step()
+
+            if stop:
+                break
+
+        # Copy new weights into old policy
+        self.policy_old.load_state_dict(self.policy.state_dict())
+
+        # clear buffer
+        self.buffer.clear()
+
+
+    def save(self, checkpoint_path):
+        torch.save(self.policy_old.state_dict(), checkpoint_path)
+
+
+    def load(self, checkpoint_path):
+        self.policy_old.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+        self.policy.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+
+
+    def save_policy(self, policy_path):
+        """
+        Save the actor as a NNPolicy state dict (the POLICY_SAVE_PATH format read by eval.py), with or without a
+        shared trunk
+        """
+        torch.save(self.policy.actor.model.state_dict(), policy_path)
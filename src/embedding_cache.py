@@ -0,0 +1,108 @@
+import os
+import hashlib
+import numpy as np
+from src.traj_io import num_traj_file
+
+
+def encoder_hash(encoder):
+    """
+    :param encoder: traj encoder
+    :return: hash of the encoder parameters and buffers, changes with the checkpoint
+    """
+    digest = hashlib.sha1()
+    for name, value in sorted(encoder.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(value.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def parameter_version(encoder):
+    """
+    :param encoder: traj encoder
+    :return: key changing whenever a parameter or buffer of the encoder is replaced or modified in place (optimizer
+             step, load_state_dict), cheap to compute compared to encoder_hash
+    """
+    return tuple((name, value.data_ptr(), value._version) for name, value in encoder.state_dict().items())
+
+
+def cache_key(encoder_key, amp_dtype=None):
+    """
+    :param encoder_key: encoder_hash of the encoder
+    :param amp_dtype: low precision dtype the encoder runs under, None for float32
+    :return: name of the cache directory, the embeddings computed under autocast differ from the float32 ones
+    """
+    if amp_dtype is None:
+        return encoder_key
+    return encoder_key + '_' + str(amp_dtype).replace('torch.', '')
+
+
+class EmbeddingCache(object):
+    def __init__(self, cache_dir, key):
+        """
+        On-disk cache of the encoder outputs, one .npz file per traj under a directory named after the checkpoint.
+        The _num_traj.npy metadata of a traj path is read once per instance, get_embedding_cache builds one per pass
+        :param cache_dir: cache directory
+        :param key: key of the frozen traj encoder and its precision, see cache_key
+        """
+        self.cache_dir = os.path.join(cache_dir, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.traj_keys = {}
+
+    def traj_key(self, traj_path):
+        """
+        :param traj_path: traj path prefix
+        :return: hash of the absolute traj path and of the number of trajs and mtime of its _num_traj.npy metadata
+                 (as in TrajStore.source), the entries of trajs collected again are then missed
+        """
+        if traj_path not in self.traj_keys:
+            digest = hashlib.sha1(os.path.abspath(traj_path).encode())
+            if os.path.exists(num_traj_file(traj_path)):
+                digest.update(str(int(np.load(num_traj_file(traj_path)))).encode())
+                digest.update(repr(os.path.getmtime(num_traj_file(traj_path))).encode())
+            self.traj_keys[traj_path] = digest.hexdigest()
+        return self.traj_keys[traj_path]
+
+    def cache_file(self, traj_path, idx):
+        """
+        :param traj_path: traj path prefix
+        :param idx: traj index
+        :return: the .npz file holding the embeddings of the traj
+        """
+        return os.path.join(self.cache_dir, self.traj_key(traj_path) + '_embed_' + str(int(idx)) + '.npz')
+
+    def contains(self, traj_path, traj_idx):
+        """
+        :param traj_path: traj path prefix
+        :param traj_idx: traj indexes
+        :return: whether the embeddings of all the trajs are cached
+        """
+        return all(os.path.exists(self.cache_file(traj_path, idx)) for idx in traj_idx)
+
+    def load(self, traj_path, batch_idx):
+        """
+        :param traj_path: traj path prefix
+        :param batch_idx: traj indexes of the batch
+        :return: step embeddings (N, T, D), traj embeddings (N, D)
+        """
+        step_embed, traj_embed = [], []
+        for idx in batch_idx:
+            with np.load(self.cache_file(traj_path, idx)) as embed:
+                step_embed.append(embed['step_embed'])
+                traj_embed.append(embed['traj_embed'])
+        return np.array(step_embed), np.array(traj_embed)
+
+    def save(self, traj_path, batch_idx, step_embed, traj_embed):
+        """
+        :param traj_path: traj path prefix
+        :param batch_idx: traj indexes of the batch
+        :param step_embed: step embeddings (N, T, D)
+        :param traj_embed: traj embeddings (N, D)
+        """
+        step_embed = step_embed.detach().cpu().numpy()
+        traj_embed = traj_embed.detach().cpu().numpy()
+        for i, idx in enumerate(batch_idx):
+            # write to a temporary file first, so that an interrupted save never leaves a truncated cache entry.
+            cache_file = self.cache_file(traj_path, idx)
+            tmp_file = cache_file[:-len('.npz')] + '.tmp.' + str(os.getpid()) + '.npz'
+            np.savez(tmp_file, step_embed=step_embed[i], traj_embed=traj_embed[i])
+            os.replace(tmp_file, cache_file)
@@ -0,0 +1,265 @@
+import os
+import json
+import torch
+import numpy as np
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
+
+# Columns of the memory-mapped store and the .npz key each of them is converted from.
+STORE_FIELDS = {'states': 'states', 'actions': 'actions', 'final_rewards': 'final_rewards', 'seeds': 'seed'}
+
+_stores = {}
+
+
+def traj_file(traj_path, idx):
+    """
+    :param traj_path: traj path prefix
+    :param idx: traj index
+    :return: the .npz file of the traj
+    """
+    return traj_path + '_traj_' + str(idx) + '.npz'
+
+
+def store_file(traj_path, field):
+    """
+    :param traj_path: traj path prefix
+    :param field: store column
+    :return: the raw file backing the column
+    """
+    return traj_path + '_store_' + field + '.dat'
+
+
+def store_meta_file(traj_path):
+    """
+    :param traj_path: traj path prefix
+    :return: the metadata (number of trajs, shape and dtype of every column) of the store
+    """
+    return traj_path + '_store.json'
+
+
+def num_traj_file(traj_path):
+    """
+    :param traj_path: traj path prefix
+    :return: the number of trajs saved by the collection
+    """
+    return traj_path + '_num_traj.npy'
+
+
+class TrajStore(object):
+    def __init__(self, traj_path, mode='c'):
+        """
+        Columnar store of all the trajs under a traj path, every column is a np.memmap of shape (num_traj, ...)
+        :param traj_path: traj path prefix
+        :param mode: np.memmap mode, the default copy-on-write mode never modifies the files
+        """
+        with open(store_meta_file(traj_path)) as f:
+            meta = json.load(f)
+        self.traj_path = traj_path
+        self.num_traj = meta['num_traj']
+        self.source = meta.get('source')
+        self.columns = {}
+        for field, spec in meta['fields'].items():
+            self.columns[field] = np.memmap(store_file(traj_path, field), dtype=spec['dtype'], mode=mode,
+                                            shape=(self.num_traj, *spec['shape']))
+
+    @staticmethod
+    def exists(traj_path):
+        return os.path.exists(store_meta_file(traj_path))
+
+    def is_stale(self):
+        """
+        :return: whether the .npz trajs the store was converted from have been collected again since
+        """
+        if self.source is None or not os.path.exists(num_traj_file(self.traj_path)):
+            return False
+        mtime = os.path.getmtime(num_traj_file(self.traj_path))
+        if mtime == self.source['mtime']:
+            return False
+        return mtime > self.source['mtime'] or int(np.load(num_traj_file(self.traj_path))) != self.source['num_traj']
+
+    @classmethod
+    def create(cls, traj_path, num_traj, specs, source=None):
+        """
+        Allocate an empty store
+        :param traj_path: traj path prefix
+        :param num_traj: number of trajs
+        :param specs: {field: (per traj shape, dtype)}
+        :param source: {'num_traj', 'mtime'} of the _num_traj.npy metadata the store is converted from, checked by
+                       is_stale, None when the store is the only copy of the trajs
+        :return: the store, opened for writing
+        """
+        meta = {'num_traj': int(num_traj), 'fields': {}, 'source': source}
+        for field, (shape, dtype) in specs.items():
+            meta['fields'][field] = {'shape': [int(dim) for dim in shape], 'dtype': np.dtype(dtype).str}
+            np.memmap(store_file(traj_path, field), dtype=dtype, mode='w+', shape=(num_traj, *shape)).flush()
+        with open(store_meta_file(traj_path), 'w') as f:
+            json.dump(meta, f)
+        _stores.pop(traj_path, None)
+        return cls(traj_path, mode='r+')
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __len__(self):
+        return self.num_traj
+
+    def get_batch(self, batch_idx, fields):
+        """
+        :param batch_idx: traj indexes of the batch
+        :param fields: store columns to read
+        :return: one array per field, a view of the store when batch_idx is a contiguous range
+        """
+        batch_idx = np.asarray(batch_idx)
+        if batch_idx.shape[0] > 0 and np.all(np.diff(batch_idx) == 1):
+            batch_idx = slice(int(batch_idx[0]), int(batch_idx[-1]) + 1)
+        return tuple(self.columns[field][batch_idx] for field in fields)
+
+    def write(self, idx, **arrays):
+        """
+        :param idx: traj index
+        :param arrays: {field: value of the traj}
+        """
+        for field, value in arrays.items():
+            self.columns[field][idx] = value
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+
+
+def open_store(traj_path):
+    """
+    :param traj_path: traj path prefix
+    :return: the (cached) store of the traj path, None if it has not been converted or is stale. The cached store is
+             checked on every call (a stat), the trajs may be collected again while the process runs
+    """
+    if traj_path not in _stores:
+        if not TrajStore.exists(traj_path):
+            return None
+        _stores[traj_path] = TrajStore(traj_path)
+    if _stores[traj_path].is_stale():
+        print('The store of {} is older than its trajs, reading the .npz files. '
+              'Run convert_to_store again.'.format(traj_path))
+        del _stores[traj_path]
+        return None
+    return _stores[traj_path]
+
+
+def convert_to_store(traj_path, num_traj=None):
+    """
+    Convert the per traj .npz files into a memory-mapped store. Integer states (pixels) are stored as uint8 and
+    checked to fit, other states keep their dtype
+    :param traj_path: traj path prefix
+    :param num_traj: number of trajs, read from the _num_traj.npy metadata by default
+    :return: the store
+    """
+    source = None
+    if os.path.exists(num_traj_file(traj_path)):
+        source = {'num_traj': int(np.load(num_traj_file(traj_path))),
+                  'mtime': os.path.getmtime(num_traj_file(traj_path))}
+    if num_traj is None:
+        num_traj = int(np.load(num_traj_file(traj_path)))
+
+    first = load_traj(traj_path, 0, STORE_FIELDS.values())
+    specs = {field: (value.shape, value.dtype) for field, value in zip(STORE_FIELDS, first)}
+    pixels = specs['states'][1].kind in 'iu'
+    if pixels:
+        specs['states'] = (specs['states'][0], np.uint8)
+    store = TrajStore.create(traj_path, num_traj, specs, source)
+
+    for idx in range(num_traj):
+        if idx % 1000 == 0:
+            print('Converting traj %d out of %d.' % (idx, num_traj))
+        arrays = dict(zip(STORE_FIELDS, load_traj(traj_path, idx, STORE_FIELDS.values())))
+        if pixels and arrays['states'].size > 0 and (arrays['states'].min() < 0 or arrays['states'].max() > 255):
+            raise ValueError('The states of traj {} do not fit in uint8.'.format(idx))
+        store.write(idx, **arrays)
+    store.flush()
+
+    _stores.pop(traj_path, None)
+    return open_store(traj_path)
+
+
+def load_traj(traj_path, idx, fields=('states', 'final_rewards')):
+    """
+    Load several fields of one traj with a single open of its .npz file
+    :param traj_path: traj path prefix
+    :param idx: traj index
+    :param fields: names of the arrays to load
+    :return: one array per field, in the order of fields
+    """
+    with np.load(traj_file(traj_path, idx)) as traj:
+        return tuple(traj[field] for field in fields)
+
+
+def load_batch(traj_path, batch_idx, fields=('states', 'final_rewards')):
+    """
+    Load several fields of a batch of trajs. Slice them from the store when the traj path has been converted,
+    otherwise every .npz file is opened only once
+    :param traj_path: traj path prefix
+    :param batch_idx: traj indexes of the batch
+    :param fields: names of the arrays to load, the store columns are read from their .npz key (e.g. seeds from seed)
+    :return: one array per field, stacked along the first (traj) dimension
+    """
+    store = open_store(traj_path)
+    if store is not None and all(field in store.columns for field in fields):
+        return store.get_batch(batch_idx, fields)
+
+    npz_fields = [STORE_FIELDS.get(field, field) for field in fields]
+    columns = tuple([] for _ in fields)
+    for idx in batch_idx:
+        for column, value in zip(columns, load_traj(traj_path, idx, npz_fields)):
+            column.append(value)
+    return tuple(np.array(column) for column in columns)
+
+
+def traj_lengths(actions):
+    """
+    :param actions: actions of a batch of left padded trajs (N, T), shifted by one so that 0 marks the padding
+    :return: number of real time steps of each traj (N, )
+    """
+    return (actions != 0).sum(-1)
+
+
+class TrajDataset(Dataset):
+    def __init__(self, traj_path, traj_idx, fields=('states', 'final_rewards')):
+        """
+        Dataset of traj batches, indexed by a list of positions in traj_idx (see make_traj_loader)
+        :param traj_path: traj path prefix
+        :param traj_idx: traj indexes
+        :param fields: names of the arrays to load
+        """
+        self.traj_path = traj_path
+        self.traj_idx = np.asarray(traj_idx)
+        self.fields = tuple(fields)
+
+    def __len__(self):
+        return self.traj_idx.shape[0]
+
+    def __getitem__(self, batch_pos):
+        return load_batch(self.traj_path, self.traj_idx[batch_pos], self.fields)
+
+
+def make_traj_loader(traj_path, traj_idx, batch_size, fields=('states', 'final_rewards'), drop_last=False,
+                     num_workers=0, pin_memory=False, prefetch_factor=2, persistent_workers=False):
+    """
+    Build a loader yielding the same batches, in the same order, as slicing traj_idx every batch_size trajs.
+    Whole batches are assembled by the workers, so that loading batch k+1 overlaps the computation on batch k
+    :param traj_path: traj path prefix
+    :param traj_idx: traj indexes
+    :param batch_size: batch size
+    :param fields: names of the arrays to load
+    :param drop_last: drop the last incomplete batch
+    :param num_workers: number of loading processes, 0 loads in the main process
+    :param pin_memory: put the batches into pinned memory, only used with cuda
+    :param prefetch_factor: number of batches loaded in advance by each worker
+    :param persistent_workers: keep the workers alive across the passes over the loader, only worth it when the
+                               same loader is iterated several times (epochs)
+    :return: loader yielding one tensor per field
+    """
+    dataset = TrajDataset(traj_path, traj_idx, fields)
+    sampler = BatchSampler(SequentialSampler(dataset), batch_size, drop_last)
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers}
+    return DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=num_workers,
+                      pin_memory=pin_memory and torch.cuda.is_available(), **worker_kwargs)
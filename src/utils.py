@@ -16,7 +16,32 @@ from gpytorch.variational._variational_strategy import _VariationalStrategy
 from gpytorch.variational.variational_strategy import _ensure_updated_strategy_flag_set
 from gpytorch.utils.memoize import cached, clear_cache_hook, pop_from_cache_ignore_args
 from gpytorch.lazy import DiagLazyTensor, MatmulLazyTensor, RootLazyTensor, SumLazyTensor, TriangularLazyTensor, \
-    delazify
+    BlockDiagLazyTensor, delazify
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_amp_dtype(amp):
+    """
+    :param amp: mixed precision mode (None, 'bf16' or 'fp16')
+    :return: the low precision dtype of the mode, None for full precision
+    """
+    if amp is None or amp == 'none':
+        return None
+    if amp not in AMP_DTYPES:
+        raise ValueError('Unknown mixed precision mode {}, should be one of none, bf16, fp16.'.format(amp))
+    if amp == 'fp16' and not torch.cuda.is_available():
+        raise ValueError('fp16 mixed precision requires cuda, use bf16 on cpu.')
+    return AMP_DTYPES[amp]
+
+
+def autocast(device, amp_dtype):
+    """
+    :param device: device of the inputs
+    :param amp_dtype: low precision dtype, None disables autocast
+    :return: autocast context
+    """
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
 
 
 class CnnRnnEncoder(nn.Module):
@@ -66,24 +91,34 @@ class CnnRnnEncoder(nn.Module):
             self.rnn_cell_type = 'GRU'
 
         self.traj_embed_layer = nn.Linear(hidden_dim, hidden_dim)
+        # Low precision dtype of the CNN (None: float32), the RNN always runs in float32.
+        self.amp_dtype = None
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         """
         Forward function: given an input, return the model output (output at each time and the final time step)
-        :param x: input observations (Batch_size, seq_len, input_channels, input_dim, input_dim)
+        :param x: input observations (Batch_size, seq_len, input_channels, input_dim, input_dim), uint8 observations
+                  are converted to float here, i.e., after they have been copied to the device
+        :param lengths: number of real (not padded) time steps of each traj (batch_size, ), the trajs being left
+                        padded. If given, the padded time steps are skipped (see forward_packed)
         :return step_embed: the latent representation of each time step (batch_size, seq_len, hidden_dim)
                 traj_embed: the representation of the traj (batch_size, hidden_dim)
         """
 
+        if lengths is not None:
+            return self.forward_packed(x, lengths)
+
         num_traj = x.shape[0]
+        x = x.float()
 
         if self.normalize:
             mean = torch.mean(x, dim=(0, 1))[None, None, :]
             std = torch.std(x, dim=(0, 1))[None, None, :]
             x = (x - mean) / std
         x = x.view(-1, self.input_channels, self.input_dim, self.input_dim)
-        obs_encoded = self.cnn_encoder(x)  # (N*T, D1) get the hidden representation of every time step.
-        obs_encoded = obs_encoded.view(num_traj, self.seq_len, obs_encoded.shape[-1])
+        with autocast(x.device, self.amp_dtype):
+            obs_encoded = self.cnn_encoder(x)  # (N*T, D1) get the hidden representation of every time step.
+        obs_encoded = obs_encoded.float().view(num_traj, self.seq_len, obs_encoded.shape[-1])
 
         rnn_outputs = self.rnn(obs_encoded)
 
@@ -93,6 +128,45 @@ class CnnRnnEncoder(nn.Module):
 
         return step_embed, traj_embed
 
+    def forward_packed(self, x, lengths):
+        """
+        Padding-aware forward: the CNN only runs on the real frames, which are right aligned and packed for the RNN.
+        The step embeddings of the padded time steps are zeros, and the traj embedding is the RNN state at the last
+        real time step. Not supported with normalize, whose batch statistics include the padded frames in the dense
+        forward
+        :param x: input observations (Batch_size, seq_len, input_channels, input_dim, input_dim)
+        :param lengths: number of real time steps of each traj (batch_size, )
+        :return step_embed: the latent representation of each time step (batch_size, seq_len, hidden_dim)
+                traj_embed: the representation of the traj (batch_size, hidden_dim)
+        """
+
+        if self.normalize:
+            raise ValueError('Skipping the padded time steps is not supported with normalize.')
+        num_traj = x.shape[0]
+        lengths = torch.as_tensor(lengths).cpu().long().clamp(1, self.seq_len)
+        steps = torch.arange(self.seq_len, device=x.device)[None, :]
+        real_mask = steps >= (self.seq_len - lengths.to(x.device))[:, None]  # left padded: real frames at the end.
+        packed_mask = steps < lengths.to(x.device)[:, None]  # real frames moved to the start of the sequence.
+
+        x = x[real_mask].float()  # (sum(lengths), input_channels, input_dim, input_dim), in (traj, step) order.
+        with autocast(x.device, self.amp_dtype):
+            obs_encoded = self.cnn_encoder(x)  # (sum(lengths), D1)
+        obs_encoded = obs_encoded.float()
+
+        rnn_inputs = obs_encoded.new_zeros(num_traj, self.seq_len, obs_encoded.shape[-1])
+        rnn_inputs[packed_mask] = obs_encoded
+        rnn_inputs = nn.utils.rnn.pack_padded_sequence(rnn_inputs, lengths, batch_first=True, enforce_sorted=False)
+        rnn_outputs = self.rnn(rnn_inputs)
+        packed_outputs, _ = nn.utils.rnn.pad_packed_sequence(rnn_outputs[0], batch_first=True,
+                                                             total_length=self.seq_len)
+
+        step_embed = packed_outputs.new_zeros(num_traj, self.seq_len, self.hidden_dim)
+        step_embed[real_mask] = packed_outputs[packed_mask]  # back to the left padded layout.
+        traj_embed = torch.squeeze(rnn_outputs[1], 0)  # (1, batch_size, hidden_dim) -> (batch_size, hidden_dim)
+        traj_embed = self.traj_embed_layer(traj_embed)  # (batch_size, hidden_dim)
+
+        return step_embed, traj_embed
+
 
 class MlpRnnEncoder(nn.Module):
     def __init__(self, seq_len, input_dim, hiddens, dropout_rate=0.25, rnn_cell_type='GRU', normalize=False):
@@ -157,7 +231,7 @@ class DGPXRLModel(gpytorch.Module):
     def __init__(self, seq_len, input_dim, input_channels, hiddens, likelihood_type, num_inducing_points,
                  encoder_type='MLP', inducing_points=None, mean_inducing_points=None, dropout_rate=0.25,
                  rnn_cell_type='GRU', normalize=False, grid_bounds=None, using_ngd=False, using_ksi=False,
-                 using_ciq=False, using_sor=False, using_OrthogonallyDecouple=False):
+                 using_ciq=False, using_sor=False, using_OrthogonallyDecouple=False, predictive_covar='full'):
         """
         Define the DGP encoding model
         :type encoder_type: object
@@ -179,6 +253,7 @@ class DGPXRLModel(gpytorch.Module):
         :param using_ciq: Whether to use Contour Integral Quadrature to approximate K_{zz}^{-1/2}, Use it together with NGD
         :param using_sor: Whether to use SoR approximation, not applicable for KSI and CIQ
         :param using_OrthogonallyDecouple
+        :param predictive_covar: covariance of q(f), 'full', 'block' (one block per traj) or 'diag'
         """
         super(DGPXRLModel, self).__init__()
         self.seq_len = seq_len
@@ -201,19 +276,41 @@ class DGPXRLModel(gpytorch.Module):
                                              mean_inducing_points=mean_inducing_points, grid_bounds=grid_bounds,
                                              likelihood_type=likelihood_type, using_ngd=using_ngd, using_ksi=using_ksi,
                                              using_ciq=using_ciq, using_sor=using_sor,
-                                             using_OrthogonallyDecouple=using_OrthogonallyDecouple)
+                                             using_OrthogonallyDecouple=using_OrthogonallyDecouple,
+                                             predictive_covar=predictive_covar, block_size=seq_len)
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         """
         Compute the marginal posterior q(f) ~ N(\mu_f, \sigma_f), \mu_f (N*T, 1), \sigma_f(N*T, N*T).
         Later, when computing the marginal loglikelihood, we sample multiple set of data from the marginal loglikelihood
         :param x: input data x (N, T, P)
+        :param lengths: number of real time steps of each traj, skip the padded time steps in the (CNN) encoder
         :return: q(gy_layer(Encoder(x)))
         """
-        step_embedding, traj_embedding = self.encoder(x)  # (N, T, P) -> (N, T, D), (N, D).
+        if lengths is not None:
+            step_embedding, traj_embedding = self.encoder(x, lengths)
+        else:
+            step_embedding, traj_embedding = self.encoder(x)  # (N, T, P) -> (N, T, D), (N, D).
+        return self.forward_embedding(step_embedding, traj_embedding)
+
+    def get_features(self, step_embedding, traj_embedding):
+        """
+        :param step_embedding: encoder output at each time step (N, T, D)
+        :param traj_embedding: encoder output of the traj (N, D)
+        :return: inputs of the GP layer (N, T, 2D)
+        """
         traj_embedding = traj_embedding[:, None, :].repeat(1, self.seq_len, 1)  # (N, D) -> (N, T, D)
-        features = torch.cat([step_embedding, traj_embedding], dim=-1)  # (N, T, 2D)
-        features_reshaped = features.view(x.size(0) * x.size(1), features.size(-1))
+        return torch.cat([step_embedding, traj_embedding], dim=-1)  # (N, T, 2D)
+
+    def forward_embedding(self, step_embedding, traj_embedding):
+        """
+        Same as forward, starting from the encoder outputs (e.g., loaded from an embedding cache)
+        :param step_embedding: encoder output at each time step (N, T, D)
+        :param traj_embedding: encoder output of the traj (N, D)
+        :return: q(gy_layer(embedding))
+        """
+        features = self.get_features(step_embedding, traj_embedding)  # (N, T, 2D)
+        features_reshaped = features.view(features.size(0) * features.size(1), features.size(-1))
         # features_reshaped = self.batch_norm(features_reshaped)
         res = self.gp_layer(features_reshaped)
         return res, features
@@ -222,7 +319,8 @@ class DGPXRLModel(gpytorch.Module):
 # Build the GP layer.
 class GaussianProcessLayer(gpytorch.models.ApproximateGP):
     def __init__(self, input_dim_step, input_dim_traj, num_inducing_points, inducing_points, mean_inducing_points,
-                 grid_bounds, likelihood_type, using_ngd, using_ksi, using_ciq, using_sor, using_OrthogonallyDecouple):
+                 grid_bounds, likelihood_type, using_ngd, using_ksi, using_ciq, using_sor, using_OrthogonallyDecouple,
+                 predictive_covar='full', block_size=None):
         """
         Define the mean and kernel function: Constant mean, and additive RBF kernel (step kernel + traj kernel).
         variational distribution: Cholesky Multivariate Gaussian q(u) ~ N(\mu, LL^T).
@@ -246,7 +344,13 @@ class GaussianProcessLayer(gpytorch.models.ApproximateGP):
         :param using_ciq: Whether to use Contour Integral Quadrature to approximate K_{zz}^{-1/2}, Use it together with NGD
         :param using_sor: Whether to use SoR approximation, not applicable for KSI and CIQ
         :param using_OrthogonallyDecouple
+        :param predictive_covar: covariance of q(f), 'full', 'block' (blocks of block_size inputs) or 'diag',
+                                 only supported by the customized variational strategy
+        :param block_size: block size of the 'block' covariance
         """
+        if predictive_covar != 'full' and (using_ksi or using_ciq):
+            raise ValueError('The {} predictive covariance is not supported with KSI or CIQ.'.format(predictive_covar))
+
         if using_ngd:
             print('Using Natural Gradient Descent.')
             if likelihood_type == 'regression':
@@ -274,7 +378,8 @@ class GaussianProcessLayer(gpytorch.models.ApproximateGP):
         else:
             variational_strategy = CustomizedVariationalStrategy(self, inducing_points, variational_distribution,
                                                                  learning_inducing_locations=True,
-                                                                 using_sor=using_sor)
+                                                                 using_sor=using_sor, predictive_covar=predictive_covar,
+                                                                 block_size=block_size)
 
         if using_OrthogonallyDecouple:
             print('Using Orthogonally Decouple.')
@@ -512,6 +617,8 @@ class NNSoftmaxLikelihood(Likelihood):
             nn.LeakyReLU(),
             nn.Linear(num_features, num_features * num_classes)
         )
+        # Low precision dtype of the weight encoder (None: float32).
+        self.amp_dtype = None
 
     def expected_log_prob(self, observations, function_dist, *args, **kwargs):
         likelihood_samples = self._draw_likelihood_samples(function_dist, *args, **kwargs)
@@ -541,8 +648,9 @@ class NNSoftmaxLikelihood(Likelihood):
         # print('Check the shape of f, should be [n_likelihood_sample, n_traj, traj_length]:')
         # print(function_samples.shape)
         input_encoding = kwargs['input_encoding'].sum(-1)
-        mixing_weights = self.weight_encoder(input_encoding)
-        mixing_weights = mixing_weights.view(mixing_weights.shape[0], self.num_features, self.num_classes)
+        with autocast(input_encoding.device, self.amp_dtype):
+            mixing_weights = self.weight_encoder(input_encoding)
+        mixing_weights = mixing_weights.float().view(mixing_weights.shape[0], self.num_features, self.num_classes)
         mixed_fs = torch.einsum('bxy, xyk->bxk', (function_samples, mixing_weights))  # num_classes x num_data
         # print('Check the shape of fW, should be [n_likelihood_sample, n_traj, n_classes]:')
         # print(mixed_fs.shape)
@@ -836,28 +944,128 @@ class CustomizedVariationalStrategy(_VariationalStrategy):
         q(f|v) \approx K_{xz}K_{zz}^(-1)Lv (Omit the variance of the conditional distribution q(f|u)).
         Here q(f) = N(K_{xz}K_{zz}^{-1/2}\mu, K_{xz}K_{zz}^{-1/2}SK_{zz}^{-1/2}K_{xz}^{T})
         K_{xx} can be approximated as  K_{xz}K_{zz}^{-1}K_{xz}^{T}.
+    Inference (eval mode without gradients):
+        \alpha = L^{-T}\mu and C = L^{-T}(S-I)L^{-1} only depend on the frozen model, they are computed once, then
+        q(f) = N(K_{xz}\alpha + \mu_x, K_{xx} + K_{xz}CK_{zx}).
     """
 
     def __init__(self, model, inducing_points, variational_distribution, learning_inducing_locations=True,
-                 using_sor=False):
+                 using_sor=False, predictive_covar='full', block_size=None):
         """
         :param model: Model this strategy is applied to (ApproximateGP)
         :param inducing_points: z
         :param variational_distribution: q(u) or q(v) if whitening
         :param learning_inducing_locations: Whether to learn/udpate z
         :param using_sor: Whether to use SoR
+        :param predictive_covar: covariance of q(f), 'full' (N*T, N*T), 'block' (diagonal blocks of block_size
+                                 consecutive inputs, i.e., one block per traj), or 'diag' (marginal variances only)
+        :param block_size: block size of the 'block' covariance, the traj length
         """
         super(CustomizedVariationalStrategy, self).__init__(model, inducing_points, variational_distribution,
                                                             learning_inducing_locations)
+        if predictive_covar not in ('full', 'block', 'diag'):
+            raise ValueError('Unknown predictive covariance {}, should be one of full, block, diag.'.format(predictive_covar))
+        if predictive_covar == 'block' and block_size is None:
+            raise ValueError('block_size is required with the block predictive covariance.')
         self.register_buffer("updated_strategy", torch.tensor(True))
         self.using_sor = using_sor
+        self.predictive_covar = predictive_covar
+        self.block_size = block_size
         self._register_load_state_dict_pre_hook(_ensure_updated_strategy_flag_set)
+        # Loading a checkpoint in eval mode invalidates the inference terms.
+        self._register_load_state_dict_pre_hook(self._clear_inference_cache)
+
+    def _clear_inference_cache(self, *args):
+        """
+        load_state_dict pre hook, a bound method so that deep copies and pickles of the model clear their own cache
+        """
+        clear_cache_hook(self)
 
     @cached(name="cholesky_factor", ignore_args=True)
     def _cholesky_factor(self, induc_induc_covar):
         L = psd_safe_cholesky(delazify(induc_induc_covar).double())
         return TriangularLazyTensor(L)
 
+    @cached(name="inference_terms", ignore_args=True)
+    def _inference_terms(self, inducing_points, inducing_values, variational_inducing_covar):
+        """
+        Terms of q(f) that do not depend on x, cleared with the other caches when the strategy goes back to training
+        :param inducing_points: Locations of the inducing points (z)
+        :param inducing_values: mean of q(v)
+        :param variational_inducing_covar: covariance of q(v)
+        :return: \alpha = L^{-T}\mu, C = L^{-T}(S-I)L^{-1}
+        """
+        induc_induc_covar = self.model.forward(inducing_points).lazy_covariance_matrix.add_jitter()  # K_{zz}.
+        L = self._cholesky_factor(induc_induc_covar)  # LL^T = K_{zz}
+        if L.shape != induc_induc_covar.shape:
+            try:
+                pop_from_cache_ignore_args(self, "cholesky_factor")
+            except CachingError:
+                pass
+            L = self._cholesky_factor(induc_induc_covar)
+        eye = torch.eye(L.shape[-1], dtype=L.dtype, device=L.device)
+        L_inv = L.inv_matmul(eye)  # L^{-1}
+        L_inv_t = L_inv.transpose(-1, -2)
+
+        alpha = (L_inv_t @ inducing_values.double().unsqueeze(-1)).squeeze(-1)  # L^{-T}\mu
+        middle_term = -eye  # -I
+        if variational_inducing_covar is not None:
+            middle_term = middle_term + delazify(variational_inducing_covar).double()  # S-I
+        middle_term = L_inv_t @ middle_term @ L_inv  # L^{-T}(S-I)L^{-1}
+        return alpha.to(inducing_points.dtype), middle_term.to(inducing_points.dtype)
+
+    def inference_forward(self, x, inducing_points, inducing_values, variational_inducing_covar=None, **kwargs):
+        """
+        Same as forward for a frozen model, the per batch work is K_{xz}, K_{xx} and one matmul
+        :param x: Locations to get the variational posterior of the function values at
+        :param inducing_points: Locations of the inducing points (z)
+        :param inducing_values: mean of q(v)
+        :param variational_inducing_covar: covariance of q(v)
+        :return: q(f(x)).
+        """
+        alpha, middle_term = self._inference_terms(inducing_points, inducing_values, variational_inducing_covar)
+        induc_data_covar = self.model.covar_module(inducing_points, x).evaluate()  # K_{zx}.
+
+        predictive_mean = (induc_data_covar.transpose(-1, -2) @ alpha.unsqueeze(-1)).squeeze(-1) \
+                          + self.model.mean_module(x)
+        predictive_covar = self._predictive_covar(x, None, induc_data_covar, middle_term)
+        return MultivariateNormal(predictive_mean, predictive_covar)
+
+    def _predictive_covar(self, x, data_data_covar, interp_term, middle_term):
+        """
+        Covariance of q(f): K_{xx} + interp_term^T middle_term interp_term, in the predictive_covar format
+        :param x: Locations to get the variational posterior of the function values at (N*T, d)
+        :param data_data_covar: K_{xx}, None to compute only the entries of the format
+        :param interp_term: (M, N*T)
+        :param middle_term: (M, M)
+        :return: predictive covariance (N*T, N*T)
+        """
+        if self.predictive_covar == 'diag':
+            data_data_diag = self.model.covar_module(x, diag=True)
+            interp_diag = (interp_term * (delazify(middle_term) @ interp_term)).sum(-2)
+            return DiagLazyTensor(data_data_diag + interp_diag + 1e-4)
+
+        if self.predictive_covar == 'block':
+            x_blocks = x.view(-1, self.block_size, x.shape[-1])  # (N, T, d)
+            interp_blocks = interp_term.view(interp_term.shape[-2], -1, self.block_size).transpose(0, 1)  # (N, M, T)
+            covar_blocks = SumLazyTensor(
+                self.model.covar_module(x_blocks).add_jitter(1e-4),
+                MatmulLazyTensor(interp_blocks.transpose(-1, -2), delazify(middle_term) @ interp_blocks),
+            )  # (N, T, T)
+            return BlockDiagLazyTensor(covar_blocks)
+
+        if data_data_covar is None:
+            data_data_covar = self.model.covar_module(x)
+        if settings.trace_mode.on():
+            return (
+                    data_data_covar.add_jitter(1e-4).evaluate()
+                    + interp_term.transpose(-1, -2) @ middle_term.evaluate() @ interp_term
+            )
+        return SumLazyTensor(
+            data_data_covar.add_jitter(1e-4),
+            MatmulLazyTensor(interp_term.transpose(-1, -2), middle_term @ interp_term),
+        )
+
     @property
     @cached(name="prior_distribution_memo")
     def prior_distribution(self):
@@ -894,17 +1102,27 @@ class CustomizedVariationalStrategy(_VariationalStrategy):
         then this variable is the covariance matrix of that Gaussian. Otherwise, it will be :attr:`None`
         :return: q(f(x)).
         """
-        # Compute full prior distribution
-        full_inputs = torch.cat([inducing_points, x], dim=-2)
-        full_output = self.model.forward(full_inputs, **kwargs)
-        full_covar = full_output.lazy_covariance_matrix
-
-        # Covariance terms
-        num_induc = inducing_points.size(-2)
-        test_mean = full_output.mean[..., num_induc:]  # \mu_x
-        induc_induc_covar = full_covar[..., :num_induc, :num_induc].add_jitter()  # K_{zz}.
-        induc_data_covar = full_covar[..., :num_induc, num_induc:].evaluate()  # K_{xz}.
-        data_data_covar = full_covar[..., num_induc:, num_induc:]  # K_{xx}.
+        if not self.training and not torch.is_grad_enabled() and not settings.trace_mode.on():
+            return self.inference_forward(x, inducing_points, inducing_values, variational_inducing_covar, **kwargs)
+
+        if self.predictive_covar == 'full':
+            # Compute full prior distribution
+            full_inputs = torch.cat([inducing_points, x], dim=-2)
+            full_output = self.model.forward(full_inputs, **kwargs)
+            full_covar = full_output.lazy_covariance_matrix
+
+            # Covariance terms
+            num_induc = inducing_points.size(-2)
+            test_mean = full_output.mean[..., num_induc:]  # \mu_x
+            induc_induc_covar = full_covar[..., :num_induc, :num_induc].add_jitter()  # K_{zz}.
+            induc_data_covar = full_covar[..., :num_induc, num_induc:].evaluate()  # K_{xz}.
+            data_data_covar = full_covar[..., num_induc:, num_induc:]  # K_{xx}.
+        else:
+            # Only the entries of K_{xx} kept by the predictive covariance are computed, in _predictive_covar.
+            test_mean = self.model.mean_module(x)  # \mu_x
+            induc_induc_covar = self.model.covar_module(inducing_points).add_jitter()  # K_{zz}.
+            induc_data_covar = self.model.covar_module(inducing_points, x).evaluate()  # K_{xz}.
+            data_data_covar = None
 
         # Compute interpolation terms
         # K_ZZ^{-1/2} \mu_Z
@@ -915,7 +1133,7 @@ class CustomizedVariationalStrategy(_VariationalStrategy):
             except CachingError:
                 pass
             L = self._cholesky_factor(induc_induc_covar)
-        interp_term = L.inv_matmul(induc_data_covar.double()).to(full_inputs.dtype)  # K_{zz}^{-1/2} K_{xz}^T
+        interp_term = L.inv_matmul(induc_data_covar.double()).to(x.dtype)  # K_{zz}^{-1/2} K_{xz}^T
 
         # Compute the mean of q(f)
         # K_{xz} K_{zz}^{-1/2} \mu_z + \mu_X
@@ -934,16 +1152,7 @@ class CustomizedVariationalStrategy(_VariationalStrategy):
             if variational_inducing_covar is not None:
                 middle_term = SumLazyTensor(variational_inducing_covar, middle_term)  # S-I
 
-        if settings.trace_mode.on():
-            predictive_covar = (
-                    data_data_covar.add_jitter(1e-4).evaluate()
-                    + interp_term.transpose(-1, -2) @ middle_term.evaluate() @ interp_term
-            )
-        else:
-            predictive_covar = SumLazyTensor(
-                data_data_covar.add_jitter(1e-4),
-                MatmulLazyTensor(interp_term.transpose(-1, -2), middle_term @ interp_term),
-            )
+        predictive_covar = self._predictive_covar(x, data_data_covar, interp_term, middle_term)
 
         # Return the distribution
         return MultivariateNormal(predictive_mean, predictive_covar)
@@ -3,16 +3,30 @@ import tqdm
 import math
 import torch
 import numpy as np
+from src.traj_io import load_batch
 
 
-def concrete_transformation(theta, batch_size, temp=1.0 / 10.0, epsilon=torch.tensor(1e-10)):
+def sample_uniform(theta, batch_size, generator=None):
+    """ Draw the uniform noise of the concrete/gumbel transformations
+    :param theta: distribution parameters
+    :param batch_size: size of samples
+    :param generator: torch.Generator on the device of theta, None draws float64 noise with numpy on the host
+    :return: noise of shape (batch_size, *theta.shape)
+    """
+    if generator is None:
+        return torch.from_numpy(np.random.uniform(0, 1, size=(batch_size, *theta.shape)))
+    return torch.rand((batch_size, *theta.shape), generator=generator, device=theta.device, dtype=theta.dtype)
+
+
+def concrete_transformation(theta, batch_size, temp=1.0 / 10.0, epsilon=torch.tensor(1e-10), generator=None):
     """ Use concrete distribution to approximate binary output
     :param theta: Bernoulli distribution parameters
     :param batch_size: size of samples
     :param temp: temperature
+    :param generator: torch.Generator drawing the noise on the device, None uses numpy
     :return: approximated binary output
     """
-    unif_noise = torch.from_numpy(np.random.uniform(0, 1, size=(batch_size, *theta.shape)))
+    unif_noise = sample_uniform(theta, batch_size, generator)
 
     reverse_theta = torch.ones_like(theta) - theta
     reverse_unif_noise = torch.ones_like(unif_noise) - unif_noise
@@ -27,14 +41,15 @@ def concrete_transformation(theta, batch_size, temp=1.0 / 10.0, epsilon=torch.te
     return torch.sigmoid(logit).type(torch.float32)
 
 
-def gumble_transformation(theta, batch_size, temp=1.0 / 10.0, epsilon=torch.tensor(1e-8)):
+def gumble_transformation(theta, batch_size, temp=1.0 / 10.0, epsilon=torch.tensor(1e-8), generator=None):
     """ Use concrete distribution to approximate multiclass output
     :param theta: Multinoulli distribution parameters
     :param batch_size: size of samples
     :param temp: temperature
+    :param generator: torch.Generator drawing the noise on the device, None uses numpy
     :return: approximated binary output
     """
-    unif_noise = torch.from_numpy(np.random.uniform(0, 1, size=(batch_size, *theta.shape)))
+    unif_noise = sample_uniform(theta, batch_size, generator).to(theta.device)
 
     gumbel = - torch.log(- torch.log(unif_noise + epsilon) + epsilon)
     logit = (torch.log(theta + epsilon) + gumbel) / temp
@@ -78,7 +93,7 @@ def elasticnet_loss(tensor):
 
 class MaskObsModel(torch.nn.Module):
     def __init__(self, policy, act_distrubtion, input_shape, mask_shape, initializer='one', normalize_choice='sigmoid',
-                 upsampling_mode='nearest', epsilon=1e-8):
+                 upsampling_mode='nearest', epsilon=1e-8, noise_seed=None):
         """
         :param policy: policy network
         :param act_distribution: action distribution "normal" or "cat"
@@ -89,6 +104,7 @@ class MaskObsModel(torch.nn.Module):
         :param normalize_choice: how to normalize the variable to between zero and one ['sigmoid', 'tanh', 'clip']
         :param upsampling_mode: upsampling mode ['nearest', 'bilinear']
         :param epsilon: same number to prevent numerical error
+        :param noise_seed: seed of the on-device generator of the concrete noise, None draws it with numpy on the host
         """
 
         super(MaskObsModel, self).__init__()
@@ -101,6 +117,9 @@ class MaskObsModel(torch.nn.Module):
         self.normalize_choice = normalize_choice
         self.upsampling_mode = upsampling_mode
         self.epsilon = torch.tensor(epsilon)
+        self.noise_seed = noise_seed
+        self.generator = None
+        self.p_cache = None
 
         # Remove the gradient in pretrained policy network
         self.policy.eval()
@@ -126,6 +145,17 @@ class MaskObsModel(torch.nn.Module):
 
         self.logit_p = torch.nn.Parameter(tensor_logit_p)
 
+    def get_generator(self):
+        """
+        :return: the seeded generator of the concrete noise on the device of logit_p, None without noise_seed
+        """
+        if self.noise_seed is None:
+            return None
+        if self.generator is None or self.generator.device != self.logit_p.device:
+            self.generator = torch.Generator(device=self.logit_p.device)
+            self.generator.manual_seed(self.noise_seed)
+        return self.generator
+
     def forward(self, obs, fused_obs, hidden_states=None, temp=0.1, compute_obs_only=False):
         """
         Compute the masked observations
@@ -136,29 +166,10 @@ class MaskObsModel(torch.nn.Module):
         :return: masked observations and corresponding actions.
         """
 
-        # normalize logit_p to between zero and one -> p.
-        if self.normalize_choice == 'sigmoid':
-            # print('Using sigmoid normalization.')
-            p_mask_size = torch.sigmoid(self.logit_p)
-        elif self.normalize_choice == 'tanh':
-            # print('Using tanh normalization.')
-            p_mask_size = (torch.tanh(self.logit_p + torch.ones_like(self.logit_p))) / (2 + self.epsilon)
-        elif self.normalize_choice == 'clip':
-            # print('Using clip normalization.')
-            p_mask_size = torch.clamp(self.logit_p, 0.0, 1.0).clone()
-        else:
-            # print('Using sigmoid normalization.')
-            p_mask_size = torch.sigmoid(self.logit_p)
-
-        # resize variables
-        if len(self.input_shape) > 1 and self.input_shape[1] != self.mask_shape[1]:
-            # print('Upsampling the mask from %d to %d.' % (self.mask_shape[1], self.input_shape[1]))
-            p = torch.nn.Upsample(size=self.input_shape[1:], mode=self.upsampling_mode)(p_mask_size[None,:])[0]
-        else:
-            p = p_mask_size
+        p = self.compute_p()
 
         batch_size = obs.shape[0]
-        mask = concrete_transformation(p, batch_size, temp, self.epsilon)
+        mask = concrete_transformation(p, batch_size, temp, self.epsilon, self.get_generator())
         reverse_mask = torch.ones_like(mask) - mask
 
         # compute masked samples and reverse masked samples.
@@ -174,59 +185,136 @@ class MaskObsModel(torch.nn.Module):
             return obs_exp, obs_remain, acts_exp, acts_remain
 
     def compute_p(self):
+        """
+        Normalize logit_p to between zero and one and upsample it to the input shape. The result is memoized until
+        logit_p or the normalization changes (optimizer step, load_state_dict, device move, a new normalize_choice,
+        upsampling_mode or epsilon). The memo is only used when no gradient flows back to logit_p, since the graph
+        of a cached p cannot be backpropagated twice.
+        :return: p
+        """
+        key = (self.logit_p.data_ptr(), self.logit_p._version, self.logit_p.device, self.normalize_choice,
+               self.upsampling_mode, self.epsilon)
+        use_cache = not (torch.is_grad_enabled() and self.logit_p.requires_grad)
+        if use_cache and self.p_cache is not None and self.p_cache[0] == key:
+            return self.p_cache[1]
+
         # normalize logit_p to between zero and one -> p.
         if self.normalize_choice == 'sigmoid':
-            # print('Using sigmoid normalization.')
             p_mask_size = torch.sigmoid(self.logit_p)
         elif self.normalize_choice == 'tanh':
-            # print('Using tanh normalization.')
             p_mask_size = (torch.tanh(self.logit_p + torch.ones_like(self.logit_p))) / (2 + self.epsilon)
         elif self.normalize_choice == 'clip':
-            # print('Using clip normalization.')
             p_mask_size = torch.clamp(self.logit_p, 0.0, 1.0).clone()
         else:
-            # print('Using sigmoid normalization.')
             p_mask_size = torch.sigmoid(self.logit_p)
 
         # resize variables
         if len(self.input_shape) > 1 and self.input_shape[1] != self.mask_shape[1]:
-            # print('Upsampling the mask from %d to %d.' % (self.mask_shape[1], self.input_shape[1]))
-            p = torch.nn.Upsample(size=self.input_shape[1:], mode=self.upsampling_mode)(p_mask_size[None,:])[0]
+            p = torch.nn.functional.interpolate(p_mask_size[None, :], size=self.input_shape[1:],
+                                                mode=self.upsampling_mode)[0]
         else:
             p = p_mask_size
 
+        if use_cache:
+            self.p_cache = (key, p)
         return p
 
     def get_visual_mask(self, temp=0.1):
-         # normalize logit_p to between zero and one -> p.
-        if self.normalize_choice == 'sigmoid':
-            # print('Using sigmoid normalization.')
-            p_mask_size = torch.sigmoid(self.logit_p)
-        elif self.normalize_choice == 'tanh':
-            # print('Using tanh normalization.')
-            p_mask_size = (torch.tanh(self.logit_p + torch.ones_like(self.logit_p))) / (2 + self.epsilon)
-        elif self.normalize_choice == 'clip':
-            # print('Using clip normalization.')
-            p_mask_size = torch.clamp(self.logit_p, 0.0, 1.0).clone()
-        else:
-            # print('Using sigmoid normalization.')
-            p_mask_size = torch.sigmoid(self.logit_p)
-
-        # resize variables
-        if len(self.input_shape) > 1 and self.input_shape[1] != self.mask_shape[1]:
-            # print('Upsampling the mask from %d to %d.' % (self.mask_shape[1], self.input_shape[1]))
-            p = torch.nn.Upsample(size=self.input_shape[1:], mode=self.upsampling_mode)(p_mask_size[None,:])[0]
-        else:
-            p = p_mask_size
-
-        mask = concrete_transformation(p, 1, temp, self.epsilon)[0]
+        p = self.compute_p()
+        mask = concrete_transformation(p, 1, temp, self.epsilon, self.get_generator())[0]
         
         return mask
 
 
+class FusedObs(object):
+    def __init__(self, fused_choice, obs_shape, device=None, noise_seed=None):
+        """
+        Values to fill in the masked part of the observations. They are kept on the device and broadcast to the batch
+        with expand instead of materializing one copy per observation
+        :param fused_choice: values to fill in the masked part ['mean', 'random', 'blur'], zeros otherwise
+        :param obs_shape: shape of one observation [c, w, h] or [d]
+        :param device: device of the observations
+        :param noise_seed: seed of the on-device generator of the 'random' noise, None draws it with numpy on the host
+        """
+        if fused_choice == 'blur' and len(obs_shape) != 3:
+            raise TypeError("Non-image observation does not blur...")
+        if len(obs_shape) not in [1, 3]:
+            raise TypeError('Only support image or vector observation...')
+
+        self.fused_choice = fused_choice
+        self.obs_shape = tuple(obs_shape)
+        self.device = device
+        self.noise_seed = noise_seed
+        self.generator = None
+        self.baselines = {}
+        self.baseline = torch.zeros(self.obs_shape, dtype=torch.float32, device=device)
+
+        if fused_choice == 'blur':
+            # cv2.GaussianBlur(obs, (5, 5), cv2.BORDER_DEFAULT) on every (w, h) plane: the flag lands on sigmaX (= 4)
+            # and the border is the default BORDER_REFLECT_101 (reflect padding).
+            kernel = cv2.getGaussianKernel(5, cv2.BORDER_DEFAULT)
+            kernel = torch.tensor(kernel @ kernel.T, dtype=torch.float32, device=device)
+            self.blur_kernel = kernel[None, None].repeat(self.obs_shape[0], 1, 1, 1)
+
+    def get_generator(self, device):
+        """
+        :return: the seeded generator of the 'random' noise on the device, None without noise_seed
+        """
+        if self.noise_seed is None:
+            return None
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.noise_seed)
+        return self.generator
+
+    def fit(self, traj_path, traj_idx, step_idx=None, batch_size=20):
+        """
+        Compute the dataset-level mean observation, only needed for fused_choice='mean'. The means of the datasets
+        already fitted are kept, so that switching between them (e.g. train and test) does not load them again
+        :param traj_path: traj path
+        :param traj_idx: traj index
+        :param step_idx: time steps to average over, all of them by default
+        :param batch_size: number of trajs loaded at a time
+        """
+        if self.fused_choice != 'mean':
+            return
+        fit_key = (traj_path, np.asarray(traj_idx).tobytes(),
+                   None if step_idx is None else np.asarray(step_idx).tobytes())
+        if fit_key not in self.baselines:
+            obs_sum = np.zeros(self.obs_shape)
+            obs_count = 0
+            for batch in range(0, traj_idx.shape[0], batch_size):
+                batch_obs, = load_batch(traj_path, traj_idx[batch:batch + batch_size], ('states',))
+                if step_idx is not None:
+                    batch_obs = batch_obs[:, step_idx, ]
+                batch_obs = batch_obs.reshape(-1, *self.obs_shape)
+                obs_sum += batch_obs.sum(0, dtype=np.float64)
+                obs_count += batch_obs.shape[0]
+            self.baselines[fit_key] = torch.tensor(obs_sum / obs_count, dtype=torch.float32, device=self.device)
+        self.baseline = self.baselines[fit_key]
+
+    def __call__(self, obs):
+        """
+        :param obs: observations on the device (N, *obs_shape)
+        :return: fused observations (N, *obs_shape), a broadcast view unless fused_choice='blur'
+        """
+        if self.fused_choice == 'blur':
+            obs = torch.nn.functional.pad(obs.float(), (2, 2, 2, 2), mode='reflect')
+            return torch.nn.functional.conv2d(obs, self.blur_kernel, groups=self.obs_shape[0])
+        if self.fused_choice == 'random':
+            # fresh noise for every batch, shared by its observations.
+            if self.noise_seed is None:
+                noise = torch.tensor(np.random.normal(loc=0, scale=0.1, size=self.obs_shape), dtype=torch.float32,
+                                     device=obs.device)
+            else:
+                noise = 0.1 * torch.randn(self.obs_shape, generator=self.get_generator(obs.device), device=obs.device)
+            return noise.expand(obs.shape[0], *self.obs_shape)
+        return self.baseline.expand(obs.shape[0], *self.obs_shape)
+
+
 class MaskFeatExp(object):
     def __init__(self, policy, act_distribution, input_shape, mask_shape, lr, require_hidden=True, initializer='one',
-                 normalize_choice='sigmoid', upsampling_mode='nearest', epsilon=1e-8):
+                 normalize_choice='sigmoid', upsampling_mode='nearest', epsilon=1e-8, noise_seed=None):
         """
         :param policy: policy network
         :param act_distribution: action distribution "normal" or "cat"
@@ -238,10 +326,11 @@ class MaskFeatExp(object):
         :param normalize_choice: how to normalize the variable to between zero and one ['sigmoid', 'tanh', 'clip']
         :param upsampling_mode: upsampling mode ['nearest', 'bilinear']
         :param epsilon: same number to prevent numerical error
+        :param noise_seed: seed of the on-device generator of the concrete noise, None draws it with numpy on the host
         """
 
         self.mask_model = MaskObsModel(policy, act_distribution, input_shape, mask_shape, initializer,
-                                       normalize_choice, upsampling_mode, epsilon)
+                                       normalize_choice, upsampling_mode, epsilon, noise_seed)
 
         self.optimizer = torch.optim.Adam({self.mask_model.logit_p}, lr=lr)
 
@@ -264,16 +353,8 @@ class MaskFeatExp(object):
         :return: loss.
         """
 
-        obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(obs[0:1,], fused_obs[0:1],
-                                                                     (hidden[0][0], hidden[1][0]), temp)
-        for i in range(obs.shape[0]-1):
-            obs_exp_tmp, obs_remain_tmp, acts_exp_tmp, acts_remain_tmp = self.mask_model(obs[i+1:i+2], fused_obs[i+1:i+2],
-                                                                                         (hidden[0][i+1], hidden[1][i+1]),
-                                                                                         temp)
-            obs_exp = torch.cat((obs_exp, obs_exp_tmp))
-            obs_remain = torch.cat((obs_remain, obs_remain_tmp))
-            acts_exp = torch.cat((acts_exp, acts_exp_tmp))
-            acts_remain = torch.cat((acts_remain, acts_remain_tmp))
+        # one concrete sample per observation and one policy forward for the whole batch.
+        obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(obs, fused_obs, hidden, temp)
 
         # define and compute the network loss and regularization loss.
         if self.mask_model.act_distribution == 'cat':
@@ -359,6 +440,11 @@ class MaskFeatExp(object):
         total_train_samples = train_idx.shape[0] * step_idx.shape[0]
         batch_samples = batch_size * step_idx.shape[0]
 
+        # Generate the fused images once for the whole training set.
+        fused_obs_cache = FusedObs(fused_choice, self.mask_model.input_shape, self.mask_model.logit_p.device,
+                                   self.mask_model.noise_seed)
+        fused_obs_cache.fit(traj_path, train_idx, step_idx)
+
         if train_idx.shape[0] % batch_size == 0:
             n_batch = int(train_idx.shape[0] / batch_size)
         else:
@@ -383,21 +469,13 @@ class MaskFeatExp(object):
             loss_smooth = 0
 
             for batch in tqdm.tqdm(range(n_batch)):
-                batch_obs = []
-                batch_acts = []
-                batch_hs = []
-                batch_cs = []
-
-                for idx in train_idx[batch * batch_size:min((batch + 1) * batch_size, train_idx.shape[0]), ]:
-                    batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'][step_idx,])
-                    batch_acts.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['actions'][step_idx,])
-                    # batch_hs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['h'][step_idx,])
-                    # batch_cs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['c'][step_idx,])
-
-                batch_obs = np.array(batch_obs)
+                batch_idx = train_idx[batch * batch_size:min((batch + 1) * batch_size, train_idx.shape[0]), ]
+                batch_obs, batch_acts = load_batch(traj_path, batch_idx, ('states', 'actions'))
+
+                batch_obs = batch_obs[:, step_idx, ]
                 batch_obs = batch_obs.reshape(batch_samples, *batch_obs.shape[2:])
 
-                batch_acts = np.array(batch_acts)
+                batch_acts = batch_acts[:, step_idx, ]
                 batch_acts = batch_acts.reshape(batch_samples, *batch_acts.shape[2:])
 
                 # batch_hs = np.array(batch_hs)
@@ -416,38 +494,16 @@ class MaskFeatExp(object):
                 batch_hs = batch_hs[nonzero_idx,]
                 batch_cs = batch_cs[nonzero_idx,]
 
-                obs = torch.tensor(batch_obs_non_padding, dtype=torch.float32)
+                obs = torch.as_tensor(batch_obs_non_padding)
                 acts = torch.tensor(batch_acts, dtype=torch.float32)
                 hs = torch.tensor(batch_hs, dtype=torch.float32)
                 cs = torch.tensor(batch_cs, dtype=torch.float32)
 
-                # todo: Support only one channel, add three channels support
-                # Generate fused images
-                if len(batch_obs.shape) == 4:
-                    if fused_choice == 'mean':
-                        fused_obs = np.mean(batch_obs, axis=0)[None, :, :, :].repeat(batch_samples, 0)
-                    elif fused_choice == 'random':
-                        fused_obs = np.random.normal(loc=0, scale=0.1, size=batch_obs.shape[1:])[None, :, :, :].repeat(batch_samples, 0)
-                    elif fused_choice == 'blur':
-                        fused_obs = cv2.GaussianBlur(batch_obs[:,:,:,:], (5, 5), cv2.BORDER_DEFAULT)
-                    else:
-                        fused_obs = np.zeros(batch_obs.shape[1:])[None, :, :, :].repeat(batch_samples, 0)
-                elif len(batch_obs.shape) == 2:
-                    if fused_choice == 'mean':
-                        fused_obs = np.mean(batch_obs, axis=0)
-                    elif fused_choice == 'random':
-                        fused_obs = np.random.normal(loc=0, scale=0.1, size=batch_obs.shape[1:])
-                    elif fused_choice == 'blur':
-                        raise TypeError("Non-image observation does not blur...")
-                    else:
-                        fused_obs = np.zeros(batch_obs.shape[1:])
-                    fused_obs = fused_obs[None, ].repeat(batch_samples, 0)
-                else:
-                    raise TypeError('Only support image or vector observation...')
-                fused_obs = torch.tensor(fused_obs, dtype=torch.float32)
-
                 if torch.cuda.is_available():
-                    obs, fused_obs, acts, hs, cs = obs.cuda(), fused_obs.cuda(), acts.cuda(), hs.cuda(), cs.cuda()
+                    obs, acts, hs, cs = obs.cuda(), acts.cuda(), hs.cuda(), cs.cuda()
+
+                obs = obs.float()
+                fused_obs = fused_obs_cache(obs)
 
                 self.optimizer.zero_grad()
                 loss_batch, loss_exp_batch, loss_sparse_batch, loss_smooth_batch = \
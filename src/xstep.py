@@ -1,3 +1,4 @@
+import os
 import tqdm
 import torch
 import gpytorch
@@ -6,6 +7,9 @@ import torch.optim as optim
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from src.utils import CnnRnnEncoder, MlpRnnEncoder
 from src.utils import DGPXRLModel, CustomizedGaussianLikelihood, CustomizedSoftmaxLikelihood, NNSoftmaxLikelihood
+from src.utils import get_amp_dtype
+from src.traj_io import load_batch, make_traj_loader, traj_lengths
+from src.embedding_cache import EmbeddingCache, cache_key, encoder_hash, parameter_version
 
 
 class DGaussianModel(torch.nn.Module):
@@ -170,18 +174,15 @@ class DGaussianStepExp(object):
             rewards_all = []
 
             for batch in tqdm.tqdm(range(n_batch)):
-                batch_obs = []
-                batch_rewards = []
-                for idx in train_idx[batch * batch_size:min((batch + 1) * batch_size, train_idx.shape[0]), ]:
-                    batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                    batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
+                batch_idx = train_idx[batch * batch_size:min((batch + 1) * batch_size, train_idx.shape[0]), ]
+                batch_obs, batch_rewards = load_batch(traj_path, batch_idx, ('states', 'final_rewards'))
 
-                obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+                obs = torch.tensor(np.asarray(batch_obs), dtype=torch.float32)
 
                 if self.model.likelihood_type == 'classification':
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                    rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.long)
                 else:
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                    rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.float32)
 
                 if torch.cuda.is_available():
                     obs, rewards = obs.cuda(), rewards.cuda()
@@ -247,18 +248,15 @@ class DGaussianStepExp(object):
             n_batch = int(test_idx.shape[0] / batch_size) + 1
 
         for batch in range(n_batch):
-            batch_obs = []
-            batch_rewards = []
-            for idx in test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]:
-                batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
+            batch_idx = test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]
+            batch_obs, batch_rewards = load_batch(traj_path, batch_idx, ('states', 'final_rewards'))
 
-            obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+            obs = torch.tensor(np.asarray(batch_obs), dtype=torch.float32)
 
             if self.model.likelihood_type == 'classification':
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.long)
             else:
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.float32)
 
             if torch.cuda.is_available():
                 obs, rewards = obs.cuda(), rewards.cuda()
@@ -419,7 +417,8 @@ class DGPStepExp(object):
                  optimizer_type, n_epoch, gamma, num_inducing_points, encoder_type='MLP', inducing_points=None,
                  mean_inducing_points=None, dropout_rate=0.25, num_class=None, rnn_cell_type='GRU', normalize=False,
                  grid_bounds=None, using_ngd=False, using_ksi=False, using_ciq=False, using_sor=False,
-                 using_OrthogonallyDecouple=False, weight_x=False, lambda_1=0.01):
+                 using_OrthogonallyDecouple=False, weight_x=False, lambda_1=0.01, num_workers=0, pin_memory=False,
+                 prefetch_factor=2, embedding_cache_dir=None, skip_padding=False, amp=None, predictive_covar='full'):
         """
         :param train_len: training data length
         :param seq_len: trajectory length
@@ -446,6 +445,14 @@ class DGPStepExp(object):
         :param using_OrthogonallyDecouple
         :param weight_x: whether the mixing weights depend on inputs
         :param lambda_1: coefficient before the lasso/local linear regularization (here we time it to lr)
+        :param num_workers: number of processes loading the trajs in the background
+        :param pin_memory: load the trajs into pinned memory for faster host to device copies
+        :param prefetch_factor: number of batches loaded in advance by each loading process
+        :param embedding_cache_dir: directory caching the encoder outputs of the trajs for the test/explanation passes
+        :param skip_padding: skip the padded time steps (marked by a 0 action) in the CNN encoder, without normalize
+        :param amp: mixed precision mode of the CNN encoder and the likelihood NN (None, 'bf16' or 'fp16'),
+                    the RNN, the GP layer and the likelihood sampling stay in float32/float64
+        :param predictive_covar: covariance of q(f), 'full' (N*T, N*T), 'block' (one T*T block per traj) or 'diag'
         """
 
         self.train_len = train_len
@@ -456,6 +463,19 @@ class DGPStepExp(object):
         self.gamma = gamma
         self.using_ngd = using_ngd
         self.weight_x = weight_x
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.embedding_cache_dir = embedding_cache_dir
+        self.skip_padding = skip_padding
+        if self.skip_padding and encoder_type != 'CNN':
+            raise ValueError('Skipping the padded time steps is only supported by the CNN encoder.')
+        if self.skip_padding and normalize:
+            raise ValueError('Skipping the padded time steps is not supported with normalize.')
+        # (traj_path, traj index) -> features (T, 2D) of the traj, filled by get_features_per_traj.
+        self.features_cache = {}
+        # (parameter version, hash) of the encoder, hashing the whole state_dict on every pass is slow.
+        self.encoder_hash = (None, None)
 
         # Build the likelihood layer (Regression and classification).
         if self.likelihood_type == 'regression':
@@ -479,7 +499,8 @@ class DGPStepExp(object):
                                  rnn_cell_type=rnn_cell_type, normalize=normalize, num_inducing_points=num_inducing_points,
                                  inducing_points=inducing_points, mean_inducing_points=mean_inducing_points,
                                  grid_bounds=grid_bounds, using_ngd=using_ngd, using_ksi=using_ksi, using_ciq=using_ciq,
-                                 using_sor=using_sor, using_OrthogonallyDecouple=using_OrthogonallyDecouple)
+                                 using_sor=using_sor, using_OrthogonallyDecouple=using_OrthogonallyDecouple,
+                                 predictive_covar=predictive_covar)
         # print(self.model)
 
         # First, sampling from q(f) with shape [n_sample, n_data].
@@ -540,6 +561,14 @@ class DGPStepExp(object):
                                                                 milestones=[0.5 * self.n_epoch, 0.75 * self.n_epoch],
                                                                 gamma=self.gamma)
 
+        # Mixed precision, the gradients are scaled with fp16 only.
+        self.amp_dtype = get_amp_dtype(amp)
+        if isinstance(self.model.encoder, CnnRnnEncoder):
+            self.model.encoder.amp_dtype = self.amp_dtype
+        if isinstance(self.likelihood, NNSoftmaxLikelihood):
+            self.likelihood.amp_dtype = self.amp_dtype
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
+
         if torch.cuda.is_available():
             self.model = self.model.cuda()
             self.likelihood = self.likelihood.cuda()
@@ -561,8 +590,82 @@ class DGPStepExp(object):
         likelihood_dict = dicts['likelihood']
         self.model.load_state_dict(model_dict)
         self.likelihood.load_state_dict(likelihood_dict)
+        self.features_cache = {}
         return self.model, self.likelihood
 
+    def get_loader(self, traj_idx, batch_size, traj_path, drop_last=False, fields=None, persistent_workers=False):
+        """
+        :param traj_idx: traj index
+        :param batch_size: batch size
+        :param traj_path: traj path
+        :param drop_last: drop the last incomplete batch
+        :param fields: names of the arrays to load
+        :param persistent_workers: keep the loading workers across epochs
+        :return: loader yielding one tensor per field, (obs, rewards) batches by default, followed by the actions
+                 when skipping the padding
+        """
+        if fields is None:
+            fields = ('states', 'final_rewards', 'actions') if self.skip_padding else ('states', 'final_rewards')
+        return make_traj_loader(traj_path, traj_idx, batch_size, fields, drop_last=drop_last,
+                                num_workers=self.num_workers, pin_memory=self.pin_memory,
+                                prefetch_factor=self.prefetch_factor, persistent_workers=persistent_workers)
+
+    def get_embedding_cache(self):
+        """
+        :return: the embedding cache of the current encoder, None if no cache directory is set or if the encoder
+                 normalizes the inputs with batch statistics (the embeddings of a traj then depend on its batch)
+        """
+        if self.embedding_cache_dir is None or self.model.encoder.normalize:
+            return None
+        version = parameter_version(self.model.encoder)
+        if self.encoder_hash[0] != version:
+            self.encoder_hash = (version, encoder_hash(self.model.encoder))
+        key = cache_key(self.encoder_hash[1], getattr(self.model.encoder, 'amp_dtype', None))
+        if self.skip_padding:
+            return EmbeddingCache(os.path.join(self.embedding_cache_dir, 'skip_padding'), key)
+        return EmbeddingCache(self.embedding_cache_dir, key)
+
+    def encode(self, obs, batch_actions):
+        """
+        :param obs: input observations (N, T, P), on the device
+        :param batch_actions: empty, or the actions of the batch when skipping the padding
+        :return: step embedding (N, T, D), traj embedding (N, D)
+        """
+        if batch_actions:
+            return self.model.encoder(obs, traj_lengths(batch_actions[0]))
+        return self.model.encoder(obs)  # (N, T, P) -> (N, T, D), (N, D).
+
+    def iter_embeddings(self, traj_idx, batch_size, traj_path, drop_last=False):
+        """
+        Encode the trajs batch by batch with the frozen encoder. With an embedding cache, the embeddings are read
+        from the cache when all the trajs are cached (no obs is loaded), otherwise they are computed and cached
+        :param traj_idx: traj index
+        :param batch_size: batch size
+        :param traj_path: traj path
+        :param drop_last: drop the last incomplete batch
+        :return: generator of (step embedding (N, T, D), traj embedding (N, D), rewards)
+        """
+        cache = self.get_embedding_cache()
+        if cache is not None and cache.contains(traj_path, traj_idx):
+            loader = self.get_loader(traj_idx, batch_size, traj_path, drop_last, fields=('final_rewards', ))
+            for batch, (batch_rewards, ) in enumerate(loader):
+                step_embedding, traj_embedding = cache.load(traj_path, traj_idx[batch * batch_size:(batch + 1) * batch_size])
+                step_embedding, traj_embedding = torch.as_tensor(step_embedding), torch.as_tensor(traj_embedding)
+                if torch.cuda.is_available():
+                    step_embedding, traj_embedding = step_embedding.cuda(), traj_embedding.cuda()
+                yield step_embedding, traj_embedding, batch_rewards
+            return
+
+        loader = self.get_loader(traj_idx, batch_size, traj_path, drop_last)
+        for batch, (obs, batch_rewards, *batch_actions) in enumerate(loader):
+            if torch.cuda.is_available():
+                obs = obs.cuda(non_blocking=True)
+            step_embedding, traj_embedding = self.encode(obs, batch_actions)
+            if cache is not None:
+                cache.save(traj_path, traj_idx[batch * batch_size:(batch + 1) * batch_size], step_embedding,
+                           traj_embedding)
+            yield step_embedding, traj_embedding, batch_rewards
+
     def train(self, train_idx, batch_size, traj_path, save_path=None, likelihood_sample_size=8):
         """
         Training function
@@ -576,11 +679,10 @@ class DGPStepExp(object):
 
         self.model.train()
         self.likelihood.train()
+        self.features_cache = {}
 
-        if train_idx.shape[0] % batch_size == 0:
-            n_batch = int(train_idx.shape[0] / batch_size)
-        else:
-            n_batch = int(train_idx.shape[0] / batch_size) + 1
+        loader = self.get_loader(train_idx, batch_size, traj_path, persistent_workers=True)
+        n_batch = len(loader)
 
         best_acc = 0
         for epoch in range(1, self.n_epoch + 1):
@@ -593,22 +695,15 @@ class DGPStepExp(object):
             rewards_all = []
             with gpytorch.settings.use_toeplitz(False):
                 with gpytorch.settings.num_likelihood_samples(likelihood_sample_size):
-                    for batch in tqdm.tqdm(range(n_batch)):
-                        batch_obs = []
-                        batch_rewards = []
-                        for idx in train_idx[batch * batch_size:min((batch + 1) * batch_size, train_idx.shape[0]), ]:
-                            batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                            batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
-
-                        obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+                    for obs, batch_rewards, *batch_actions in tqdm.tqdm(loader):  # obs stay uint8 until the encoder
 
                         if self.likelihood_type == 'classification':
-                            rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                            rewards = batch_rewards.long()
                         else:
-                            rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                            rewards = batch_rewards.float()
 
                         if torch.cuda.is_available():
-                            obs, rewards = obs.cuda(), rewards.cuda()
+                            obs, rewards = obs.cuda(non_blocking=True), rewards.cuda(non_blocking=True)
 
                         if self.using_ngd:
                             self.variational_ngd_optimizer.zero_grad()
@@ -616,36 +711,37 @@ class DGPStepExp(object):
                         else:
                             self.optimizer.zero_grad()
 
-                        output, features = self.model(obs)  # marginal variational posterior, q(f|x).
+                        # marginal variational posterior, q(f|x).
+                        output, features = self.model.forward_embedding(*self.encode(obs, batch_actions))
 
                         if self.weight_x:
                             loss = -self.mll(output, rewards, input_encoding=features)  # approximated ELBO.
                         else:
                             loss = -self.mll(output, rewards)  # approximated ELBO.
 
-                        loss.backward()
+                        self.scaler.scale(loss).backward()
 
                         if self.using_ngd:
-                            self.variational_ngd_optimizer.step()
-                            self.hyperparameter_optimizer.step()
+                            self.scaler.step(self.variational_ngd_optimizer)
+                            self.scaler.step(self.hyperparameter_optimizer)
                         else:
-                            self.optimizer.step()
+                            self.scaler.step(self.optimizer)
+                        self.scaler.update()
 
                         loss_sum += loss.item()
 
                         self.likelihood_regular_optimizer.zero_grad()
+                        features = features.detach()
                         if self.weight_x and self.likelihood_type == 'classification':
-                            # lasso.
-                            output, features = self.model(obs)  # marginal variational posterior, q(f|x).
-                            features_sum = features.detach().sum(-1)
-                            weight_output = self.likelihood.weight_encoder(features_sum)
+                            # lasso, reusing the encoding of the ELBO pass instead of running the encoder again.
+                            weight_output = self.likelihood.weight_encoder(features.sum(-1))
                             lasso_term = torch.norm(weight_output, p=1) # lasso
                             lasso_term.backward()
-                            loss_reg_sum += lasso_term
+                            loss_reg_sum += lasso_term.item()
                         else:
                             lasso_term = torch.norm(self.likelihood.mixing_weights, p=1) # lasso
                             lasso_term.backward()
-                            loss_reg_sum += lasso_term
+                            loss_reg_sum += lasso_term.item()
                             self.likelihood_regular_optimizer.step()
 
                         if self.weight_x:
@@ -701,7 +797,7 @@ class DGPStepExp(object):
         :param batch_size: training batch size
         :param traj_path: training traj path
         :param likelihood_sample_size:
-        :return: prediction error
+        :return: test accuracy (classification) or MSE (regression)
         """
 
         # Specify that the model is in eval mode.
@@ -713,30 +809,18 @@ class DGPStepExp(object):
         preds_all = []
         rewards_all = []
 
-        if test_idx.shape[0] % batch_size == 0:
-            n_batch = int(test_idx.shape[0] / batch_size)
-        else:
-            n_batch = int(test_idx.shape[0] / batch_size) + 1
-
         with torch.no_grad(), gpytorch.settings.num_likelihood_samples(likelihood_sample_size):
-            for batch in range(n_batch):
-                batch_obs = []
-                batch_rewards = []
-                for idx in test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]:
-                    batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                    batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
-
-                obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+            for step_embedding, traj_embedding, batch_rewards in self.iter_embeddings(test_idx, batch_size, traj_path):
 
                 if self.likelihood_type == 'classification':
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                    rewards = batch_rewards.long()
                 else:
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                    rewards = batch_rewards.float()
 
                 if torch.cuda.is_available():
-                    obs, rewards = obs.cuda(), rewards.cuda()
+                    rewards = rewards.cuda(non_blocking=True)
 
-                f_predicted, features = self.model(obs)
+                f_predicted, features = self.model.forward_embedding(step_embedding, traj_embedding)
                 if self.weight_x:
                     output = self.likelihood(f_predicted, input_encoding=features)
                 else:
@@ -765,8 +849,9 @@ class DGPStepExp(object):
         else:
             print('Test MAE: {}'.format(mae / float(test_idx.shape[0])))
             print('Test MSE: {}'.format(mse / float(test_idx.shape[0])))
+            return mse / float(test_idx.shape[0])
 
-        return 0
+        return acc
 
     def get_explanations(self, class_id, normalize=True):
         """
@@ -791,80 +876,134 @@ class DGPStepExp(object):
 
         return saliency
 
-    def get_explanations_per_traj(self, exp_idx, batch_size, traj_path, normalize=True):
+    def get_features_per_traj(self, traj_idx, traj_path):
         """
-        get explanation for each input traj
+        :param traj_idx: traj index
+        :param traj_path: traj path
+        :return: features of the traj (T, 2D) on the cpu, only the trajs not explained yet go through the encoder
+        """
+        key = (traj_path, int(traj_idx))
+        if key not in self.features_cache:
+            self.model.eval()
+            with torch.no_grad():
+                for step_embedding, traj_embedding, _ in self.iter_embeddings(np.asarray([traj_idx]), 1, traj_path):
+                    self.features_cache[key] = self.model.get_features(step_embedding, traj_embedding)[0].cpu()
+        return self.features_cache[key]
+
+    def get_kernel(self, kernel):
+        """
+        :param kernel: kernel name ('all', 'step' or 'traj')
+        :return: the kernel of the GP layer
+        """
+        if kernel == 'all':
+            return self.model.gp_layer.covar_module
+        elif kernel == 'step':
+            return self.model.gp_layer.step_kernel
+        elif kernel == 'traj':
+            return self.model.gp_layer.traj_kernel
+        raise ValueError('Unknown kernel {}, should be one of all, step, traj.'.format(kernel))
+
+    def get_covariance(self, traj_idx, traj_path, kernel='all', steps=None):
+        """
+        Covariance between the time steps of one traj, computed on demand from its cached features
+        :param traj_idx: traj index
+        :param traj_path: traj path
+        :param kernel: kernel name ('all', 'step' or 'traj')
+        :param steps: time steps of the block, all the time steps by default
+        :return: covariance block (len(steps), len(steps))
+        """
+        features = self.get_features_per_traj(traj_idx, traj_path)
+        if steps is not None:
+            features = features[torch.as_tensor(steps)]
+        kernel = self.get_kernel(kernel)
+        features = features.to(next(self.model.parameters()).device)
+        with torch.no_grad():
+            return kernel(features).evaluate().detach().cpu().numpy()
+
+    def iter_explanations_per_traj(self, exp_idx, batch_size, traj_path, normalize=True, compute_covar=False):
+        """
+        get explanation for each input traj, one batch at a time (the last incomplete batch is dropped)
         :param exp_idx: training traj index
         :param batch_size: training batch size
         :param traj_path: training traj path
         :param normalize: normalize
-        :return: time step importance
+        :param compute_covar: also compute the covariances of the batch
+        :return: generator of (time step importance, (covar_all, covar_traj, covar_step) with compute_covar and None
+                 otherwise, final rewards)
         """
 
         self.model.eval()
         self.likelihood.eval()
-        n_batch = int(exp_idx.shape[0] / batch_size)
-        final_rewards = []
 
-        for batch in range(n_batch):
-            batch_obs = []
-            batch_rewards = []
-            for idx in exp_idx[batch * batch_size:(batch + 1) * batch_size, ]:
-                batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                batch_rewards.append(int(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards']))
+        with torch.no_grad():
+            for batch, (step_embedding, traj_embedding, batch_rewards) in enumerate(
+                    self.iter_embeddings(exp_idx, batch_size, traj_path, drop_last=True)):
+                rewards = batch_rewards.long().numpy()
 
-            final_rewards += batch_rewards
-            obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+                features = self.model.get_features(step_embedding, traj_embedding)  # (N, T, 2D)
+                # kept on the cpu, so that the cache does not grow on the device with every traj explained.
+                features_cpu = features.cpu()
+                for idx, traj_features in zip(exp_idx[batch * batch_size:(batch + 1) * batch_size], features_cpu):
+                    self.features_cache[(traj_path, int(idx))] = traj_features
 
-            if self.likelihood_type == 'classification':
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
-            else:
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                covars = None
+                if compute_covar:
+                    covars = tuple(self.get_kernel(kernel)(features).evaluate().cpu().numpy()
+                                   for kernel in ('all', 'traj', 'step'))
 
-            if torch.cuda.is_available():
-                obs = obs.cuda()
+                if self.weight_x:
+                    input_encoding = features.sum(-1)
+                    importance_all = self.likelihood.weight_encoder(input_encoding)
+                    importance_all = importance_all.reshape(importance_all.shape[0], self.likelihood.num_features,
+                                                            self.likelihood.num_classes)
+                else:
+                    importance_all = self.likelihood.mixing_weights
+                    importance_all = importance_all.transpose(1, 0)
 
-            step_embedding, traj_embedding = self.model.encoder(obs)  # (N, T, P) -> (N, T, D), (N, D).
-            traj_embedding = traj_embedding[:, None, :].repeat(1, obs.shape[1], 1)  # (N, D) -> (N, T, D)
-            features = torch.cat([step_embedding, traj_embedding], dim=-1)  # (N, T, 2D)
-            # features = features.view(obs.size(0) * obs.size(1), features.size(-1))
-            covar_all = self.model.gp_layer.covar_module(features)
-            covar_step = self.model.gp_layer.step_kernel(features)
-            covar_traj = self.model.gp_layer.traj_kernel(features)
+                importance_all = importance_all.cpu().numpy()
 
-            if self.weight_x:
-                input_encoding = features.sum(-1)
-                importance_all = self.likelihood.weight_encoder(input_encoding)
-                importance_all = importance_all.reshape(importance_all.shape[0], self.likelihood.num_features,
-                                                        self.likelihood.num_classes)
-            else:
-                importance_all = self.likelihood.mixing_weights
-                importance_all = importance_all.transpose(1, 0)
+                if len(importance_all.shape) == 2:
+                    importance_all = np.repeat(importance_all[None, ...], rewards.shape[0], axis=0)
 
-            importance_all = importance_all.cpu().detach().numpy()
+                if importance_all.shape[-1] > 1:
+                    importance = importance_all[list(range(rewards.shape[0])), :, rewards]
+                else:
+                    importance = np.squeeze(importance_all, -1)
 
-            if len(importance_all.shape) == 2:
-                importance_all = np.repeat(importance_all[None, ...], rewards.shape[0], axis=0)
+                if normalize:
+                    importance = (importance - np.min(importance, axis=1)[:, None]) \
+                                 / (np.max(importance, axis=1)[:, None] - np.min(importance, axis=1)[:, None] + 1e-16)
 
-            if importance_all.shape[-1] > 1:
-                importance = importance_all[list(range(rewards.shape[0])), :, rewards]
-            else:
-                importance = np.squeeze(importance_all, -1)
+                yield importance, covars, [int(reward) for reward in batch_rewards]
 
-            if batch == 0:
-                saliency_all = importance
-                covar_all_all = covar_all.numpy()[None, ...]
-                covar_step_all = covar_step.numpy()[None, ...]
-                covar_traj_all = covar_traj.numpy()[None, ...]
-            else:
-                saliency_all = np.vstack((saliency_all, importance))
-                covar_all_all = np.concatenate((covar_all_all, covar_all.numpy()[None, ...]))
-                covar_step_all = np.concatenate((covar_step_all, covar_all.numpy()[None, ...]))
-                covar_traj_all = np.concatenate((covar_traj_all, covar_all.numpy()[None, ...]))
+    def get_explanations_per_traj(self, exp_idx, batch_size, traj_path, normalize=True, compute_covar=False):
+        """
+        get explanation for each input traj
+        :param exp_idx: training traj index
+        :param batch_size: training batch size
+        :param traj_path: training traj path
+        :param normalize: normalize
+        :param compute_covar: also return the covariances, stacked per batch
+        :return: time step importance, (covar_all, covar_traj, covar_step), final rewards. Without compute_covar
+                 the covariances are empty arrays of shape (0, ), query them with get_covariance instead
+        """
 
-        if normalize:
-            saliency_all = (saliency_all - np.min(saliency_all, axis=1)[:, None]) \
-                         / (np.max(saliency_all, axis=1)[:, None] - np.min(saliency_all, axis=1)[:, None] + 1e-16)
+        n_batch = exp_idx.shape[0] // batch_size
+        saliency_all = None
+        covar_all = tuple(np.empty((0, )) for _ in range(3))
+        final_rewards = []
+
+        for batch, (importance, covars, rewards) in enumerate(
+                self.iter_explanations_per_traj(exp_idx, batch_size, traj_path, normalize, compute_covar)):
+            if batch == 0:
+                saliency_all = np.empty((n_batch * batch_size, ) + importance.shape[1:], dtype=importance.dtype)
+                if compute_covar:
+                    covar_all = tuple(np.empty((n_batch, ) + covar.shape, dtype=covar.dtype) for covar in covars)
 
-        return saliency_all, (covar_all_all, covar_traj_all, covar_step_all), final_rewards
+            saliency_all[batch * batch_size:(batch + 1) * batch_size] = importance
+            if compute_covar:
+                for covar_stack, covar in zip(covar_all, covars):
+                    covar_stack[batch] = covar
+            final_rewards += rewards
 
+        return saliency_all, covar_all, final_rewards
@@ -7,7 +7,8 @@ import numpy as np
 import torch.optim as optim
 from src.xstep import DGaussianModel, DGPModel
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
-from src.xfeat import MaskObsModel, elasticnet_loss, smoothness_loss, continuity_loss
+from src.xfeat import MaskObsModel, FusedObs, elasticnet_loss, smoothness_loss, continuity_loss
+from src.traj_io import load_batch, make_traj_loader
 from PIL import Image
 
 
@@ -15,7 +16,7 @@ class DGaussianStepFeatExp(object):
     def __init__(self, seq_len, input_dim, hiddens, input_channels, likelihood_type, lr, mask_shape, policy,
                  fused_choice='mean', temp=0.1, act_distribution='cat', encoder_type='MLP', dropout_rate=0.25,
                  num_class=None, rnn_cell_type='GRU', initializer='one', normalize_choice='sigmoid',
-                 upsampling_mode='nearest', epsilon=1e-10, normalize=False):
+                 upsampling_mode='nearest', epsilon=1e-10, normalize=False, noise_seed=None):
 
         """ reward prediction + feature explanation
         :param seq_len: trajectory length
@@ -38,6 +39,7 @@ class DGaussianStepFeatExp(object):
         :param upsampling_mode: upsampling mode ['nearest', 'bilinear']
         :param epsilon: same number to prevent numerical error
         :param normalize: whether to normalize the input
+        :param noise_seed: seed of the on-device generator of the concrete noise, None draws it with numpy on the host
         """
 
         self.seq_len = seq_len
@@ -47,10 +49,10 @@ class DGaussianStepFeatExp(object):
         self.temp = temp
         if encoder_type == 'CNN':
             self.mask_model = MaskObsModel(policy, act_distribution, (input_channels, input_dim, input_dim), mask_shape,
-                                           initializer, normalize_choice, upsampling_mode, epsilon)
+                                           initializer, normalize_choice, upsampling_mode, epsilon, noise_seed)
         else:
             self.mask_model = MaskObsModel(policy, act_distribution, (input_dim,), mask_shape, initializer,
-                                           normalize_choice, upsampling_mode, epsilon)
+                                           normalize_choice, upsampling_mode, epsilon, noise_seed)
 
         self.step_model = DGaussianModel(seq_len, input_dim, hiddens, input_channels, likelihood_type, encoder_type,
                                          dropout_rate, num_class, rnn_cell_type, normalize)
@@ -198,17 +200,9 @@ class DGaussianStepFeatExp(object):
                     batch_obs, batch_fused_obs, batch_acts, batch_hs, batch_cs = \
                         batch_obs.cuda(), batch_fused_obs.cuda(), batch_acts.cuda(), batch_hs.cuda(), batch_cs.cuda()
 
-                obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(batch_obs[0:1, ], batch_fused_obs[0:1],
-                                                                             (batch_hs[0], batch_cs[0]), temp)
-                for i in range(batch_obs.shape[0] - 1):
-                    obs_exp_tmp, obs_remain_tmp, acts_exp_tmp, acts_remain_tmp = \
-                        self.mask_model(batch_obs[i + 1:i + 2], batch_fused_obs[i + 1:i + 2],
-                                        (batch_hs[i + 1], batch_cs[i + 1]), temp)
-
-                    obs_exp = torch.cat((obs_exp, obs_exp_tmp))
-                    obs_remain = torch.cat((obs_remain, obs_remain_tmp))
-                    acts_exp = torch.cat((acts_exp, acts_exp_tmp))
-                    acts_remain = torch.cat((acts_remain, acts_remain_tmp))
+                # one concrete sample per observation and one policy forward for the whole mini-batch.
+                obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(batch_obs, batch_fused_obs,
+                                                                             (batch_hs, batch_cs), temp)
 
                 self.feat_optimizer.zero_grad()
 
@@ -288,29 +282,20 @@ class DGaussianStepFeatExp(object):
             rewards_all = []
 
             for batch in tqdm.tqdm(range(n_batch)):
-                batch_obs = []
-                batch_acts = []
-                batch_rewards = []
-                batch_hs = []
-                batch_cs = []
-
-                for idx in train_idx[batch * step_batch_size:min((batch + 1) * step_batch_size, train_idx.shape[0]), ]:
-                    batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                    batch_acts.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['actions'])
-                    batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
-                    batch_hs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['h'])
-                    batch_cs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['c'])
-
-                batch_obs_flatten = np.array(batch_obs)
+                batch_idx = train_idx[batch * step_batch_size:min((batch + 1) * step_batch_size, train_idx.shape[0]), ]
+                batch_obs, batch_acts, batch_rewards, batch_hs, batch_cs = \
+                    load_batch(traj_path, batch_idx, ('states', 'actions', 'final_rewards', 'h', 'c'))
+
+                batch_obs_flatten = np.asarray(batch_obs)
                 batch_obs_flatten = batch_obs_flatten.reshape(batch_sample_num, *batch_obs_flatten.shape[2:])
 
-                batch_acts = np.array(batch_acts)
+                batch_acts = np.asarray(batch_acts)
                 batch_acts = batch_acts.reshape(batch_sample_num, *batch_acts.shape[2:])
 
-                batch_hs = np.array(batch_hs)
+                batch_hs = np.asarray(batch_hs)
                 batch_hs = batch_hs.reshape(batch_sample_num, *batch_hs.shape[2:])
 
-                batch_cs = np.array(batch_cs)
+                batch_cs = np.asarray(batch_cs)
                 batch_cs = batch_cs.reshape(batch_sample_num, *batch_cs.shape[2:])
                 # for debugging
                 # batch_hs = np.zeros((batch_sample_num, 1, 256))
@@ -352,7 +337,7 @@ class DGaussianStepFeatExp(object):
                 batch_fused_obs = torch.tensor(batch_fused_obs, dtype=torch.float32)
                 batch_fused_obs_non_padding = torch.tensor(batch_fused_obs_non_padding, dtype=torch.float32)
 
-                obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+                obs = torch.tensor(np.asarray(batch_obs), dtype=torch.float32)
                 batch_obs_flatten = torch.tensor(batch_obs_flatten, dtype=torch.float32)
                 batch_obs_flatten_non_padding = torch.tensor(batch_obs_flatten_non_padding, dtype=torch.float32)
 
@@ -361,9 +346,9 @@ class DGaussianStepFeatExp(object):
                 cs = torch.tensor(batch_cs, dtype=torch.float32)
 
                 if self.step_model.likelihood_type == 'classification':
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                    rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.long)
                 else:
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                    rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.float32)
 
                 if torch.cuda.is_available():
                     obs, batch_obs_flatten, batch_obs_flatten_non_padding, batch_fused_obs, batch_fused_obs_non_padding = \
@@ -480,14 +465,10 @@ class DGaussianStepFeatExp(object):
         batch_sample_num = batch_size * self.seq_len
 
         for batch in range(n_batch):
-            batch_obs = []
-            batch_rewards = []
-
-            for idx in test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]:
-                batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
+            batch_idx = test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]
+            batch_obs, batch_rewards = load_batch(traj_path, batch_idx, ('states', 'final_rewards'))
 
-            obs_flatten = np.array(batch_obs)
+            obs_flatten = np.asarray(batch_obs)
             obs_flatten = obs_flatten.reshape(batch_sample_num, *obs_flatten.shape[2:])
 
             # todo: Support only one channel, add three channels support
@@ -516,13 +497,13 @@ class DGaussianStepFeatExp(object):
             else:
                 raise TypeError('Only support image or vector observation...')
 
-            obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
+            obs = torch.tensor(np.asarray(batch_obs), dtype=torch.float32)
             obs_flatten = torch.tensor(obs_flatten, dtype=torch.float32)
 
             if self.step_model.likelihood_type == 'classification':
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.long)
             else:
-                rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.float32)
 
             if torch.cuda.is_available():
                 obs, obs_flatten, fused_obs, rewards = obs.cuda(), obs_flatten.cuda(), fused_obs.cuda(), rewards.cuda()
@@ -597,7 +578,7 @@ class DGPStepFeatExp(object):
                  mask_shape, policy, num_inducing_points, temp=0.1, fused_choice='mean', act_distribution='cat',
                  encoder_type='MLP', dropout_rate=0.25, num_class=None, rnn_cell_type='GRU', normalize=False,
                  grid_bounds=None, initializer='one', normalize_choice='sigmoid', upsampling_mode='nearest',
-                 epsilon=1e-10):
+                 epsilon=1e-10, num_workers=0, pin_memory=False, prefetch_factor=2, noise_seed=None):
 
         """ reward prediction (DGP) + feature explanation
         :param train_len: number of training trajectory
@@ -622,6 +603,10 @@ class DGPStepFeatExp(object):
         :param normalize_choice: how to normalize the variable to between zero and one ['sigmoid', 'tanh', 'clip']
         :param upsampling_mode: upsampling mode ['nearest', 'bilinear']
         :param epsilon: same number to prevent numerical error
+        :param num_workers: number of processes loading the trajs in the background
+        :param pin_memory: load the trajs into pinned memory for faster host to device copies
+        :param prefetch_factor: number of batches loaded in advance by each loading process
+        :param noise_seed: seed of the on-device generator of the concrete noise, None draws it with numpy on the host
         """
 
         self.train_len = train_len
@@ -632,13 +617,16 @@ class DGPStepFeatExp(object):
         self.fused_choice = fused_choice
         self.policy = policy
         self.mask_shape = mask_shape
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
 
         if encoder_type == 'CNN':
             self.mask_model = MaskObsModel(policy, act_distribution, (input_channels, input_dim, input_dim), mask_shape,
-                                           initializer, normalize_choice, upsampling_mode, epsilon)
+                                           initializer, normalize_choice, upsampling_mode, epsilon, noise_seed)
         else:
             self.mask_model = MaskObsModel(policy, act_distribution, (input_dim,), mask_shape, initializer,
-                                           normalize_choice, upsampling_mode, epsilon)
+                                           normalize_choice, upsampling_mode, epsilon, noise_seed)
 
         self.step_model = DGPModel(seq_len, input_dim, hiddens, input_channels, likelihood_type, num_inducing_points,
                                    encoder_type, inducing_points=None, mean_inducing_points=None,
@@ -662,6 +650,9 @@ class DGPStepFeatExp(object):
             self.step_model = self.step_model.cuda()
             self.mask_model = self.mask_model.cuda()
 
+        self.fused_obs = FusedObs(fused_choice, self.mask_model.input_shape, self.mask_model.logit_p.device,
+                                  self.mask_model.noise_seed)
+
     def compute_feat_loss(self, acts_exp, acts_remain, acts, reg_choice, reg_coef_1, reg_coef_2, norm_choice='l2'):
         """
         compute mask prediction and regularization loss
@@ -756,6 +747,19 @@ class DGPStepFeatExp(object):
 
         return self.step_model, self.mask_model
 
+    def get_loader(self, traj_idx, batch_size, traj_path, fields=('states', 'final_rewards'), persistent_workers=False):
+        """
+        :param traj_idx: traj index
+        :param batch_size: batch size
+        :param traj_path: traj path
+        :param fields: names of the arrays to load
+        :param persistent_workers: keep the loading workers across epochs
+        :return: loader yielding one tensor per field
+        """
+        return make_traj_loader(traj_path, traj_idx, batch_size, fields, num_workers=self.num_workers,
+                                pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor,
+                                persistent_workers=persistent_workers)
+
     def train_mask(self, obs, fused_obs, acts, hs, cs, mask_batch_size, reg_choice, reg_coef_1, reg_coef_2, temp=0.1,
                    norm_choice='l2'):
             """
@@ -795,17 +799,9 @@ class DGPStepFeatExp(object):
                     batch_obs, batch_fused_obs, batch_acts, batch_hs, batch_cs = \
                         batch_obs.cuda(), batch_fused_obs.cuda(), batch_acts.cuda(), batch_hs.cuda(), batch_cs.cuda()
 
-                obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(batch_obs[0:1, ], batch_fused_obs[0:1],
-                                                                             (batch_hs[0], batch_cs[0]), temp)
-                for i in range(batch_obs.shape[0] - 1):
-                    obs_exp_tmp, obs_remain_tmp, acts_exp_tmp, acts_remain_tmp = \
-                        self.mask_model(batch_obs[i + 1:i + 2], batch_fused_obs[i + 1:i + 2],
-                                        (batch_hs[i + 1], batch_cs[i + 1]), temp)
-
-                    obs_exp = torch.cat((obs_exp, obs_exp_tmp))
-                    obs_remain = torch.cat((obs_remain, obs_remain_tmp))
-                    acts_exp = torch.cat((acts_exp, acts_exp_tmp))
-                    acts_remain = torch.cat((acts_remain, acts_remain_tmp))
+                # one concrete sample per observation and one policy forward for the whole mini-batch.
+                obs_exp, obs_remain, acts_exp, acts_remain = self.mask_model(batch_obs, batch_fused_obs,
+                                                                             (batch_hs, batch_cs), temp)
 
                 self.feat_optimizer.zero_grad()
 
@@ -855,11 +851,6 @@ class DGPStepFeatExp(object):
                                                               milestones=[0.5 * n_epoch, 0.75 * n_epoch],
                                                               gamma=decay_weight)
 
-        if train_idx.shape[0] % step_batch_size == 0:
-            n_batch = int(train_idx.shape[0] / step_batch_size)
-        else:
-            n_batch = int(train_idx.shape[0] / step_batch_size) + 1
-
         lambda_up_counter = 0
         lambda_down_counter = 0
 
@@ -868,6 +859,10 @@ class DGPStepFeatExp(object):
         best_model_iter = 0
 
         batch_sample_num = step_batch_size*self.seq_len
+        loader = self.get_loader(train_idx, step_batch_size, traj_path, ('states', 'actions', 'final_rewards'),
+                                 persistent_workers=True)
+        n_batch = len(loader)
+        self.fused_obs.fit(traj_path, train_idx)
 
         for epoch in range(1, n_epoch + 1):
             self.step_model.train()
@@ -886,26 +881,14 @@ class DGPStepFeatExp(object):
 
             with gpytorch.settings.use_toeplitz(False):
                 with gpytorch.settings.num_likelihood_samples(likelihood_sample_size):
-                    for batch in tqdm.tqdm(range(n_batch)):
-
-                        batch_obs = []
-                        batch_acts = []
-                        batch_rewards = []
-                        batch_hs = []
-                        batch_cs = []
-
-                        for idx in train_idx[
-                                   batch * step_batch_size:min((batch + 1) * step_batch_size, train_idx.shape[0]), ]:
-                            batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                            batch_acts.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['actions'])
-                            batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
-                            # batch_hs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['h'])
-                            # batch_cs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['c'])
-
-                        batch_obs_flatten = np.array(batch_obs)
+                    for batch_obs, batch_acts, batch_rewards in tqdm.tqdm(loader):
+                        batch_obs, batch_acts, batch_rewards = batch_obs.numpy(), batch_acts.numpy(), \
+                                                               batch_rewards.numpy()
+
+                        batch_obs_flatten = np.asarray(batch_obs)
                         batch_obs_flatten = batch_obs_flatten.reshape(batch_sample_num, *batch_obs_flatten.shape[2:])
 
-                        batch_acts = np.array(batch_acts)
+                        batch_acts = np.asarray(batch_acts)
                         batch_acts = batch_acts.reshape(batch_sample_num, *batch_acts.shape[2:])
 
                         # batch_hs = np.array(batch_hs)
@@ -925,60 +908,33 @@ class DGPStepFeatExp(object):
                         batch_hs = batch_hs[nonzero_idx,]
                         batch_cs = batch_cs[nonzero_idx,]
 
-                        # todo: Support only one channel, add three channels support
-                        # Generate fused images
-                        if len(batch_obs_flatten.shape) == 4:
-                            if self.fused_choice == 'mean':
-                                batch_fused_obs = np.mean(batch_obs_flatten, axis=0)[None, :, :, :].repeat(batch_sample_num, 0)
-                            elif self.fused_choice == 'random':
-                                batch_fused_obs = np.random.normal(loc=0, scale=0.1,
-                                                                   size=batch_obs_flatten.shape[1:])[None, :, :, :].repeat(
-                                    batch_sample_num, 0)
-                            elif self.fused_choice == 'blur':
-                                batch_fused_obs = cv2.GaussianBlur(batch_obs_flatten[:, :, :, :], (5, 5),
-                                                                   cv2.BORDER_DEFAULT)
-                            else:
-                                batch_fused_obs = np.zeros(batch_obs_flatten.shape[1:])[None, :, :, :].repeat(batch_sample_num, 0)
-                            # batch_fused_obs = batch_fused_obs[:, None, :, :]
-                        elif len(batch_obs_flatten.shape) == 2:
-                            if self.fused_choice == 'mean':
-                                batch_fused_obs = np.mean(batch_obs_flatten, axis=0)
-                            elif self.fused_choice == 'random':
-                                batch_fused_obs = np.random.normal(loc=0, scale=0.1, size=batch_obs_flatten.shape[1:])
-                            elif self.fused_choice == 'blur':
-                                raise TypeError("Non-image observation does not blur...")
-                            else:
-                                batch_fused_obs = np.zeros(batch_obs_flatten.shape[1:])
-                            batch_fused_obs = batch_fused_obs[None,].repeat(batch_sample_num, 0)
-                        else:
-                            raise TypeError('Only support image or vector observation...')
-                        batch_fused_obs_non_padding = batch_fused_obs[nonzero_idx,]
-
-                        batch_fused_obs = torch.tensor(batch_fused_obs, dtype=torch.float32)
-                        batch_fused_obs_non_padding = torch.tensor(batch_fused_obs_non_padding, dtype=torch.float32)
-
-                        obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
-                        batch_obs_flatten = torch.tensor(batch_obs_flatten, dtype=torch.float32)
-                        batch_obs_flatten_non_padding = torch.tensor(batch_obs_flatten_non_padding, dtype=torch.float32)
+                        # Observations stay uint8 until they are on the device.
+                        obs_shape = batch_obs.shape
+                        batch_obs_flatten = torch.as_tensor(batch_obs_flatten)
+                        batch_obs_flatten_non_padding = torch.as_tensor(batch_obs_flatten_non_padding)
 
                         acts = torch.tensor(batch_acts, dtype=torch.float32)
                         hs = torch.tensor(batch_hs, dtype=torch.float32)
                         cs = torch.tensor(batch_cs, dtype=torch.float32)
 
                         if self.step_model.likelihood_type == 'classification':
-                            rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                            rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.long)
                         else:
-                            rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                            rewards = torch.tensor(np.asarray(batch_rewards), dtype=torch.float32)
 
                         if torch.cuda.is_available():
-                            obs, batch_obs_flatten, batch_obs_flatten_non_padding = \
-                                obs.cuda(), batch_obs_flatten.cuda(), batch_obs_flatten_non_padding.cuda()
-
-                            batch_fused_obs, batch_fused_obs_non_padding = \
-                                batch_fused_obs.cuda(), batch_fused_obs_non_padding.cuda()
+                            batch_obs_flatten, batch_obs_flatten_non_padding = \
+                                batch_obs_flatten.cuda(), batch_obs_flatten_non_padding.cuda()
 
                             acts, rewards, hs, cs = acts.cuda(), rewards.cuda(), hs.cuda(), cs.cuda()
 
+                        batch_obs_flatten = batch_obs_flatten.float()
+                        batch_obs_flatten_non_padding = batch_obs_flatten_non_padding.float()
+
+                        # Broadcast views of the fused images, computed on the device.
+                        batch_fused_obs = self.fused_obs(batch_obs_flatten)
+                        batch_fused_obs_non_padding = self.fused_obs(batch_obs_flatten_non_padding)
+
                         loss_feat, loss_feat_exp_batch, loss_feat_reg_batch = \
                             self.train_mask(batch_obs_flatten_non_padding, batch_fused_obs_non_padding, acts, hs, cs,
                                             mask_batch_size, reg_choice, reg_coef_1, reg_coef_2, self.temp, norm_choice)
@@ -991,7 +947,7 @@ class DGPStepFeatExp(object):
                         obs_exp = self.mask_model(batch_obs_flatten, batch_fused_obs, temp=self.temp,
                                                   compute_obs_only=True)
 
-                        obs = obs_exp.reshape(obs.shape)
+                        obs = obs_exp.reshape(obs_shape)
                         output, features = self.step_model.model(obs)  # marginal variational posterior, q(f|x).
                         pred_loss_batch, pred_reg_loss_batch = self.compute_step_loss(output, rewards, features)
 
@@ -1092,67 +1048,24 @@ class DGPStepFeatExp(object):
         preds_all = []
         rewards_all = []
 
-        batch_sample_num = batch_size * self.seq_len
-
-        if test_idx.shape[0] % batch_size == 0:
-            n_batch = int(test_idx.shape[0] / batch_size)
-        else:
-            n_batch = int(test_idx.shape[0] / batch_size) + 1
+        if use_mask:
+            self.fused_obs.fit(traj_path, test_idx)
 
         with torch.no_grad(), gpytorch.settings.num_likelihood_samples(likelihood_sample_size):
-            for batch in range(n_batch):
-                batch_obs = []
-                batch_rewards = []
-
-                for idx in test_idx[batch * batch_size:min((batch + 1) * batch_size, test_idx.shape[0]), ]:
-                    batch_obs.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['states'])
-                    batch_rewards.append(np.load(traj_path + '_traj_' + str(idx) + '.npz')['final_rewards'])
-
-                obs_flatten = np.array(batch_obs)
-                obs_flatten = obs_flatten.reshape(batch_sample_num, *obs_flatten.shape[2:])
-
-                # todo: Support only one channel, add three channels support
-                # Generate fused images
-                if len(obs_flatten.shape) == 4:
-                    if self.fused_choice == 'mean':
-                        fused_obs = np.mean(obs_flatten, axis=0)[None, :, :, :].repeat(batch_sample_num, 0)
-                    elif self.fused_choice == 'random':
-                        fused_obs = np.random.normal(loc=0, scale=0.1,
-                                                            size=obs_flatten.shape[1:])[None, :, :, :].repeat(
-                            batch_sample_num, 0)
-                    elif self.fused_choice == 'blur':
-                        fused_obs = cv2.GaussianBlur(obs_flatten[:, :, :, :], (5, 5),
-                                                            cv2.BORDER_DEFAULT)
-                    else:
-                        fused_obs = np.zeros(obs_flatten.shape[1:])[None, :, :, :].repeat(batch_sample_num, 0)
-                elif len(obs_flatten.shape) == 2:
-                    if self.fused_choice == 'mean':
-                        fused_obs = np.mean(obs_flatten, axis=0)
-                    elif self.fused_choice == 'random':
-                        fused_obs = np.random.normal(loc=0, scale=0.1, size=obs_flatten.shape[1:])
-                    elif self.fused_choice == 'blur':
-                        raise TypeError("Non-image observation does not blur...")
-                    else:
-                        fused_obs = np.zeros(obs_flatten.shape[1:])
-                    fused_obs = fused_obs[None,].repeat(batch_sample_num, 0)
-                else:
-                    raise TypeError('Only support image or vector observation...')
-
-                obs = torch.tensor(np.array(batch_obs), dtype=torch.float32)
-                obs_flatten = torch.tensor(obs_flatten, dtype=torch.float32)
-                fused_obs = torch.tensor(fused_obs, dtype=torch.float32)
-
+            for obs, batch_rewards in self.get_loader(test_idx, batch_size, traj_path):
+                # Observations stay uint8 until they are on the device.
                 if self.step_model.likelihood_type == 'classification':
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.long)
+                    rewards = batch_rewards.long()
                 else:
-                    rewards = torch.tensor(np.array(batch_rewards), dtype=torch.float32)
+                    rewards = batch_rewards.float()
 
                 if torch.cuda.is_available():
-                    obs, obs_flatten, fused_obs, rewards = obs.cuda(), obs_flatten.cuda(), \
-                                                           fused_obs.cuda(), rewards.cuda()
+                    obs, rewards = obs.cuda(), rewards.cuda()
 
                 if use_mask:
-                    obs_exp = self.mask_model(obs_flatten, fused_obs, temp=self.temp, compute_obs_only=True)
+                    obs_flatten = obs.reshape(-1, *obs.shape[2:]).float()
+                    obs_exp = self.mask_model(obs_flatten, self.fused_obs(obs_flatten), temp=self.temp,
+                                              compute_obs_only=True)
                     obs = obs_exp.reshape(obs.shape)
 
                 output, features = self.step_model.model(obs)  # marginal variational posterior, q(f|x).
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules are imported the way the scripts do (from src.x import ..., from utils import ...).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,77 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from src.embedding_cache import EmbeddingCache, cache_key, encoder_hash, parameter_version
+
+
+def test_hash_changes_with_the_parameters():
+    encoder = torch.nn.Linear(4, 3)
+    key = encoder_hash(encoder)
+    version = parameter_version(encoder)
+    assert encoder_hash(encoder) == key
+    assert parameter_version(encoder) == version
+
+    with torch.no_grad():
+        encoder.weight.add_(1.)
+    assert parameter_version(encoder) != version
+    assert encoder_hash(encoder) != key
+
+
+def test_hash_changes_with_load_state_dict():
+    encoder, other = torch.nn.Linear(4, 3), torch.nn.Linear(4, 3)
+    key, version = encoder_hash(encoder), parameter_version(encoder)
+    encoder.load_state_dict(other.state_dict())
+    assert parameter_version(encoder) != version
+    assert encoder_hash(encoder) == encoder_hash(other) != key
+
+
+def test_save_load(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), encoder_hash(torch.nn.Linear(4, 3)))
+    traj_path = os.path.join('trajs', 'pong')
+    step_embed, traj_embed = torch.randn(2, 5, 3), torch.randn(2, 3)
+    assert not cache.contains(traj_path, [3, 4])
+
+    cache.save(traj_path, [3, 4], step_embed, traj_embed)
+    assert cache.contains(traj_path, [3, 4])
+    assert sorted(os.listdir(cache.cache_dir)) == sorted(os.path.basename(cache.cache_file(traj_path, idx))
+                                                         for idx in (3, 4))
+    loaded_step, loaded_traj = cache.load(traj_path, [3, 4])
+    np.testing.assert_array_equal(loaded_step, step_embed.numpy())
+    np.testing.assert_array_equal(loaded_traj, traj_embed.numpy())
+
+
+def test_new_checkpoint_misses(tmp_path):
+    encoder = torch.nn.Linear(4, 3)
+    cache = EmbeddingCache(str(tmp_path), encoder_hash(encoder))
+    cache.save('pong', [0], torch.randn(1, 5, 3), torch.randn(1, 3))
+    with torch.no_grad():
+        encoder.bias.add_(1.)
+    assert not EmbeddingCache(str(tmp_path), encoder_hash(encoder)).contains('pong', [0])
+
+
+def test_precision_in_key(tmp_path):
+    key = encoder_hash(torch.nn.Linear(4, 3))
+    assert cache_key(key) == key
+    assert len({cache_key(key), cache_key(key, torch.bfloat16), cache_key(key, torch.float16)}) == 3
+
+    EmbeddingCache(str(tmp_path), cache_key(key)).save('pong', [0], torch.randn(1, 5, 3), torch.randn(1, 3))
+    assert not EmbeddingCache(str(tmp_path), cache_key(key, torch.bfloat16)).contains('pong', [0])
+
+
+def test_traj_paths_do_not_collide(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache'), 'key')
+    assert cache.cache_file(os.path.join('trajs', 'pong'), 0) != cache.cache_file('trajs_pong', 0)
+    assert cache.cache_file('pong', 0) == cache.cache_file(os.path.abspath('pong'), 0)
+
+
+def test_collecting_again_misses(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    np.save(traj_path + '_num_traj.npy', 3)
+    EmbeddingCache(str(tmp_path / 'cache'), 'key').save(traj_path, [0], torch.randn(1, 5, 3), torch.randn(1, 3))
+    assert EmbeddingCache(str(tmp_path / 'cache'), 'key').contains(traj_path, [0])
+
+    np.save(traj_path + '_num_traj.npy', 4)
+    assert not EmbeddingCache(str(tmp_path / 'cache'), 'key').contains(traj_path, [0])
@@ -0,0 +1,46 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from src.utils import CnnRnnEncoder
+
+SEQ_LEN, INPUT_DIM, CHANNELS, HIDDEN_DIM = 6, 32, 2, 8
+
+
+def build_encoder(normalize=False):
+    torch.manual_seed(0)
+    return CnnRnnEncoder(SEQ_LEN, INPUT_DIM, CHANNELS, HIDDEN_DIM, normalize=normalize).eval()
+
+
+def random_obs(num_traj):
+    return torch.randint(0, 256, (num_traj, SEQ_LEN, CHANNELS, INPUT_DIM, INPUT_DIM), dtype=torch.uint8)
+
+
+def test_full_length_packed_matches_dense():
+    encoder = build_encoder()
+    obs = random_obs(3)
+    with torch.no_grad():
+        dense_step, dense_traj = encoder(obs)
+        packed_step, packed_traj = encoder(obs, torch.full((3, ), SEQ_LEN))
+    torch.testing.assert_close(packed_step, dense_step, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(packed_traj, dense_traj, rtol=1e-5, atol=1e-6)
+
+
+def test_padded_steps_are_skipped():
+    encoder = build_encoder()
+    lengths = torch.tensor([SEQ_LEN, 1, 4])
+    obs = random_obs(3)
+    with torch.no_grad():
+        step_embed, traj_embed = encoder(obs, lengths)
+        for i, length in enumerate(lengths.tolist()):
+            # the real frames of a left padded traj are its last ones, encoded alone.
+            real_obs = obs[i, SEQ_LEN - length:].float()
+            outputs, hidden = encoder.rnn(encoder.cnn_encoder(real_obs)[None])
+            torch.testing.assert_close(step_embed[i, SEQ_LEN - length:], outputs[0], rtol=1e-5, atol=1e-6)
+            assert torch.all(step_embed[i, :SEQ_LEN - length] == 0)
+            torch.testing.assert_close(traj_embed[i], encoder.traj_embed_layer(hidden[0, 0]), rtol=1e-5, atol=1e-6)
+
+
+def test_packed_rejects_normalize():
+    with pytest.raises(ValueError):
+        build_encoder(normalize=True)(random_obs(1), torch.full((1, ), SEQ_LEN))
@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+for module in ('torch', 'stable_baselines3', 'yaml', 'PIL', 'ale_py'):
+    pytest.importorskip(module)
+gym = pytest.importorskip('gym')
+
+import utils
+
+ENV_NAME = 'ALE/Pong-v5'
+ACTIONS = np.random.RandomState(0).randint(0, 6, 200)
+
+
+def play(env_pool, seed):
+    env, obs = env_pool.reset(seed)
+    frames, rewards = [obs], []
+    for action in ACTIONS:
+        obs, reward, done, _ = env.step(action)
+        frames.append(obs)
+        rewards.append(reward)
+        if done:
+            break
+    env_pool.release(env)
+    return np.array(frames), np.array(rewards)
+
+
+@pytest.fixture
+def env_pools():
+    try:
+        pools = utils.EnvPool(ENV_NAME), utils.EnvPool(ENV_NAME, snapshot=True)
+        pools[0].release(pools[0].reset(0)[0])
+    except gym.error.Error as error:
+        pytest.skip('{} is not available: {}'.format(ENV_NAME, error))
+    yield pools
+    for pool in pools:
+        pool.close()
+
+
+def test_snapshot_matches_fresh_reset(env_pools):
+    fresh_pool, snapshot_pool = env_pools
+    expected = play(fresh_pool, 3)
+    first = play(snapshot_pool, 3)
+    assert 3 in snapshot_pool.snapshots
+    # the second episode of the seed is restored from the snapshot, after another seed moved the emulator.
+    play(snapshot_pool, 5)
+    replayed = play(snapshot_pool, 3)
+    for frames, rewards in (first, replayed):
+        np.testing.assert_array_equal(frames, expected[0])
+        np.testing.assert_array_equal(rewards, expected[1])
+
+
+def test_shared_pool():
+    assert utils.get_env_pool(ENV_NAME) is utils.get_env_pool(ENV_NAME)
+    assert utils.get_env_pool(ENV_NAME).snapshot
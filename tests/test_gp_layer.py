@@ -0,0 +1,80 @@
+import copy
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('gpytorch')
+
+from src.utils import GaussianProcessLayer
+
+STEP_DIM, TRAJ_DIM, NUM_INDUCING, SEQ_LEN = 3, 2, 8, 4
+
+
+def build_layer(predictive_covar='full', block_size=None):
+    torch.manual_seed(0)
+    inducing_points = torch.randn(NUM_INDUCING, STEP_DIM + TRAJ_DIM)
+    layer = GaussianProcessLayer(STEP_DIM, TRAJ_DIM, NUM_INDUCING, inducing_points, None, None, 'classification',
+                                 using_ngd=False, using_ksi=False, using_ciq=False, using_sor=False,
+                                 using_OrthogonallyDecouple=False, predictive_covar=predictive_covar,
+                                 block_size=block_size)
+    # move q(v) away from the prior, so that the (S - I) term is not zero.
+    variational_distribution = layer.variational_strategy._variational_distribution
+    with torch.no_grad():
+        variational_distribution.variational_mean.copy_(torch.randn(NUM_INDUCING))
+        variational_distribution.chol_variational_covar.copy_(torch.eye(NUM_INDUCING) +
+                                                              0.1 * torch.randn(NUM_INDUCING, NUM_INDUCING).tril())
+    return layer.eval()
+
+
+def test_inference_forward_matches_forward():
+    layer = build_layer()
+    x = torch.randn(2 * SEQ_LEN, STEP_DIM + TRAJ_DIM)
+    with torch.no_grad():
+        fast = layer(x)
+    with torch.enable_grad():
+        exact = layer(x)
+    torch.testing.assert_close(fast.mean, exact.mean.detach(), rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(fast.covariance_matrix, exact.covariance_matrix.detach(), rtol=1e-4, atol=1e-5)
+
+
+def test_inference_terms_cleared_by_load_state_dict():
+    layer, other = build_layer(), build_layer()
+    with torch.no_grad():
+        other.variational_strategy._variational_distribution.variational_mean.add_(1.)
+    x = torch.randn(SEQ_LEN, STEP_DIM + TRAJ_DIM)
+    with torch.no_grad():
+        layer(x)
+        layer.load_state_dict(other.state_dict())
+        torch.testing.assert_close(layer(x).mean, other(x).mean)
+
+
+@pytest.mark.parametrize('grad', [False, True])
+def test_block_and_diag_covariances_match_full(grad):
+    x = torch.randn(3 * SEQ_LEN, STEP_DIM + TRAJ_DIM)
+    with torch.set_grad_enabled(grad):
+        full = build_layer()(x).covariance_matrix.detach()
+        block = build_layer('block', SEQ_LEN)(x).covariance_matrix.detach()
+        diag = build_layer('diag')(x).covariance_matrix.detach()
+
+    block_mask = torch.block_diag(*[torch.ones(SEQ_LEN, SEQ_LEN)] * 3).bool()
+    torch.testing.assert_close(block[block_mask], full[block_mask], rtol=1e-4, atol=1e-5)
+    assert torch.all(block[~block_mask] == 0)
+    torch.testing.assert_close(torch.diagonal(diag), torch.diagonal(full), rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(diag, torch.diag(torch.diagonal(diag)))
+
+
+def test_deepcopy_clears_its_own_inference_terms():
+    layer, other = build_layer(), build_layer()
+    with torch.no_grad():
+        other.variational_strategy._variational_distribution.variational_mean.add_(1.)
+    x = torch.randn(SEQ_LEN, STEP_DIM + TRAJ_DIM)
+    with torch.no_grad():
+        layer(x)
+        layer_copy = copy.deepcopy(layer)
+        layer_copy(x)
+        layer_copy.load_state_dict(other.state_dict())
+        torch.testing.assert_close(layer_copy(x).mean, other(x).mean)
+
+
+def test_save_whole_model(tmp_path):
+    layer = build_layer()
+    torch.save(layer, str(tmp_path / 'layer.pt'))
@@ -0,0 +1,247 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+for module in ('gym', 'stable_baselines3', 'yaml', 'PIL'):
+    pytest.importorskip(module)
+
+import torch.nn.functional as F
+from torch.distributions import Categorical
+
+from ppo import AtariPolicy, PPO, RolloutBuffer, TensorRolloutBuffer, discounted_returns, gae_advantages, \
+    reverse_discount
+from utils import NNPolicy
+
+NUM_ACTIONS, NUM_STEPS, STATE_SHAPE = 6, 8, (4, 84, 84)
+
+
+def loop_returns(rewards, is_terminals, gamma):
+    """
+    Monte Carlo returns as the PPO update computed them before the vectorized scan
+    """
+    returns = []
+    discounted_reward = 0
+    for reward, is_terminal in zip(reversed(rewards), reversed(is_terminals)):
+        if is_terminal:
+            discounted_reward = 0
+        discounted_reward = reward + (gamma * discounted_reward)
+        returns.insert(0, discounted_reward)
+    return returns
+
+
+def loop_gae(rewards, values, is_terminals, gamma, gae_lambda):
+    advantages, last_advantage = [], 0
+    for t in reversed(range(len(rewards))):
+        not_terminal = 1 - float(is_terminals[t])
+        next_value = values[t + 1] if t + 1 < len(values) else 0
+        delta = rewards[t] + gamma * not_terminal * next_value - values[t]
+        last_advantage = delta + gamma * gae_lambda * not_terminal * last_advantage
+        advantages.insert(0, last_advantage)
+    return advantages
+
+
+def build_ppo(**kwargs):
+    """
+    Discrete PPO on Atari frames, two agents built with the same arguments start from the same weights
+    """
+    torch.manual_seed(0)
+    policy_model = NNPolicy(channels=4, num_actions=NUM_ACTIONS)
+    poisoned_policy = AtariPolicy(NNPolicy(channels=4, num_actions=NUM_ACTIONS))
+    return PPO(None, NUM_ACTIONS, 1e-3, 1e-3, 0.99, 3, 0.2, False, policy_model=policy_model,
+               poisoned_policy=poisoned_policy, **kwargs)
+
+
+def random_states(num_steps, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 256, (num_steps, 1) + STATE_SHAPE, generator=generator).float()
+
+
+def fill(agent, states, poisoned=None):
+    torch.manual_seed(1)
+    for step, state in enumerate(states):
+        if poisoned is None:
+            agent.select_action(state)
+        else:
+            agent.select_action(state, poisoned[step])
+        agent.buffer.add_outcome(float(step % 3 == 0), step % 4 == 3)
+
+
+def full_batch_update(agent, probs_poisoned_policy=None):
+    """
+    The update before the minibatches: K_epochs full batch steps on the normalized Monte Carlo returns, with the KL
+    to the poisoned policy averaged over all the stored steps
+    """
+    states, actions, old_logprobs, rewards, is_terminals = agent.buffer.get(agent.device)[:5]
+    states = agent.prepare(states)
+    returns = discounted_returns(torch.as_tensor(np.asarray(rewards, dtype=np.float32)),
+                                 torch.as_tensor(np.asarray(is_terminals, dtype=bool)), agent.gamma)
+    returns = (returns - returns.mean()) / (returns.std() + 1e-7)
+    for _ in range(agent.K_epochs):
+        probs = agent.policy.actor(states)
+        dist = Categorical(probs)
+        state_values = agent.policy.critic(states).reshape(-1)
+        ratios = torch.exp(dist.log_prob(actions) - old_logprobs)
+        advantages = returns - state_values.detach()
+        surr1 = ratios * advantages
+        surr2 = torch.clamp(ratios, 1 - agent.eps_clip, 1 + agent.eps_clip) * advantages
+        loss = -torch.min(surr1, surr2) + 0.5 * F.mse_loss(state_values, returns) - 0.01 * dist.entropy()
+        if probs_poisoned_policy is not None:
+            loss = loss + 0.01 * F.kl_div(torch.log(probs + 1e-9), probs_poisoned_policy, reduction='mean')
+        agent.optimizer.zero_grad()
+        loss.mean().backward()
+        agent.optimizer.step()
+    agent.buffer.clear()
+
+
+def assert_same_weights(module, expected):
+    for param, expected_param in zip(module.parameters(), expected.parameters()):
+        torch.testing.assert_close(param, expected_param)
+
+
+def test_tensor_buffer_matches_list_buffer():
+    states = random_states(NUM_STEPS)
+    torch.manual_seed(0)
+    actions = torch.randint(0, NUM_ACTIONS, (NUM_STEPS, 1))
+    logprobs = torch.randn(NUM_STEPS, 1)
+    list_buffer, tensor_buffer = RolloutBuffer(), TensorRolloutBuffer(NUM_STEPS, STATE_SHAPE)
+    for step in range(NUM_STEPS):
+        for buffer in (list_buffer, tensor_buffer):
+            buffer.add(states[step], actions[step], logprobs[step])
+            buffer.add_outcome(float(step % 3 == 0), step % 4 == 3)
+
+    expected = list_buffer.get(torch.device('cpu'))
+    got = tensor_buffer.get(torch.device('cpu'))
+    assert len(tensor_buffer) == NUM_STEPS
+    assert got[0].dtype == torch.uint8
+    torch.testing.assert_close(got[0].float(), expected[0])
+    torch.testing.assert_close(got[1], expected[1])
+    torch.testing.assert_close(got[2], expected[2])
+    np.testing.assert_array_equal(got[3], expected[3])
+    np.testing.assert_array_equal(got[4], expected[4])
+
+
+def test_state_transform_applied_to_raw_frames():
+    mask = torch.ones(STATE_SHAPE)
+    mask[:, :10, :10] = 0
+    agent = build_ppo(buffer_size=NUM_STEPS, state_transform=lambda state: state * mask)
+    states = random_states(NUM_STEPS)
+    fill(agent, states)
+    buffer_states = agent.buffer.get(agent.device)[0]
+    # the buffer keeps the unmasked frames, the mask is applied by prepare when they are read.
+    assert buffer_states.dtype == torch.uint8
+    torch.testing.assert_close(buffer_states.float(), states[:, 0])
+    idx = torch.tensor([5, 1, 2])
+    torch.testing.assert_close(agent.prepare(buffer_states[idx]), states[idx, 0] * mask)
+
+
+def test_tensor_buffer_raises_when_full():
+    buffer = TensorRolloutBuffer(2, STATE_SHAPE)
+    for _ in range(2):
+        buffer.add(torch.zeros(STATE_SHAPE), torch.zeros(1, dtype=torch.int64), torch.zeros(1))
+        buffer.add_outcome(0., False)
+    with pytest.raises(ValueError):
+        buffer.add(torch.zeros(STATE_SHAPE), torch.zeros(1, dtype=torch.int64), torch.zeros(1))
+    with pytest.raises(ValueError):
+        buffer.add_outcome(0., False)
+    buffer.clear()
+    buffer.add(torch.zeros(STATE_SHAPE), torch.zeros(1, dtype=torch.int64), torch.zeros(1))
+    assert len(buffer) == 1
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 64, 1000])
+def test_discounted_returns_match_loop(n):
+    rng = np.random.RandomState(n)
+    rewards, is_terminals = rng.randn(n), rng.rand(n) < 0.05
+    returns = discounted_returns(torch.as_tensor(rewards), torch.as_tensor(is_terminals), 0.99)
+    np.testing.assert_allclose(returns.numpy(), loop_returns(rewards, is_terminals, 0.99), rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('n', [1, 5, 300])
+def test_gae_matches_loop(n):
+    rng = np.random.RandomState(n)
+    rewards, values, is_terminals = rng.randn(n), rng.randn(n), rng.rand(n) < 0.1
+    advantages = gae_advantages(torch.as_tensor(rewards), torch.as_tensor(values), torch.as_tensor(is_terminals),
+                                0.99, 0.95)
+    np.testing.assert_allclose(advantages.numpy(), loop_gae(rewards, values, is_terminals, 0.99, 0.95),
+                               rtol=1e-10, atol=1e-10)
+
+
+def test_reverse_discount_keeps_inputs():
+    x, coefs = torch.ones(5), torch.full((5, ), 0.5)
+    y = reverse_discount(x, coefs)
+    assert torch.equal(x, torch.ones(5)) and torch.equal(coefs, torch.full((5, ), 0.5))
+    torch.testing.assert_close(y, torch.tensor([1.9375, 1.875, 1.75, 1.5, 1.]))
+
+
+def test_full_batch_update_matches_old_update():
+    agent, reference = build_ppo(buffer_size=NUM_STEPS), build_ppo(buffer_size=NUM_STEPS)
+    states = random_states(NUM_STEPS)
+    fill(agent, states)
+    fill(reference, states)
+    agent.update(False, states[-1])
+    full_batch_update(reference)
+    assert_same_weights(agent.policy, reference.policy)
+    assert_same_weights(agent.policy_old, reference.policy)
+    assert len(agent.buffer) == 0
+
+
+def test_update_stops_early_past_target_kl(monkeypatch, capsys):
+    agent = build_ppo(buffer_size=NUM_STEPS, minibatch_size=2, target_kl=1e-12)
+    states = random_states(NUM_STEPS)
+    fill(agent, states)
+    steps = []
+    optimizer_step = agent.optimizer.step
+    monkeypatch.setattr(agent.optimizer, 'step', lambda *args: steps.append(1) or optimizer_step(*args))
+    agent.update(False, states[-1])
+    # the first minibatch is still on the old policy, the second one is past the KL after a single step.
+    assert len(steps) == 1
+    assert 'Early stopping' in capsys.readouterr().out
+    assert len(agent.buffer) == 0
+
+
+def test_poisoned_probs_in_chunks():
+    agent = build_ppo(buffer_size=NUM_STEPS)
+    states = random_states(5)[:, 0].to(torch.uint8)
+    with torch.no_grad():
+        expected = agent.policy.poisoned_policy[0](states.float())
+    torch.testing.assert_close(agent.policy.poisoned_probs(states, chunk_size=2), expected)
+
+
+def test_kl_weights_skip_poisoned_steps():
+    agent = build_ppo(buffer_size=NUM_STEPS, kl_regularize=True, kl_per_step=True)
+    reference = build_ppo(buffer_size=NUM_STEPS)
+    states = random_states(NUM_STEPS)
+    fill(agent, states, poisoned=[True] * NUM_STEPS)
+    fill(reference, states)
+    agent.update(False, states[-1])
+    full_batch_update(reference)
+    assert_same_weights(agent.policy, reference.policy)
+
+
+def test_kl_weights_average_clean_steps():
+    agent = build_ppo(buffer_size=NUM_STEPS, kl_regularize=True, kl_per_step=True)
+    reference = build_ppo(buffer_size=NUM_STEPS)
+    states = random_states(NUM_STEPS)
+    fill(agent, states, poisoned=[False] * NUM_STEPS)
+    fill(reference, states)
+    agent.update(False, states[-1])
+    with torch.no_grad():
+        probs_poisoned_policy = reference.policy.poisoned_policy[0](states[:, 0])
+    full_batch_update(reference, probs_poisoned_policy)
+    assert_same_weights(agent.policy, reference.policy)
+
+
+def test_shared_trunk_single_conv_pass(tmp_path):
+    agent = build_ppo(buffer_size=NUM_STEPS, shared_trunk=True)
+    calls = []
+    agent.policy.actor.model.conv1.register_forward_hook(lambda *args: calls.append(1))
+    states = random_states(4)[:, 0]
+    logprobs, state_values, dist_entropy, probs = agent.policy.evaluate(states, torch.zeros(4, dtype=torch.int64))
+    assert len(calls) == 1
+    assert state_values.shape == (4, 1)
+
+    agent.save_policy(str(tmp_path / 'policy.pt'))
+    policy = NNPolicy(channels=4, num_actions=NUM_ACTIONS)
+    policy.load_state_dict(torch.load(str(tmp_path / 'policy.pt')))
+    with torch.no_grad():
+        torch.testing.assert_close(AtariPolicy(policy)(states), probs - 1e-9)
@@ -0,0 +1,98 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+for module in ('torch', 'gym', 'stable_baselines3', 'yaml', 'PIL'):
+    pytest.importorskip(module)
+
+import utils
+from src import traj_io
+from src.traj_io import load_batch, load_traj, open_store
+
+MAX_EP_LEN = 6
+
+
+class FakeEnvPool(object):
+    def __init__(self, env_name, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_rollout_episode(model, env_pool, seed, max_ep_len=1e3, render=False):
+    """
+    Deterministic traj of a seed, every third seed ends without reward and is dropped
+    """
+    if seed % 3 == 1:
+        return None
+    rng = np.random.RandomState(seed)
+    return dict(observations=rng.rand(int(max_ep_len), 2), actions=rng.randint(1, 7, int(max_ep_len)),
+                values=rng.rand(int(max_ep_len)), states=rng.rand(int(max_ep_len), 1, 4, 4).astype(np.float32),
+                rewards=rng.rand(int(max_ep_len)), final_rewards=np.int32(seed % 2), seed=seed)
+
+
+@pytest.fixture(autouse=True)
+def fake_env(monkeypatch):
+    monkeypatch.setattr(utils, 'EnvPool', FakeEnvPool)
+    monkeypatch.setattr(utils, 'rollout_episode', fake_rollout_episode)
+    traj_io._stores.clear()
+    yield
+    traj_io._stores.clear()
+
+
+def run_chunks(save_path, num_traj, num_workers):
+    """
+    rollout_parallel without the process pool, the workers run in the test process
+    """
+    chunks = [chunk for chunk in np.array_split(np.arange(num_traj), num_workers) if chunk.shape[0] > 0]
+    chunk_paths = [utils._chunk_store_path(save_path, chunk) for chunk in chunks]
+    kept = [utils._rollout_worker(None, 'pong', chunk, MAX_EP_LEN, chunk_path)
+            for chunk, chunk_path in zip(chunks, chunk_paths)]
+    utils._merge_chunk_stores(save_path, chunk_paths, kept)
+    for chunk_path in chunk_paths:
+        utils._remove_store(chunk_path)
+    return sum(len(seeds) for seeds in kept)
+
+
+@pytest.mark.parametrize('num_workers', [1, 3, 20])
+def test_parallel_numbering_matches_rollout(tmp_path, num_workers):
+    num_traj = 11
+    utils.rollout(None, 'pong', num_traj, MAX_EP_LEN, save_path=str(tmp_path / 'seq'))
+    traj_count = run_chunks(str(tmp_path / 'par'), num_traj, num_workers)
+    assert traj_count == int(np.load(str(tmp_path / 'seq') + '_num_traj.npy'))
+
+    store = open_store(str(tmp_path / 'par'))
+    for idx in range(traj_count):
+        expected = load_traj(str(tmp_path / 'seq'), idx, traj_io.STORE_FIELDS.values())
+        for field, value in zip(traj_io.STORE_FIELDS, expected):
+            np.testing.assert_array_equal(store[field][idx], value)
+    assert not any('_chunk_' in path.name for path in tmp_path.iterdir())
+
+
+def test_parallel_metadata(tmp_path):
+    save_path = str(tmp_path / 'pong')
+    chunk_path = utils._chunk_store_path(save_path, [0])
+    kept = utils._rollout_worker(None, 'pong', np.arange(3), MAX_EP_LEN, chunk_path)
+    store = utils._merge_chunk_stores(save_path, [chunk_path], [kept])
+    assert kept == [0, 2]
+    assert len(store) == 2
+    states, seeds = load_batch(save_path, [0, 1], ('states', 'seeds'))
+    assert states.dtype == np.float32
+    np.testing.assert_array_equal(seeds, [0, 2])
+
+
+def test_parallel_no_traj(tmp_path):
+    assert utils._merge_chunk_stores(str(tmp_path / 'pong'), [], []) is None
+    with pytest.raises(ValueError):
+        utils.rollout_parallel(None, 'pong', 4, MAX_EP_LEN, save_path=str(tmp_path / 'pong'), num_workers=0)
+    utils.rollout_parallel(None, 'pong', 0, MAX_EP_LEN, save_path=str(tmp_path / 'pong'), num_workers=2)
+    assert int(np.load(str(tmp_path / 'pong') + '_num_traj.npy')) == 0
+    assert open_store(str(tmp_path / 'pong')) is None
+
+
+def test_load_batch_reads_both_layouts(tmp_path):
+    utils.rollout(None, 'pong', 7, MAX_EP_LEN, save_path=str(tmp_path / 'seq'))
+    traj_count = run_chunks(str(tmp_path / 'par'), 7, 2)
+    for seq, par in zip(load_batch(str(tmp_path / 'seq'), range(traj_count), ('actions', 'seeds')),
+                        load_batch(str(tmp_path / 'par'), range(traj_count), ('actions', 'seeds'))):
+        np.testing.assert_array_equal(seq, par)
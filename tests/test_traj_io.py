@@ -0,0 +1,93 @@
+import os
+import time
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+from src import traj_io
+from src.traj_io import TrajStore, convert_to_store, load_batch, open_store, num_traj_file
+
+
+def save_trajs(traj_path, states, seed=0):
+    rng = np.random.RandomState(seed)
+    for idx, traj_states in enumerate(states):
+        np.savez_compressed(traj_io.traj_file(traj_path, idx), states=traj_states,
+                            actions=rng.randint(0, 7, size=traj_states.shape[0]),
+                            final_rewards=np.int32(rng.randint(0, 2)), seed=idx)
+    np.save(num_traj_file(traj_path), len(states))
+
+
+@pytest.fixture(autouse=True)
+def clear_stores():
+    traj_io._stores.clear()
+    yield
+    traj_io._stores.clear()
+
+
+def test_store_round_trip(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    states = np.random.RandomState(0).randint(0, 256, size=(5, 10, 4, 8, 8)).astype(np.int64)
+    save_trajs(traj_path, states)
+
+    store = convert_to_store(traj_path)
+    assert store['states'].dtype == np.uint8
+
+    batch_idx = [1, 2, 4]
+    expected = [traj_io.load_traj(traj_path, idx, ('states', 'actions', 'final_rewards', 'seed'))
+                for idx in batch_idx]
+    for field, column in zip(('states', 'actions', 'final_rewards', 'seeds'),
+                             load_batch(traj_path, batch_idx, ('states', 'actions', 'final_rewards', 'seeds'))):
+        key = traj_io.STORE_FIELDS[field]
+        pos = ('states', 'actions', 'final_rewards', 'seed').index(key)
+        np.testing.assert_array_equal(column, np.array([traj[pos] for traj in expected]))
+
+
+def test_float_states_keep_their_dtype(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    states = np.random.RandomState(0).rand(3, 10, 1, 8, 8).astype(np.float32)
+    save_trajs(traj_path, states)
+
+    store = convert_to_store(traj_path)
+    assert store['states'].dtype == np.float32
+    np.testing.assert_array_equal(load_batch(traj_path, [0, 1, 2], ('states', ))[0], states)
+
+
+def test_out_of_range_states_raise(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    states = np.zeros((2, 10, 4, 8, 8), dtype=np.int64)
+    states[1, 0, 0, 0, 0] = 300
+    save_trajs(traj_path, states)
+
+    with pytest.raises(ValueError):
+        convert_to_store(traj_path)
+
+
+def test_stale_store_falls_back_to_npz(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    rng = np.random.RandomState(0)
+    save_trajs(traj_path, rng.randint(0, 256, size=(3, 10, 4, 8, 8)))
+    convert_to_store(traj_path)
+    assert not TrajStore(traj_path).is_stale()
+    assert open_store(traj_path) is not None
+
+    # collect again, with more trajs, in the same process: the cached store must not be served.
+    time.sleep(0.01)
+    new_states = rng.randint(0, 256, size=(4, 10, 4, 8, 8))
+    save_trajs(traj_path, new_states, seed=1)
+    os.utime(num_traj_file(traj_path), (time.time() + 1, time.time() + 1))
+
+    assert TrajStore(traj_path).is_stale()
+    assert open_store(traj_path) is None
+    np.testing.assert_array_equal(load_batch(traj_path, [3], ('states', ))[0], new_states[3:])
+
+
+def test_store_without_source_is_never_stale(tmp_path):
+    traj_path = str(tmp_path / 'pong')
+    store = TrajStore.create(traj_path, 2, {'states': ((3, ), np.uint8)})
+    store.write(1, states=np.arange(3))
+    store.flush()
+    np.save(num_traj_file(traj_path), 5)
+
+    assert open_store(traj_path) is not None
+    np.testing.assert_array_equal(load_batch(traj_path, [1], ('states', ))[0], [[0, 1, 2]])
@@ -0,0 +1,81 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+for module in ('numpy', 'cv2', 'tqdm'):
+    pytest.importorskip(module)
+
+from src import xfeat
+from src.xfeat import MaskFeatExp
+
+INPUT_SHAPE, MASK_SHAPE, NUM_ACTIONS, BATCH_SIZE = [1, 8, 8], [1, 4, 4], 4, 5
+
+
+class QueuedNoise(object):
+    def __init__(self, num_samples):
+        """
+        Stand-in for concrete_transformation handing out a fixed sequence of samples, so that a batched call and a
+        loop of one-row calls get the same mask for every row
+        """
+        torch.manual_seed(1)
+        self.noise = torch.rand(num_samples, *INPUT_SHAPE)
+        self.pos = 0
+
+    def __call__(self, theta, batch_size, *args, **kwargs):
+        rows = self.noise[self.pos:self.pos + batch_size]
+        self.pos += batch_size
+        return theta[None] * rows
+
+
+class LoopMaskModel(object):
+    def __init__(self, mask_model):
+        """
+        The mask model called one sample at a time, as compute_loss did before it was batched
+        """
+        self.mask_model = mask_model
+        self.logit_p = mask_model.logit_p
+        self.act_distribution = mask_model.act_distribution
+
+    def __call__(self, obs, fused_obs, hidden=None, temp=0.1):
+        outputs = [self.mask_model(obs[i:i + 1], fused_obs[i:i + 1], None, temp) for i in range(obs.shape[0])]
+        return tuple(torch.cat(output) for output in zip(*outputs))
+
+
+def build_explainer(act_distribution):
+    torch.manual_seed(0)
+    policy = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(8 * 8, NUM_ACTIONS))
+    explainer = MaskFeatExp(policy, act_distribution, INPUT_SHAPE, MASK_SHAPE, lr=0.01, initializer='normal')
+    explainer.mask_model.cpu()
+    explainer.mask_model.policy.cpu()
+    return explainer
+
+
+def loss_and_grad(explainer, obs, fused_obs, acts, norm_choice):
+    explainer.mask_model.logit_p.grad = None
+    losses = explainer.compute_loss(obs, fused_obs, acts, 'elasticnet', 0.01, 0.001, temp=0.1,
+                                    norm_choice=norm_choice)
+    losses[0].backward()
+    return [loss.detach() for loss in losses], explainer.mask_model.logit_p.grad.clone()
+
+
+@pytest.mark.parametrize('act_distribution, norm_choice', [('cat', 'l2'), ('normal', 'l2'), ('normal', 'l1'),
+                                                           ('normal', 'inf')])
+def test_batched_loss_matches_loop(monkeypatch, act_distribution, norm_choice):
+    torch.manual_seed(2)
+    obs = torch.rand(BATCH_SIZE, *INPUT_SHAPE)
+    fused_obs = torch.zeros(BATCH_SIZE, *INPUT_SHAPE)
+    if act_distribution == 'cat':
+        acts = torch.randint(1, NUM_ACTIONS + 1, (BATCH_SIZE, ))
+    else:
+        acts = torch.randn(BATCH_SIZE, NUM_ACTIONS)
+
+    explainer = build_explainer(act_distribution)
+    monkeypatch.setattr(xfeat, 'concrete_transformation', QueuedNoise(BATCH_SIZE))
+    batched_losses, batched_grad = loss_and_grad(explainer, obs, fused_obs, acts, norm_choice)
+
+    monkeypatch.setattr(xfeat, 'concrete_transformation', QueuedNoise(BATCH_SIZE))
+    explainer.mask_model = LoopMaskModel(explainer.mask_model)
+    loop_losses, loop_grad = loss_and_grad(explainer, obs, fused_obs, acts, norm_choice)
+
+    for batched, loop in zip(batched_losses, loop_losses):
+        torch.testing.assert_close(batched, loop, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(batched_grad, loop_grad, rtol=1e-5, atol=1e-6)
@@ -1,3 +1,4 @@
+import os
 import gym
 import sys
 import glob
@@ -6,6 +7,7 @@ import numpy as np
 import torch.nn as nn
 from PIL import Image
 import argparse
+import multiprocessing
 from pathlib import Path
 from datetime import datetime
 from urllib.request import urlopen
@@ -20,6 +22,8 @@ import yaml
 import torch.nn.functional as F
 from torch.autograd import Variable
 
+from src.traj_io import STORE_FIELDS, TrajStore, num_traj_file, store_file, store_meta_file
+
 # prepro = lambda img: imresize(img[35:195].mean(2), (80,80)).astype(np.float32).reshape(1,80,80)/255.
 
 
@@ -130,14 +134,16 @@ class NNPolicy(torch.nn.Module): # an actor-critic neural network
         self.fc3 = nn.Linear(in_features=2592, out_features=256)
         self.fc4 = nn.Linear(in_features=256, out_features=num_actions)
 
-    def forward(self, x):
+    def features(self, x):
         out = x * 1.0 / 255.0
         out = F.relu(self.conv1(out))
         out = F.relu(self.conv2(out))
         out = F.relu(self.fc3(out.transpose(1, 2).transpose(2, 3).flatten(start_dim=1)))
-        out = self.fc4(out)
         return out
 
+    def forward(self, x):
+        return self.fc4(self.features(x))
+
     def try_load(self, save_dir, checkpoint='*.tar'):
         paths = glob.glob(save_dir + checkpoint) ; step = 0
         if len(paths) > 0:
@@ -166,110 +172,294 @@ class NNPolicyCritic(torch.nn.Module): # an actor-critic neural network
         return out
 
 
+class EnvPool(object):
+    def __init__(self, env_name, frameskip=3, snapshot=False):
+        """
+        Warm envs of one game, reset by seed instead of being built with gym.make for every episode
+        :param env_name: env name
+        :param frameskip: frameskip of the envs
+        :param snapshot: cache the emulator state (with its rng) and the first obs after each seeded reset, later
+                         resets with the same seed restore them instead of reseeding (which reloads the ROM)
+        """
+        self.env_name = env_name
+        self.frameskip = frameskip
+        self.snapshot = snapshot
+        self.idle = []
+        self.snapshots = {}
+
+    def reset(self, seed):
+        """
+        :param seed: episode seed
+        :return: an env reset with the seed, its first obs
+        """
+        if self.idle:
+            env = self.idle.pop()
+        else:
+            env = gym.make(self.env_name)
+            env.env.frameskip = self.frameskip
+
+        ale = env.unwrapped.ale
+        if seed in self.snapshots:
+            state, obs = self.snapshots[seed]
+            # reset first, so that the wrappers (e.g. the TimeLimit step counter) start a new episode as well.
+            env.reset()
+            ale.restoreState(state)
+            return env, obs.copy()
+
+        env.seed(seed)
+        obs = env.reset()
+        if self.snapshot:
+            # with the rng, so that the sticky actions replay the same way as after reseeding.
+            self.snapshots[seed] = (ale.cloneState(include_rng=True), obs.copy())
+        return env, obs
+
+    def release(self, env):
+        """
+        Give an env back to the pool
+        """
+        self.idle.append(env)
+
+    def close(self):
+        for env in self.idle:
+            env.close()
+        self.idle = []
+        self.snapshots = {}
+
+
+_env_pools = {}
+
+
+def get_env_pool(env_name):
+    """
+    :param env_name: env name
+    :return: the EnvPool with snapshots of the env, shared by all the replays of the process
+    """
+    if env_name not in _env_pools:
+        _env_pools[env_name] = EnvPool(env_name, snapshot=True)
+    return _env_pools[env_name]
+
+
+def rollout_episode(model, env_pool, seed, max_ep_len=1e3, render=False):
+    """
+    Play one episode from a seed
+    :param model: policy
+    :param env_pool: EnvPool providing the env
+    :param seed: episode seed
+    :param max_ep_len: maximum (padded) traj length
+    :param render: render the env
+    :return: the arrays saved for the traj, None if the episode ends without reward
+    """
+    env, obs_0 = env_pool.reset(seed)
+    cur_obs, cur_states, cur_acts, cur_rewards, cur_values = [], [], [], [], []
+    state = torch.tensor(prepro(obs_0))  # get first state
+    episode_length, epr, eploss, done = 0, 0, 0, False  # bookkeeping
+    hx, cx = Variable(torch.zeros(1, 256)), Variable(torch.zeros(1, 256))
+
+    while not done and episode_length < max_ep_len:
+        value, logit, (hx, cx) = model((Variable(state.view(1, 1, 80, 80)), (hx, cx)))
+        hx, cx = Variable(hx.data), Variable(cx.data)
+        prob = F.softmax(logit, dim=-1)
+
+        action = prob.max(1)[1].data  # prob.multinomial().data[0] #
+        obs, reward, done, expert_policy = env.step(action.numpy()[0])
+        if env.env.game == 'pong':
+            done = reward
+        if render: env.render()
+        state = torch.tensor(prepro(obs))
+        epr += reward
+
+        # save info!
+        cur_obs.append(obs)
+        cur_states.append(state.detach().numpy())
+        cur_acts.append(action.numpy()[0])
+        cur_rewards.append(reward)
+        cur_values.append(value.detach().numpy()[0,0])
+        episode_length += 1
+    env_pool.release(env)
+
+    print('step # {}, reward {:.0f}, action {:.0f}, value {:.4f}.'.format(episode_length, epr,
+                                                                          action.numpy()[0],
+                                                                          value.detach().numpy()[0,0]))
+    if epr == 0:
+        return None
+
+    padding_amt = int(max_ep_len - len(cur_obs))
+
+    elem_obs = cur_obs[-1]
+    padding_elem_obs = np.zeros_like(elem_obs)
+    for _ in range(padding_amt):
+        cur_obs.insert(0, padding_elem_obs)
+
+    elem_states = cur_states[-1]
+    padding_elem_states = np.zeros_like(elem_states)
+    for _ in range(padding_amt):
+        cur_states.insert(0, padding_elem_states)
+
+    elem_acts = cur_acts[-1]
+    padding_elem_acts = np.ones_like(elem_acts) * -1
+    for _ in range(padding_amt):
+        cur_acts.insert(0, padding_elem_acts)
+
+    elem_rewards = cur_rewards[-1]
+    padding_elem_rewards = np.zeros_like(elem_rewards)
+    for _ in range(padding_amt):
+        cur_rewards.insert(0, padding_elem_rewards)
+
+    elem_values = cur_values[-1]
+    padding_elem_values = np.zeros_like(elem_values)
+    for _ in range(padding_amt):
+        cur_values.insert(0, padding_elem_values)
+
+    obs = np.array(cur_obs)
+    states = np.array(cur_states)
+    acts = np.array(cur_acts)
+    rewards = np.array(cur_rewards)
+    values = np.array(cur_values)
+
+    acts = acts + 1
+    final_rewards = rewards[-1].astype('int32')  # get the final reward of each traj.
+    if final_rewards == -1:
+        final_rewards = 0
+    elif final_rewards == 1:
+        final_rewards = 1
+    else:
+        final_rewards = 0
+        print('None support final_rewards')
+    print(final_rewards)
+    return dict(observations=obs, actions=acts, values=values, states=states, rewards=rewards,
+                final_rewards=final_rewards, seed=seed)
+
+
 def rollout(model, env_name, num_traj, max_ep_len=1e3, save_path=None, render=False):
 
     traj_count = 0
+    env_pool = EnvPool(env_name)
     for i in range(num_traj):
-        env = gym.make(env_name)
-        env.seed(i)
-        env.env.frameskip = 3
-
         print('Traj %d out of %d.' %(i, num_traj))
-        cur_obs, cur_states, cur_acts, cur_rewards, cur_values = [], [], [], [], []
-        state = torch.tensor(prepro(env.reset()))  # get first state
-        episode_length, epr, eploss, done = 0, 0, 0, False  # bookkeeping
-        hx, cx = Variable(torch.zeros(1, 256)), Variable(torch.zeros(1, 256))
-
-        while not done and episode_length < max_ep_len:
-            value, logit, (hx, cx) = model((Variable(state.view(1, 1, 80, 80)), (hx, cx)))
-            hx, cx = Variable(hx.data), Variable(cx.data)
-            prob = F.softmax(logit, dim=-1)
-
-            action = prob.max(1)[1].data  # prob.multinomial().data[0] #
-            obs, reward, done, expert_policy = env.step(action.numpy()[0])
-            if env.env.game == 'pong':
-                done = reward
-            if render: env.render()
-            state = torch.tensor(prepro(obs))
-            epr += reward
-
-            # save info!
-            cur_obs.append(obs)
-            cur_states.append(state.detach().numpy())
-            cur_acts.append(action.numpy()[0])
-            cur_rewards.append(reward)
-            cur_values.append(value.detach().numpy()[0,0])
-            episode_length += 1
-
-        print('step # {}, reward {:.0f}, action {:.0f}, value {:.4f}.'.format(episode_length, epr,
-                                                                              action.numpy()[0],
-                                                                              value.detach().numpy()[0,0]))
-        if epr != 0:
-
-            padding_amt = int(max_ep_len - len(cur_obs))
-
-            elem_obs = cur_obs[-1]
-            padding_elem_obs = np.zeros_like(elem_obs)
-            for _ in range(padding_amt):
-                cur_obs.insert(0, padding_elem_obs)
-
-            elem_states = cur_states[-1]
-            padding_elem_states = np.zeros_like(elem_states)
-            for _ in range(padding_amt):
-                cur_states.insert(0, padding_elem_states)
-
-            elem_acts = cur_acts[-1]
-            padding_elem_acts = np.ones_like(elem_acts) * -1
-            for _ in range(padding_amt):
-                cur_acts.insert(0, padding_elem_acts)
-
-            elem_rewards = cur_rewards[-1]
-            padding_elem_rewards = np.zeros_like(elem_rewards)
-            for _ in range(padding_amt):
-                cur_rewards.insert(0, padding_elem_rewards)
-
-            elem_values = cur_values[-1]
-            padding_elem_values = np.zeros_like(elem_values)
-            for _ in range(padding_amt):
-                cur_values.insert(0, padding_elem_values)
-
-            obs = np.array(cur_obs)
-            states = np.array(cur_states)
-            acts = np.array(cur_acts)
-            rewards = np.array(cur_rewards)
-            values = np.array(cur_values)
-
-            acts = acts + 1
-            final_rewards = rewards[-1].astype('int32')  # get the final reward of each traj.
-            if final_rewards == -1:
-                final_rewards = 0
-            elif final_rewards == 1:
-                final_rewards = 1
-            else:
-                final_rewards = 0
-                print('None support final_rewards')
-            print(final_rewards)
-            np.savez_compressed(save_path + '_traj_' + str(traj_count) + '.npz', observations=obs,
-                                actions=acts, values=values, states=states, rewards=rewards,
-                                final_rewards=final_rewards, seed=i)
+        traj = rollout_episode(model, env_pool, i, max_ep_len, render)
+        if traj is not None:
+            np.savez_compressed(save_path + '_traj_' + str(traj_count) + '.npz', **traj)
             traj_count += 1
-        env.close()
+    env_pool.close()
     np.save(save_path + '_max_length.npy', max_ep_len)
     np.save(save_path + '_num_traj.npy', traj_count)
 
 
-def rl_fed(env_name, seed, model, original_traj, importance, max_ep_len=1e3, render=False, mask_act=False):
+def _chunk_store_path(save_path, seeds):
+    return save_path + '_chunk_' + str(int(seeds[0]))
+
+
+def _rollout_worker(model, env_name, seeds, max_ep_len, chunk_path):
+    """
+    Play the episodes of a contiguous chunk of seeds with a single env, writing the kept trajs into a TrajStore
+    under chunk_path, created from the first kept traj
+    :return: seeds of the kept trajs, in increasing order
+    """
+    torch.set_num_threads(1)
+    env_pool = EnvPool(env_name)
+    kept = []
+    store = None
+    for seed in seeds:
+        seed = int(seed)
+        traj = rollout_episode(model, env_pool, seed, max_ep_len)
+        if traj is None:
+            continue
+        arrays = {field: np.asarray(traj[key]) for field, key in STORE_FIELDS.items()}
+        if store is None:
+            store = TrajStore.create(chunk_path, len(seeds),
+                                     {field: (value.shape, value.dtype) for field, value in arrays.items()})
+        store.write(len(kept), **arrays)
+        kept.append(seed)
+    if store is not None:
+        store.flush()
+    env_pool.close()
+    return kept
+
+
+def _merge_chunk_stores(save_path, chunk_paths, kept, source=None):
+    """
+    Concatenate the kept trajs of the chunk stores, in chunk order, into the store of save_path
+    :param chunk_paths: traj path prefixes of the chunk stores
+    :param kept: seeds of the kept trajs of every chunk
+    :param source: see TrajStore.create
+    :return: the store, None if no traj is kept
+    """
+    chunks = [(TrajStore(chunk_path, mode='r'), len(seeds)) for chunk_path, seeds in zip(chunk_paths, kept) if seeds]
+    if not chunks:
+        return None
+    first = chunks[0][0]
+    specs = {field: (column.shape[1:], column.dtype) for field, column in first.columns.items()}
+    store = TrajStore.create(save_path, sum(num_kept for _, num_kept in chunks), specs, source)
+    offset = 0
+    for chunk, num_kept in chunks:
+        for field in specs:
+            store[field][offset:offset + num_kept] = chunk[field][:num_kept]
+        offset += num_kept
+    store.flush()
+    return store
+
+
+def _remove_store(traj_path):
+    for path in [store_file(traj_path, field) for field in STORE_FIELDS] + [store_meta_file(traj_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def rollout_parallel(model, env_name, num_traj, max_ep_len=1e3, save_path=None, num_workers=None):
+    """
+    Same trajs, numbering and metadata as rollout, with the seeds split into contiguous chunks over a pool of
+    processes. The trajs are saved as a TrajStore (states, actions, final_rewards, seeds), without the per traj
+    .npz files, use rollout for the other arrays. The pool uses spawn, so the calling script must be guarded by
+    if __name__ == '__main__'
+    :param model: policy, copied into every worker
+    :param env_name: env name
+    :param num_traj: number of seeds (episodes) to play
+    :param max_ep_len: maximum (padded) traj length
+    :param save_path: traj path prefix
+    :param num_workers: number of processes, the number of cpus by default
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if num_workers < 1:
+        raise ValueError('num_workers should be positive.')
+    chunks = [chunk for chunk in np.array_split(np.arange(num_traj), num_workers) if chunk.shape[0] > 0]
+    chunk_paths = [_chunk_store_path(save_path, chunk) for chunk in chunks]
+
+    kept = []
+    try:
+        if chunks:
+            with multiprocessing.get_context('spawn').Pool(len(chunks)) as pool:
+                kept = pool.starmap(_rollout_worker, [(model, env_name, chunk, max_ep_len, chunk_path)
+                                                      for chunk, chunk_path in zip(chunks, chunk_paths)])
+
+        # Number the kept trajs in seed order, as the sequential rollout does.
+        traj_count = sum(len(seeds) for seeds in kept)
+        np.save(save_path + '_max_length.npy', max_ep_len)
+        np.save(num_traj_file(save_path), traj_count)
+        # A later rollout to the same path rewrites _num_traj.npy, which makes this store stale.
+        source = {'num_traj': traj_count, 'mtime': os.path.getmtime(num_traj_file(save_path))}
+        _merge_chunk_stores(save_path, chunk_paths, kept, source)
+    finally:
+        for chunk_path in chunk_paths:
+            _remove_store(chunk_path)
+    print('Collected %d trajs out of %d.' % (traj_count, num_traj))
+
+
+def rl_fed(env_name, seed, model, original_traj, importance, max_ep_len=1e3, render=False, mask_act=False,
+           env_pool=None):
+    """
+    :param env_pool: EnvPool to reset the env from, the shared get_env_pool(env_name) by default
+    """
 
     acts_orin = original_traj['actions']
     traj_len = np.count_nonzero(acts_orin)
     start_step = max_ep_len - traj_len
 
-    env = gym.make(env_name)
-    env.seed(seed)
-    env.env.frameskip = 3
+    if env_pool is None:
+        env_pool = get_env_pool(env_name)
+    env, obs_0 = env_pool.reset(seed)  # get first state
 
     episode_length, epr, done = 0, 0, False  # bookkeeping
-    obs_0 = env.reset()  # get first state
     state = torch.tensor(prepro(obs_0))
     hx, cx = Variable(torch.zeros(1, 256)), Variable(torch.zeros(1, 256))
     act_set = np.array([0, 1, 2, 3, 4, 5])
@@ -296,5 +486,6 @@ def rl_fed(env_name, seed, model, original_traj, importance, max_ep_len=1e3, ren
         # save info!
         episode_length += 1
 
+    env_pool.release(env)
     print('step # {}, reward {:.0f}.'.format(episode_length, epr))
     return epr